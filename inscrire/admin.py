@@ -20,6 +20,8 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.forms import UserCreationForm
 from django import forms
+from django.urls import reverse
+from django.utils.html import format_html
 from django.utils.translation import gettext, gettext_lazy as _
 
 from inscrire.models import *
@@ -105,6 +107,38 @@ admin.site.register(ParcoursupUser)
 admin.site.register(ParcoursupMessageRecuLog)
 admin.site.register(ParcoursupMessageEnvoyeLog)
 
+@admin.register(TacheAdmission)
+class TacheAdmissionAdmin(admin.ModelAdmin):
+	list_display = ('pk', 'user', 'etat', 'tentatives', 'date_creation', 'prochaine_tentative', 'candidat', 'dossier_parcoursup')
+	list_filter = ('etat',)
+	readonly_fields = ('message', 'candidat', 'date_creation', 'date_debut', 'date_fin', 'erreur')
+	actions = ('relancer',)
+
+	def relancer(self, request, queryset):
+		for tache in queryset:
+			tache.relancer()
+	relancer.short_description = "Relancer les tâches sélectionnées"
+
+@admin.register(TacheExport)
+class TacheExportAdmin(TacheAdmissionAdmin):
+	list_display = ('pk', 'etablissement', 'format', 'etat', 'tentatives', 'date_creation', 'avance', 'total')
+	readonly_fields = ('demandeur', 'telechargement', 'avance', 'total', 'date_creation', 'date_debut', 'date_fin', 'erreur')
+
+	def telechargement(self, obj):
+		# Les exports n'ont pas d'adresse publique
+		if obj.etat != obj.ETAT_TERMINEE or not obj.fichier:
+			return "-"
+		return format_html('<a href="{}">{}</a>',
+				reverse('export_telechargement', args=[obj.pk]),
+				obj.nom_telechargement())
+	telechargement.short_description = "fichier"
+
+@admin.register(Courriel)
+class CourrielAdmin(TacheAdmissionAdmin):
+	list_display = ('pk', 'sujet', 'expediteur', 'etat', 'tentatives', 'date_creation', 'date_fin')
+	search_fields = ('destinataires', 'sujet')
+	readonly_fields = ('candidat', 'envoi', 'date_creation', 'date_debut', 'date_fin', 'erreur')
+
 class HistoriqueVoeuInline(admin.TabularInline):
 	model = HistoriqueVoeu
 	extra = 0
@@ -114,6 +148,11 @@ class VoeuAdmin(admin.ModelAdmin):
 	list_display = ('candidat', 'formation', 'get_etat_display')
 	inlines = (HistoriqueVoeuInline,)
 
+@admin.register(DossierEtat)
+class DossierEtatAdmin(admin.ModelAdmin):
+	list_display = ('candidat', 'formation', 'etat', 'date_maj')
+	list_filter = ('formation', 'etat')
+
 @admin.register(FicheIdentite)
 class FicheIdentiteAdmin(admin.ModelAdmin):
 	search_fields = ('candidat',)
@@ -3,3 +3,49 @@ from django.apps import AppConfig
 
 class InscrireConfig(AppConfig):
 	name = 'inscrire'
+
+	def ready(self):
+		from django.db.models.signals import post_save, post_delete, \
+				m2m_changed
+		from inscrire.lib.referentiel import invalider_referentiel
+		from inscrire.lib.configuration import invalider_configuration
+		from inscrire.models import Commune, Pays, Profession, \
+				Etablissement, Voeu, ChampExclu, EnteteFiche
+		from inscrire.models.fiches import Fiche, all_fiche
+		from inscrire.models.parcoursup import maj_dossier_etat, \
+				maj_dossiers_etablissement
+
+		# Les données de référence en cache sont invalidées à chaque
+		# modification, y compris lors du chargement des fixtures.
+		for model in (Commune, Pays, Profession, Etablissement):
+			post_save.connect(invalider_referentiel, sender=model,
+					dispatch_uid='referentiel_{}_save'.format(model._meta.model_name))
+			post_delete.connect(invalider_referentiel, sender=model,
+					dispatch_uid='referentiel_{}_delete'.format(model._meta.model_name))
+
+		# L'état des dossiers des candidats suit les modifications de
+		# leurs fiches et de leurs vœux, ainsi que celles des fiches
+		# utilisées par leur établissement. La suppression d'une fiche
+		# n'est prise en compte qu'avec celle de sa ligne dans la table
+		# Fiche, effacée après celle de la sous-classe.
+		for model in all_fiche + [Voeu]:
+			post_save.connect(maj_dossier_etat, sender=model,
+					dispatch_uid='dossier_{}_save'.format(model._meta.model_name))
+		for model in (Fiche, Voeu):
+			post_delete.connect(maj_dossier_etat, sender=model,
+					dispatch_uid='dossier_{}_delete'.format(model._meta.model_name))
+		m2m_changed.connect(maj_dossiers_etablissement,
+				sender=Etablissement.fiches.through,
+				dispatch_uid='dossier_etablissement_fiches')
+
+		# La configuration des établissements en cache est invalidée à
+		# chaque modification dans l'interface d'administration.
+		for model in (Etablissement, ChampExclu, EnteteFiche):
+			post_save.connect(invalider_configuration, sender=model,
+					dispatch_uid='configuration_{}_save'.format(model._meta.model_name))
+			post_delete.connect(invalider_configuration, sender=model,
+					dispatch_uid='configuration_{}_delete'.format(model._meta.model_name))
+		for through in (Etablissement.fiches.through,
+				Etablissement.champs_exclus.through):
+			m2m_changed.connect(invalider_configuration, sender=through,
+					dispatch_uid='configuration_{}'.format(through._meta.model_name))
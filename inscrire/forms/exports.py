@@ -0,0 +1,32 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from django import forms
+
+from inscrire.models import Etablissement, TacheExport
+
+class ExportForm(forms.ModelForm):
+	class Meta:
+		model = TacheExport
+		fields = ('etablissement', 'format')
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.fields['etablissement'].queryset = Etablissement.objects.filter(
+				inscriptions=True).order_by('numero_uai')
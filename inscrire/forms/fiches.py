@@ -31,18 +31,22 @@ from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
-from django.contrib.contenttypes.models import ContentType
 from dal import autocomplete
 
 from inscrire.models import fiches, ResponsableLegal, Candidat
-from inscrire.models import MefOption, PieceJustificative, EnteteFiche
+from inscrire.models import MefOption, PieceJustificative
+from inscrire.lib.configuration import configurations
 
 class FicheValiderMixin:
-	def __init__(self, *args, **kwargs):
+	"""
+	La formation du candidat peut être passée en paramètre (formation)
+	quand plusieurs formulaires sont construits pour le même candidat :
+	elle n'est alors pas recherchée par chacun d'eux.
+	"""
+	def __init__(self, *args, formation=None, **kwargs):
 		super().__init__(*args, **kwargs)
-		contenttypefiche = ContentType.objects.get_for_model(kwargs['instance'])
-		champs_exclus = kwargs['instance'].candidat.voeu_actuel.formation.etablissement.champs_exclus.filter(fiche = contenttypefiche)
-		for field in [champ_exclu.champ for champ_exclu in champs_exclus]:
+		self.formation = formation
+		for field in self.configuration.champs_exclus(self.instance):
 			self.fields.pop(field)
 
 		if self.instance.etat != self.instance.ETAT_EDITION:
@@ -59,21 +63,27 @@ class FicheValiderMixin:
 
 		return instance
 
+	def get_formation(self):
+		if self.formation is None:
+			self.formation = self.instance.candidat.voeu_actuel.formation
+		return self.formation
+
+	@cached_property
+	def configuration(self):
+		"""Configuration de l'établissement du candidat"""
+		return configurations.get(self.get_formation().etablissement_id)
+
 	def entete(self, *args, **kwargs):
 		"""Renvoie l'entete d'une fiche."""
 
 		def href(email, sujet=""):
 			return "<a href = 'mailto:{email}?subject={sujet}'>{email}</a>".format(email = email, sujet=sujet)
 
-		contenttypefiche = ContentType.objects.get_for_model(self.instance)
-		formation = self.instance.candidat.voeu_actuel.formation
-		etablissement =  formation.etablissement
-		try:
-			entete = EnteteFiche.objects.get(fiche = contenttypefiche, formation = formation).texte
-		except EnteteFiche.DoesNotExist:
-			entete = EnteteFiche.objects.get(fiche = contenttypefiche, etablissement = etablissement).texte
-		except EnteteFiche.DoesNotExist:
+		formation = self.get_formation()
+		entete = self.configuration.entete(self.instance, formation)
+		if entete is None:
 			return ""
+		etablissement =  formation.etablissement
 		return entete.format(
 			email = href(formation.email_defaut),
 			email_pj = href(formation.email_pj, formation.sujet_email_pieces_justificatives),
@@ -122,23 +132,23 @@ class IdentiteFicheForm(FicheValiderMixin, forms.ModelForm):
 	def clean_photo(self, *args, **kwargs):
 		photo = self.cleaned_data['photo']
 		if photo and 'file' in photo.__dict__:
-			etablissement =  self.instance.candidat.voeu_actuel.formation.etablissement
+			configuration = self.configuration
 			if photo.content_type != 'image/jpeg':
 				raise forms.ValidationError("Le fichier photo doit être au format .jpg")
-			if photo.size > 1024*etablissement.photo_size_max:
+			if photo.size > 1024*configuration.photo_size_max:
 				raise forms.ValidationError(
 					"Le poids maximal du fichier photo est de {}ko. Le vôtre fait {}ko.".format(
-						etablissement.photo_size_max, int(photo.size/1024)))
+						configuration.photo_size_max, int(photo.size/1024)))
 			largeur, hauteur = photo.image.size
 			try:
 				ratio = hauteur/largeur
 			except:
 				raise forms.ValidationError("Fichier non valide")
-			ratio_etablissement = etablissement.photo_hauteur/etablissement.photo_largeur
-			if abs(ratio - ratio_etablissement) > ratio_etablissement*etablissement.tolerance_ratio/100:
+			ratio_etablissement = configuration.photo_hauteur/configuration.photo_largeur
+			if abs(ratio - ratio_etablissement) > ratio_etablissement*configuration.tolerance_ratio/100:
 				raise forms.ValidationError(
 					"Le rapport largeur/hauteur de votre fichier photo doit être environ {}/{}".format(
-						etablissement.photo_largeur, etablissement.photo_hauteur))
+						configuration.photo_largeur, configuration.photo_hauteur))
 		return photo
 
 ResponsablesForm = forms.inlineformset_factory(
@@ -154,8 +164,10 @@ class IdentiteForm(FicheValiderMixin):
 	form_classes = [IdentiteFicheForm, ResponsablesForm]
 
 	def __init__(self, instance=None, data=None, files=None, auto_id='id_%s', prefix=None,
-			initial=None, error_class=ErrorList, form_kwargs=None):
+			initial=None, error_class=ErrorList, form_kwargs=None,
+			formation=None):
 		self.instance = instance
+		self.formation = formation
 		self.is_bound = data is not None or files is not None
 		self.prefix = prefix or self.get_default_prefix()
 		self.auto_id = auto_id
@@ -204,6 +216,8 @@ class IdentiteForm(FicheValiderMixin):
 			'error_class': self.error_class,
 			'instance': self.instance if i == 0 else self.instance.candidat,
 		}
+		if i == 0:
+			defaults['formation'] = self.formation
 		if self.is_bound:
 			defaults['data'] = self.data
 			defaults['files'] = self.files
@@ -472,8 +486,10 @@ class ScolariteAnterieureForm:
 	form_classes = [ScolariteAnterieureBaseForm, ScolariteBulletinForm]
 
 	def __init__(self, instance=None, data=None, files=None, auto_id='id_%s', prefix=None,
-			initial=None, error_class=ErrorList, form_kwargs=None):
+			initial=None, error_class=ErrorList, form_kwargs=None,
+			formation=None):
 		self.instance = instance
+		self.formation = formation
 		self.is_bound = data is not None or files is not None
 		self.prefix = prefix or self.get_default_prefix()
 		self.auto_id = auto_id
@@ -522,6 +538,8 @@ class ScolariteAnterieureForm:
 			'error_class': self.error_class,
 			'instance': self.instance,
 		}
+		if i == 0:
+			defaults['formation'] = self.formation
 		if self.is_bound:
 			defaults['data'] = self.data
 			defaults['files'] = self.files
@@ -661,9 +679,10 @@ class PieceJustificativeForm(FicheValiderMixin, forms.ModelForm):
 
 	def pieces_qs(self):
 		"""Pieces à envoyer"""
+		formation = self.get_formation()
 		return PieceJustificative.objects.filter(
-			models.Q(formation=self.instance.candidat.voeu_actuel.formation)|
-			models.Q(etablissement=self.instance.candidat.voeu_actuel.formation.etablissement))
+			models.Q(formation=formation)|
+			models.Q(etablissement_id=formation.etablissement_id))
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
@@ -685,9 +704,10 @@ class PieceJustificativeSuiviForm(FicheValiderMixin, forms.ModelForm):
 
 	def pieces_qs(self):
 		"""Pieces à envoyer"""
+		formation = self.get_formation()
 		return PieceJustificative.objects.filter(
-			models.Q(formation=self.instance.candidat.voeu_actuel.formation)|
-			models.Q(etablissement=self.instance.candidat.voeu_actuel.formation.etablissement))
+			models.Q(formation=formation)|
+			models.Q(etablissement_id=formation.etablissement_id))
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
@@ -20,7 +20,7 @@ import codecs
 from django import forms
 
 from inscrire.models import Formation
-from inscrire.lib.parcoursup_fichiers import parse_export_standard
+from inscrire.lib.parcoursup_fichiers import ExportStandard, ExportInvalide
 
 class ImportParcoursupForm(forms.Form):
 	export = forms.FileField()
@@ -28,12 +28,22 @@ class ImportParcoursupForm(forms.Form):
 			queryset=Formation.objects.filter(code_parcoursup__isnull=False
 				).order_by('etablissement', 'pk'))
 
-	def propositions(self):
-		return parse_export_standard(
-				codecs.iterdecode(self.cleaned_data['export'],
-					'utf-8'),
-				self.cleaned_data['formation'].etablissement.pk,
-				self.cleaned_data['formation'].code_parcoursup)
+	def clean(self):
+		cleaned_data = super().clean()
+		if 'export' in cleaned_data and 'formation' in cleaned_data:
+			# Seule la ligne d'entête est lue ici, les admissions sont
+			# lues au fur et à mesure de l'import
+			try:
+				self.export = ExportStandard(
+						codecs.iterdecode(cleaned_data['export'],
+							'utf-8-sig'),
+						cleaned_data['formation'].etablissement.pk,
+						cleaned_data['formation'].code_parcoursup)
+			except ExportInvalide as e:
+				self.add_error('export', str(e))
+			except UnicodeDecodeError:
+				self.add_error('export', "Le fichier doit être encodé en UTF-8.")
+		return cleaned_data
 
 class ImportClassementForm(forms.Form):
 	fichier = forms.FileField()
@@ -33,6 +33,11 @@ class ImportStructuresForm(forms.Form):
 
 	@staticmethod
 	def _open_maybe_zip(source_file):
+		"""
+		Renvoie le fichier donné, ou le premier fichier qu'il contient
+		s'il s'agit d'une archive ZIP. Le contenu de l'archive est
+		décompressé au fur et à mesure de sa lecture.
+		"""
 		try:
 			file_zip = zipfile.ZipFile(source_file)
 			return file_zip.open(file_zip.namelist()[0])
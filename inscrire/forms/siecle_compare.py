@@ -8,6 +8,7 @@ class ImportFichiersSiecleForm(forms.Form):
 #    elevesavecadresses=forms.FileField(label="ElevesAvecAdresses.xml", required=False)
 #    responsablessansadresses=forms.FileField(label="ResponsablesSansdAdresses.xml", required=False)
 #    responsablesavecadresses=forms.FileField(label="ResponsablesAvecAdresses.xml", required=False)
+    export_csv=forms.BooleanField(label="Télécharger le résultat au format CSV", required=False)
 
     def clean(self):
         cd=super().clean()
@@ -19,7 +20,7 @@ class ImportFichiersSiecleForm(forms.Form):
             return
         elevessansadresses=cd.get('elevessansadresses', None)
     #    elevesavecadresses=cd.get('elevesavecadresses', None)
-        if not elevessansadresses and not elevesavecadresses:
+        if not elevessansadresses: # and not elevesavecadresses
             raise forms.ValidationError("Fournissez obligatoirement l'un des fichiers élèves")
 
     def clean_structures(self):
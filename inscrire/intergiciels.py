@@ -1,25 +1,14 @@
-import os
 from django.http import HttpResponse
-from django.shortcuts import redirect
-from django.urls import reverse
-from django.conf import settings
+
+from inscrire.lib.maintenance import maintenance
 
 def en_travaux(get_response):
+    # L'état du mode maintenance est conservé en mémoire : aucun fichier
+    # n'est lu pendant les requêtes (voir inscrire.lib.maintenance).
     def middleware(request):
-        try:
-            with open(os.path.join(settings.BASE_DIR, 'scripsup/en_travaux.txt'), encoding = 'utf-8', newline = '') as f:
-                en_travaux = f.read().strip()
-        except FileNotFoundError:
-            en_travaux = "Site en cours de configuration"
+        en_travaux = maintenance.message_travaux(request.META.get('REMOTE_ADDR'))
         if en_travaux:
-            try:
-                with open(os.path.join(settings.BASE_DIR, 'scripsup/maintenance_mode_ip.txt'), encoding = 'utf-8', newline = '') as f:
-                    IPs = [line.strip() for line in f.readlines()]
-            except FileNotFoundError:
-                return HttpResponse(en_travaux)
-            IP = request.META.get('REMOTE_ADDR')
-            if not IP in IPs :
-                return HttpResponse(en_travaux)
+            return HttpResponse(en_travaux)
         response = get_response(request)
         return response
     return middleware
@@ -0,0 +1,166 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Comparaison des élèves d'un export SIECLE avec les candidats inscrits
+
+Les candidats correspondant aux élèves sont recherchés par paquets
+(adresse e-mail, puis INE), de même que les options choisies dans leurs
+fiches et les libellés des matières : le nombre de requêtes ne dépend
+pas du nombre d'élèves. La comparaison elle-même se fait en mémoire.
+"""
+
+from django.db.models import Q
+
+from inscrire.models import Candidat, Voeu, Fiche, FicheScolarite, MefMatiere
+
+class ComparaisonSiecle:
+	"""
+	Comparaison entre les élèves de SIECLE (dictionnaire renvoyé par
+	ElevesSansAdresses.eleves()) et les candidats admis dans les
+	formations de l'établissement. Seuls les élèves des divisions
+	rattachées aux MEF de première année des formations sont retenus
+	(structures est le dictionnaire renvoyé par Structures.structures()).
+
+	Après l'appel à comparer(), les résultats sont disponibles dans :
+	- eleves_sans_candidat : élèves SIECLE sans candidat correspondant,
+	  indexés par identifiant SIECLE,
+	- candidats_sans_eleve : couples (candidat, vœu) des candidats admis
+	  sans élève correspondant,
+	- divergences : triplets (candidat, division, libellés) des options
+	  suivies dans SIECLE mais non choisies dans scripsup.
+	"""
+	taille_paquet = 500
+
+	ETATS_FICHE = (Fiche.ETAT_EDITION, Fiche.ETAT_CONFIRMEE,
+			Fiche.ETAT_TERMINEE)
+
+	def __init__(self, etablissement, eleves, structures):
+		self.etablissement = etablissement
+		self.eleves = eleves
+		self.structures = structures
+		self.eleves_sans_candidat = {}
+		self.candidats_sans_eleve = []
+		self.divergences = []
+
+	def divisions(self):
+		"""Divisions SIECLE des formations de l'établissement"""
+		divisions = set()
+		for formation in self.etablissement.formation_set.all():
+			if formation.code_mef[-2] == '1':
+				divisions.update(self.structures.get(formation.code_mef, ()))
+		return divisions
+
+	def _paquets(self, valeurs):
+		valeurs = sorted(valeurs)
+		for debut in range(0, len(valeurs), self.taille_paquet):
+			yield valeurs[debut:debut + self.taille_paquet]
+
+	def candidats(self, emails, ines):
+		"""
+		Renvoie deux index des candidats ayant l'une des adresses e-mail
+		ou l'un des INE donnés : par adresse et par INE.
+		"""
+		par_email = {}
+		par_ine = {}
+		requetes = [Q(user__email__in=paquet) for paquet in self._paquets(emails)]
+		requetes += [Q(ine__in=paquet) for paquet in self._paquets(ines)]
+		for requete in requetes:
+			for candidat in Candidat.objects.filter(requete
+					).select_related('user').order_by('pk'):
+				par_email.setdefault(candidat.user.email, candidat)
+				if candidat.ine:
+					par_ine.setdefault(candidat.ine, candidat)
+		return par_email, par_ine
+
+	def matieres_choisies(self, candidats):
+		"""
+		Renvoie un dictionnaire associant à chaque candidat donné
+		l'ensemble des codes des matières choisies dans sa fiche de
+		choix des options.
+		"""
+		matieres = {}
+		for paquet in self._paquets(candidats):
+			for candidat, matiere in FicheScolarite.objects.filter(
+					candidat__in=paquet, etat__in=self.ETATS_FICHE
+					).values_list('candidat_id', 'options__matiere_id'):
+				choisies = matieres.setdefault(candidat, set())
+				if matiere is not None:
+					choisies.add(matiere)
+		return matieres
+
+	def comparer(self):
+		divisions = self.divisions()
+		eleves = {eleve: dic for eleve, dic in self.eleves.items()
+				if dic['structure'] in divisions}
+
+		par_email, par_ine = self.candidats(
+				{dic['email'] for dic in eleves.values() if dic['email']},
+				{dic['ine'] for dic in eleves.values() if dic['ine']})
+		correspondances = {}
+		for eleve, dic in eleves.items():
+			candidat = (dic['email'] and par_email.get(dic['email'])) or \
+					(dic['ine'] and par_ine.get(dic['ine'])) or None
+			dic['candidat'] = candidat
+			if candidat is None:
+				self.eleves_sans_candidat[eleve] = dic
+			else:
+				correspondances[eleve] = candidat
+
+		pks = {candidat.pk for candidat in correspondances.values()}
+		self.candidats_sans_eleve = [(voeu.candidat, voeu) for voeu in
+				Voeu.objects.filter(formation__etablissement=self.etablissement,
+					etat__in=(Voeu.ETAT_ACCEPTE_AUTRES,
+						Voeu.ETAT_ACCEPTE_DEFINITIF)
+				).select_related('candidat__user', 'formation'
+				).order_by('candidat__last_name', 'candidat__first_name', 'pk')
+				if voeu.candidat_id not in pks]
+
+		# Divergences d'options
+		matieres = self.matieres_choisies(pks)
+		codes = {option['code_matiere'] for eleve in correspondances
+				for option in eleves[eleve]['options']}
+		libelles = dict(MefMatiere.objects.filter(code__in=codes
+			).values_list('code', 'libelle_court'))
+		for eleve, candidat in correspondances.items():
+			dic = eleves[eleve]
+			choisies = matieres.get(candidat.pk, set())
+			options = [libelles.get(option['code_matiere'],
+					option['code_matiere']) for option in dic['options']
+					if option['code_matiere'] not in choisies]
+			if options:
+				self.divergences.append((candidat, dic['structure'], options))
+		return self
+
+	def entete(self):
+		return ['Écart', 'Nom', 'Prénom', 'INE', 'Email', 'Division',
+				'Détail']
+
+	def lignes(self):
+		"""Lignes de l'export CSV des résultats"""
+		for dic in self.eleves_sans_candidat.values():
+			yield ["Élève SIECLE sans candidat", dic['nom'], dic['prenom'],
+					dic['ine'], dic['email'], dic['structure'], ""]
+		for candidat, voeu in self.candidats_sans_eleve:
+			yield ["Candidat sans élève SIECLE", candidat.last_name,
+					candidat.first_name, candidat.ine, candidat.user.email,
+					"", voeu.formation]
+		for candidat, division, options in self.divergences:
+			yield ["Options SIECLE non choisies", candidat.last_name,
+					candidat.first_name, candidat.ine, candidat.user.email,
+					division, ", ".join(options)]
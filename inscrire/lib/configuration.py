@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Configuration des établissements en cache
+
+Les fiches utilisées par un établissement, les champs exclus de ces
+fiches, leurs entêtes et les contraintes sur les photographies sont lus
+pour chaque fiche de chaque page d'un candidat, mais ne changent que
+dans l'interface d'administration. Ils sont donc réunis dans un
+instantané (EtablissementConfig), conservé en mémoire par chaque
+processus et, si le cache Django est partagé entre processus (réglage
+CACHES), placé aussi dans ce cache.
+
+Comme pour le référentiel (voir inscrire.lib.referentiel), un numéro de
+version stocké dans la base (voir VersionDonnees) est incrémenté à
+chaque modification de la configuration d'un établissement. Chaque
+processus le compare régulièrement à celui des instantanés qu'il a
+conservés ; les instantanés sont de toute façon rechargés au bout de
+DUREE_LOCALE secondes.
+
+Une transaction qui a modifié la configuration voit un numéro de version
+qui n'est pas encore validé (et qui sera réutilisé si elle est annulée) :
+les instantanés qu'elle lit sont construits à partir de la base, sans
+passer par les caches ni y être conservés.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+
+NOM_VERSION = 'configuration'
+
+# Délai (en secondes) entre deux vérifications du numéro de version dans
+# la base.
+DELAI_VERIFICATION = 10
+
+# Durée maximale (en secondes) de conservation d'un instantané en
+# mémoire, même si le numéro de version n'a pas changé.
+DUREE_LOCALE = 300
+
+# Durée de conservation des instantanés dans le cache Django. Ceux des
+# versions périmées ne sont plus jamais lus.
+DUREE_CACHE = 3600
+
+class EtablissementConfig(namedtuple('EtablissementConfig', (
+		'uai',
+		'fiches',
+		'exclus',
+		'entetes',
+		'photo_size_max',
+		'photo_largeur',
+		'photo_hauteur',
+		'tolerance_ratio',
+		))):
+	"""
+	Instantané de la configuration d'un établissement :
+	- fiches : identifiants des ContentType des fiches utilisées,
+	- exclus : ensemble des champs exclus, par ContentType de fiche,
+	- entetes : texte des entêtes de fiche, par couple (ContentType,
+	  formation), la formation valant None pour l'entête de
+	  l'établissement,
+	- les contraintes sur les photographies d'identité.
+
+	Cet objet est partagé : exclus et entetes sont donc des
+	dictionnaires en lecture seule.
+	"""
+	__slots__ = ()
+
+	def __new__(cls, *args, **kwargs):
+		configuration = super().__new__(cls, *args, **kwargs)
+		# _replace ne repasse pas par __new__
+		return configuration._replace(
+				exclus=MappingProxyType(dict(configuration.exclus)),
+				entetes=MappingProxyType(dict(configuration.entetes)))
+
+	def __getnewargs__(self):
+		# Un MappingProxyType ne peut pas être sérialisé par pickle (cache
+		# Django) : l'instantané est sérialisé avec de simples
+		# dictionnaires, de nouveau protégés par __new__ à la lecture.
+		return tuple(dict(valeur) if isinstance(valeur, MappingProxyType)
+				else valeur for valeur in self)
+
+	@classmethod
+	def charger(cls, uai):
+		from inscrire.models import Etablissement, EnteteFiche
+
+		etablissement = Etablissement.objects.get(pk=uai)
+		exclus = {}
+		for fiche, champ in etablissement.champs_exclus.values_list(
+				'fiche_id', 'champ'):
+			exclus.setdefault(fiche, set()).add(champ)
+
+		entetes = {}
+		# En cas de doublon, l'entête le plus ancien l'emporte
+		for fiche, etab, formation, texte in EnteteFiche.objects.filter(
+				Q(etablissement_id=uai) | Q(formation__etablissement_id=uai)
+				).order_by('pk').values_list('fiche_id', 'etablissement_id',
+					'formation_id', 'texte'):
+			if formation is not None:
+				entetes.setdefault((fiche, formation), texte)
+			if etab == uai:
+				entetes.setdefault((fiche, None), texte)
+
+		return cls(
+				uai=uai,
+				fiches=frozenset(etablissement.fiches.values_list('pk',
+					flat=True)),
+				exclus={fiche: frozenset(champs)
+					for fiche, champs in exclus.items()},
+				entetes=entetes,
+				photo_size_max=etablissement.photo_size_max,
+				photo_largeur=etablissement.photo_largeur,
+				photo_hauteur=etablissement.photo_hauteur,
+				tolerance_ratio=etablissement.tolerance_ratio)
+
+	@staticmethod
+	def _ctype(fiche):
+		from django.contrib.contenttypes.models import ContentType
+		# ContentType.objects garde lui-même les ContentType en cache
+		return ContentType.objects.get_for_model(fiche).pk
+
+	def utilise(self, type_fiche):
+		"""Indique si l'établissement utilise le type de fiche donné"""
+		return self._ctype(type_fiche) in self.fiches
+
+	def types_fiches(self, types):
+		"""
+		Liste des types de fiches utilisés par l'établissement parmi
+		ceux donnés, dans le même ordre
+		"""
+		return [type_fiche for type_fiche in types if self.utilise(type_fiche)]
+
+	def champs_exclus(self, fiche):
+		"""Ensemble des champs exclus d'une fiche (ou d'un type de fiche)"""
+		return self.exclus.get(self._ctype(fiche), frozenset())
+
+	def entete(self, fiche, formation):
+		"""
+		Texte (non formaté) de l'entête d'une fiche pour la formation
+		donnée : celui de la formation s'il existe, sinon celui de
+		l'établissement, sinon None.
+		"""
+		ctype = self._ctype(fiche)
+		entete = self.entetes.get((ctype, getattr(formation, 'pk', None)))
+		if entete is None:
+			entete = self.entetes.get((ctype, None))
+		return entete
+
+class Configurations:
+	"""
+	Instantanés de la configuration des établissements, chargés à la
+	demande.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._version = None
+		self._prochaine_verification = 0
+		self._configurations = {}
+		# Indique, pour chaque thread, que la transaction en cours a
+		# modifié la configuration
+		self._local = threading.local()
+
+	def invalider(self):
+		"""
+		Signale à tous les processus que la configuration d'un
+		établissement a changé. Le numéro de version est incrémenté dans
+		la transaction en cours ; les instantanés du processus sont
+		oubliés à la fin de celle-ci, pour ne pas être reconstruits à
+		partir de données pas encore enregistrées.
+		"""
+		from inscrire.models import VersionDonnees
+		VersionDonnees.objects.incrementer(NOM_VERSION)
+		if connection.in_atomic_block:
+			self._local.modifiee = True
+		transaction.on_commit(self._vider)
+
+	def _modifiee(self):
+		"""
+		Indique si la transaction en cours a modifié la configuration.
+		Après l'annulation d'une transaction, l'indicateur n'est remis à
+		zéro qu'en dehors de tout bloc atomique : d'ici là, les
+		instantanés sont simplement lus dans la base.
+		"""
+		if not connection.in_atomic_block:
+			self._local.modifiee = False
+		return getattr(self._local, 'modifiee', False)
+
+	def _vider(self):
+		self._local.modifiee = False
+		with self._lock:
+			self._configurations = {}
+			self._prochaine_verification = 0
+
+	def _cle(self, version, uai):
+		return 'inscrire:configuration:{}:{}'.format(version, uai)
+
+	def get(self, uai):
+		"""
+		Renvoie la configuration de l'établissement de numéro UAI donné
+		"""
+		from inscrire.models import VersionDonnees
+		if self._modifiee():
+			# Ni le numéro de version, ni l'instantané ne doivent être
+			# publiés avant la validation de la transaction
+			return EtablissementConfig.charger(uai)
+
+		maintenant = time.monotonic()
+		with self._lock:
+			if maintenant >= self._prochaine_verification:
+				version = VersionDonnees.objects.numero(NOM_VERSION)
+				if version != self._version:
+					self._configurations = {}
+					self._version = version
+				self._prochaine_verification = maintenant + DELAI_VERIFICATION
+			version = self._version
+			configuration, expiration = self._configurations.get(uai,
+					(None, 0))
+		if configuration is not None and maintenant < expiration:
+			return configuration
+
+		# Instantané déjà construit par un autre processus, ou à
+		# construire. Un instantané expiré est relu dans la base.
+		cle = self._cle(version, uai)
+		expire = configuration is not None
+		configuration = None if expire else cache.get(cle)
+		if configuration is None:
+			configuration = EtablissementConfig.charger(uai)
+			cache.set(cle, configuration, DUREE_CACHE)
+		with self._lock:
+			if self._version == version:
+				self._configurations[uai] = (configuration,
+						maintenant + DUREE_LOCALE)
+		return configuration
+
+configurations = Configurations()
+
+def invalider_configuration(sender, **kwargs):
+	"""
+	Récepteur des signaux post_save, post_delete et m2m_changed des
+	modèles décrivant la configuration des établissements. Les
+	enregistrements faits par loaddata (raw) sont ignorés : la commande
+	invalide la configuration une fois le chargement terminé.
+	"""
+	action = kwargs.get('action')
+	if kwargs.get('raw') or (action is not None
+			and not action.startswith('post_')):
+		return
+	configurations.invalider()
@@ -0,0 +1,259 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Exports des données des candidats admis
+
+Les lignes sont produites au fil de l'eau : les candidats sont lus par
+paquets, et les données associées à chaque paquet sont chargées en un
+nombre constant de requêtes. Le même code sert à l'export CSV d'une
+formation (téléchargé directement) et aux exports d'établissement
+produits en arrière-plan (voir inscrire.models.TacheExport).
+"""
+
+from django.core.files.storage import default_storage
+from django.db.models import F, Prefetch
+
+from inscrire.models import Candidat, ResponsableLegal, Voeu, MefOption, \
+		Classement, Fiche, FicheIdentite, FicheScolarite, FicheBourse, \
+		BulletinScolaire, DossierEtat
+
+class Echo:
+	"""
+	Pseudo-fichier qui renvoie directement ce qu'on y écrit, pour
+	produire un CSV ligne par ligne avec csv.writer.
+	"""
+	def write(self, value):
+		return value
+
+def paquets(queryset, taille):
+	"""Découpe l'itération sur un queryset en paquets"""
+	paquet = []
+	for objet in queryset.iterator(chunk_size=taille):
+		paquet.append(objet)
+		if len(paquet) >= taille:
+			yield paquet
+			paquet = []
+	if paquet:
+		yield paquet
+
+class ExportAdmis:
+	"""
+	Export des candidats admis dans une ou plusieurs formations.
+
+	url_absolue est une fonction qui transforme une URL relative (celle
+	d'une photo) en adresse absolue. Avec colonne_formation, la première
+	colonne indique la formation de chaque candidat.
+	"""
+	taille_paquet = 500
+
+	ETATS_DOSSIER = {
+		DossierEtat.ETAT_EDITION: "Edition",
+		DossierEtat.ETAT_COMPLET: "Complet",
+		DossierEtat.ETAT_TERMINE: "Termine",
+		DossierEtat.ETAT_DEMISSION: "Démission",
+	}
+
+	def __init__(self, formations, url_absolue, colonne_formation=False):
+		self.formations = {formation.pk: formation for formation in formations}
+		self.url_absolue = url_absolue
+		self.colonne_formation = colonne_formation
+		self.rangs_obligatoires = sorted(set(MefOption.objects.filter(
+			formation__in=self.formations,
+			modalite=MefOption.MODALITE_OBLIGATOIRE,
+			inscriptions=True).values_list('rang', flat=True)))
+
+	def candidats(self):
+		return Candidat.objects.filter(
+				dossieretat__formation__in=self.formations)
+
+	def nombre(self):
+		"""Nombre de lignes de données de l'export"""
+		return DossierEtat.objects.filter(
+				formation__in=self.formations).count()
+
+	def entete(self):
+		entete = ['Formation'] if self.colonne_formation else []
+		entete += [
+				'Parcoursup',
+				'Classement',
+				'Nom',
+				'Prénom',
+				'INE',
+				'Etat',
+				'Dernière connexion',
+				'Photo',
+				'Internat',
+				'Genre',
+				'Email',
+				'Téléphone',
+				'Mobile',
+				'Adresse',
+				'Série Bac',
+				'Mention Bac'
+			]
+		for r in self.rangs_obligatoires:
+			entete.append("Option obligatoire (rang {})".format(r))
+		for r in range(1, 7):
+			entete.append("Option facultative {}".format(r))
+		return entete
+
+	def lignes(self):
+		"""Générateur des lignes de données"""
+		candidats = self.candidats().annotate(
+				etat_dossier=F('dossieretat__etat'),
+				formation_export=F('dossieretat__formation')
+				).select_related('user').order_by('dossieretat__formation__nom',
+					'formation_export', 'last_name', 'first_name', 'pk')
+		# Classements envoyés à Parcoursup, pour les vœux qui ne l'ont pas
+		# encore mémorisé (voir Voeu.classement)
+		classements = {(formation, psup): classement
+				for formation, psup, classement in Classement.objects.filter(
+					formation__in=self.formations).values_list('formation',
+						'dossier_parcoursup', 'classement')}
+		options = Prefetch('options', queryset=MefOption.objects.filter(
+			formation__in=self.formations).select_related('matiere'))
+
+		for paquet in paquets(candidats, self.taille_paquet):
+			pks = [candidat.pk for candidat in paquet]
+			voeux = {(voeu.candidat_id, voeu.formation_id): voeu for voeu in
+					Voeu.objects.filter(formation__in=self.formations,
+						candidat__in=pks)}
+			photos = {}
+			for candidat_id, photo in FicheIdentite.objects.filter(
+					candidat__in=pks, etat__in=(Fiche.ETAT_EDITION,
+						Fiche.ETAT_CONFIRMEE, Fiche.ETAT_TERMINEE)
+					).order_by('pk').values_list('candidat_id', 'photo'):
+				photos.setdefault(candidat_id, photo)
+			fiches_scolarite = {}
+			for fiche in FicheScolarite.objects.filter(candidat__in=pks,
+					formation__in=self.formations
+					).exclude(etat=Fiche.ETAT_ANNULEE
+					).order_by('pk').prefetch_related(options):
+				fiches_scolarite.setdefault((fiche.candidat_id,
+					fiche.formation_id), fiche)
+
+			for candidat in paquet:
+				cle = (candidat.pk, candidat.formation_export)
+				voeu = voeux[cle]
+				classement = voeu._classement
+				if classement is None:
+					classement = classements.get(
+							(candidat.formation_export, candidat.pk))
+				photo = photos.get(candidat.pk)
+				ligne = [self.formations[candidat.formation_export]] \
+						if self.colonne_formation else []
+				ligne += [
+						candidat.dossier_parcoursup,
+						classement,
+						candidat.last_name, candidat.first_name,
+						candidat.ine, self.ETATS_DOSSIER[candidat.etat_dossier],
+						candidat.user.last_login.strftime("%Y-%m-%d") if candidat.user.last_login else "",
+						self.url_absolue(default_storage.url(photo)) if photo else "",
+						voeu.internat,
+						candidat.genre_court(),
+						candidat.user.email,
+						candidat.telephone,
+						candidat.telephone_mobile,
+						candidat.adresse,
+						candidat.bac_serie,
+						candidat.bac_mention_court()
+					]
+				fichescolarite = fiches_scolarite.get(cle)
+				if fichescolarite is not None:
+					choisies = list(fichescolarite.options.all())
+					for r in self.rangs_obligatoires:
+						mefoption = next((option for option in choisies
+							if option.rang == r), None)
+						ligne.append(mefoption.__str__() if mefoption else "")
+					for mefoption in choisies:
+						if mefoption.modalite == MefOption.MODALITE_FACULTATIVE:
+							ligne.append(mefoption.__str__())
+				yield ligne
+
+	def entete_responsables(self):
+		return [
+				'Parcoursup',
+				'Nom candidat',
+				'Prénom candidat',
+				'Lien',
+				'Genre',
+				'Nom',
+				'Prénom',
+				'Email',
+				'Téléphone',
+				'Mobile',
+				'Adresse',
+				'Profession',
+			]
+
+	def lignes_responsables(self):
+		"""Générateur des lignes de données des responsables légaux"""
+		responsables = ResponsableLegal.objects.filter(
+				candidat__dossieretat__formation__in=self.formations
+				).select_related('candidat', 'profession'
+				).order_by('candidat__last_name', 'candidat__first_name',
+					'candidat', 'pk')
+		for responsable in responsables.iterator(chunk_size=self.taille_paquet):
+			lien = responsable.get_lien_display() or ""
+			if responsable.lien == ResponsableLegal.LIEN_AUTRE and \
+					responsable.lien_precision:
+				lien = "{} ({})".format(lien, responsable.lien_precision)
+			yield [
+					responsable.candidat.dossier_parcoursup,
+					responsable.candidat.last_name,
+					responsable.candidat.first_name,
+					lien,
+					responsable.genre_court(),
+					responsable.last_name,
+					responsable.first_name,
+					responsable.email or "",
+					responsable.telephone,
+					responsable.telephone_mobile,
+					responsable.adresse,
+					responsable.profession,
+				]
+
+	def fichiers(self):
+		"""
+		Générateur des noms (dans le stockage des fichiers téléversés) des
+		documents déposés par les candidats : photos, pièces d'identité,
+		bulletins et attestations de bourse.
+		"""
+		candidats = self.candidats()
+		requetes = (
+			FicheIdentite.objects.filter(candidat__in=candidats
+				).exclude(etat=Fiche.ETAT_ANNULEE
+				).values_list('photo', 'piece_identite'),
+			BulletinScolaire.objects.filter(
+				fiche_scolarite__candidat__in=candidats
+				).exclude(fiche_scolarite__etat=Fiche.ETAT_ANNULEE
+				).values_list('bulletin'),
+			FicheBourse.objects.filter(candidat__in=candidats
+				).exclude(etat=Fiche.ETAT_ANNULEE
+				).values_list('attribution_bourse'),
+		)
+		for requete in requetes:
+			for noms in requete.order_by('pk').iterator(
+					chunk_size=self.taille_paquet):
+				for nom in noms:
+					if nom:
+						yield nom
+
+	def nombre_fichiers(self):
+		return sum(1 for _ in self.fichiers())
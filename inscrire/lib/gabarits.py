@@ -0,0 +1,86 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Gabarits des e-mails envoyés aux candidats
+
+Un e-mail nommé nom est formé de trois gabarits : nom_subject.txt,
+nom_message.txt et nom_message.html. Chacun peut être remplacé pour un
+établissement (répertoire inscrire/<UAI>/) ou pour une formation
+(inscrire/<UAI>/<slug>/).
+
+Les gabarits sont recherchés et compilés une seule fois par e-mail,
+établissement et formation, puis conservés en mémoire (sauf en mode
+DEBUG, pour que les modifications soient prises en compte
+immédiatement).
+"""
+
+import functools
+
+from django.conf import settings
+from django.template.loader import select_template
+
+PARTIES = ('subject.txt', 'message.txt', 'message.html')
+
+def noms_gabarit(nom, partie, uai=None, slug=None):
+	"""Noms des gabarits candidats, du plus spécifique au plus général"""
+	noms = []
+	if uai is not None:
+		if slug is not None:
+			noms.append('inscrire/{}/{}/{}_{}'.format(uai, slug, nom, partie))
+		noms.append('inscrire/{}/{}_{}'.format(uai, nom, partie))
+	noms.append('inscrire/{}_{}'.format(nom, partie))
+	return noms
+
+def _charger_gabarits(nom, uai, slug):
+	return tuple(select_template(noms_gabarit(nom, partie, uai, slug))
+			for partie in PARTIES)
+
+_gabarits_en_cache = functools.lru_cache(maxsize=256)(_charger_gabarits)
+
+def vider_cache():
+	_gabarits_en_cache.cache_clear()
+
+def gabarits_courriel(nom, formation=None, etablissement=None):
+	"""
+	Renvoie les gabarits compilés (sujet, texte, HTML) de l'e-mail nom
+	pour la formation ou l'établissement donné.
+	"""
+	if formation is not None:
+		uai, slug = formation.etablissement_id, formation.slug
+	else:
+		uai, slug = getattr(etablissement, 'pk', None), None
+	charger = _charger_gabarits if settings.DEBUG else _gabarits_en_cache
+	return charger(nom, uai, slug)
+
+def rendre_courriel(nom, contexte, formation=None, etablissement=None):
+	"""
+	Renvoie le sujet, le texte et la version HTML de l'e-mail nom,
+	rendus avec le contexte donné.
+	"""
+	return tuple(gabarit.render(contexte).strip() for gabarit in
+			gabarits_courriel(nom, formation, etablissement))
+
+def rendre_courriels(nom, contextes, formation=None, etablissement=None):
+	"""
+	Générateur des e-mails (sujet, texte, HTML) rendus pour chacun des
+	contextes donnés, avec les mêmes gabarits.
+	"""
+	gabarits = gabarits_courriel(nom, formation, etablissement)
+	for contexte in contextes:
+		yield tuple(gabarit.render(contexte).strip() for gabarit in gabarits)
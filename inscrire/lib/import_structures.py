@@ -0,0 +1,213 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Import des formations et des options depuis les fichiers SIECLE
+Structures et Nomenclature
+
+Le contenu des fichiers est comparé en mémoire à celui de la base, puis
+les créations, modifications et suppressions sont appliquées par lots
+dans une seule transaction : soit tout l'import réussit, soit la base
+n'est pas modifiée.
+"""
+
+from django.db import transaction, IntegrityError
+from django.utils.text import slugify
+
+from inscrire.models import Formation, MefMatiere, MefOption, FicheScolarite
+
+class ImportStructures:
+	"""
+	Synchronisation des formations de l'établissement (MEF du supérieur
+	ayant au moins une division dans le fichier Structures), des matières
+	et des options de ces formations.
+
+	Les options qui ne figurent plus dans la nomenclature sont
+	supprimées, sauf si des candidats les ont déjà choisies. Le réglage
+	des options (inscriptions, détail) est conservé pour les options
+	existantes.
+	"""
+	# Nombre de suffixes essayés pour rendre unique le slug d'une formation
+	RANGS_SLUG = 10
+
+	CHAMPS_MATIERE = ('libelle_court', 'libelle_long', 'libelle_edition')
+
+	def __init__(self, etablissement, structures, nomenclature):
+		self.etablissement = etablissement
+		self.structures = structures
+		self.nomenclature = nomenclature
+		self.formations_creees = 0
+		self.formations_modifiees = 0
+		self.matieres_creees = 0
+		self.matieres_modifiees = 0
+		self.options_creees = 0
+		self.options_supprimees = 0
+		self.options_conservees = 0
+
+	def __str__(self):
+		return "{} formation(s) créée(s), {} modifiée(s) ; " \
+				"{} matière(s) créée(s), {} modifiée(s) ; " \
+				"{} option(s) créée(s), {} supprimée(s), " \
+				"{} conservée(s) car choisie(s) par des candidats".format(
+					self.formations_creees, self.formations_modifiees,
+					self.matieres_creees, self.matieres_modifiees,
+					self.options_creees, self.options_supprimees,
+					self.options_conservees)
+
+	def executer(self):
+		mefs = self.nomenclature.mefs()
+		# On ignore ce qui n'est pas une classe du supérieur
+		mefs = {code_mef: mefs[code_mef]
+				for code_mef in sorted(self.structures.mefs())
+				if code_mef[0] == '3' and code_mef in mefs}
+
+		with transaction.atomic():
+			# On active automatiquement les inscriptions pour
+			# l'établissement, puisque l'on dispose désormais de
+			# formations connues.
+			self.etablissement.inscriptions = True
+			self.etablissement.save()
+
+			formations = self.importer_formations(mefs)
+			self.importer_matieres(mefs)
+			self.importer_options(mefs, formations)
+		return self
+
+	def slug(self, mef, formation, slugs):
+		"""
+		Renvoie un slug libre pour la formation, qui vaut None si elle
+		reste à créer. slugs associe aux slugs déjà attribués la clé
+		primaire de leur formation.
+		"""
+		base = slugify(mef.formation)
+		for rang in range(self.RANGS_SLUG + 1):
+			slug = "{}-{}".format(base, rang) if rang else base
+			proprietaire = slugs.get(slug)
+			if proprietaire is None or (formation is not None and
+					proprietaire == formation.pk):
+				return slug
+		raise IntegrityError("Aucun slug disponible pour la formation "
+				"{}".format(mef.code))
+
+	def importer_formations(self, mefs):
+		"""
+		Crée ou met à jour les formations des MEF donnés, et renvoie le
+		dictionnaire des formations indexées par code MEF
+		"""
+		existantes = {formation.code_mef: formation for formation in
+				Formation.objects.filter(etablissement=self.etablissement,
+					code_mef__in=mefs)}
+		slugs = dict(Formation.objects.values_list('slug', 'pk'))
+		nouvelles = []
+		modifiees = []
+		for code_mef, mef in mefs.items():
+			formation = existantes.get(code_mef)
+			slug = self.slug(mef, formation, slugs)
+			if formation is None:
+				nouvelles.append(Formation(code_mef=code_mef,
+					etablissement=self.etablissement,
+					nom=mef.libelle_long, slug=slug))
+				# Réservé pour les formations suivantes
+				slugs[slug] = 0
+			elif formation.nom != mef.libelle_long or formation.slug != slug:
+				slugs.pop(formation.slug, None)
+				slugs[slug] = formation.pk
+				formation.nom = mef.libelle_long
+				formation.slug = slug
+				modifiees.append(formation)
+		Formation.objects.bulk_create(nouvelles)
+		Formation.objects.bulk_update(modifiees, ['nom', 'slug'])
+		self.formations_creees = len(nouvelles)
+		self.formations_modifiees = len(modifiees)
+		# bulk_create ne renvoie pas les clés primaires sur tous les SGBD
+		return {formation.code_mef: formation for formation in
+				Formation.objects.filter(etablissement=self.etablissement,
+					code_mef__in=mefs)}
+
+	def importer_matieres(self, mefs):
+		"""
+		Crée les matières des options des MEF donnés, et met à jour les
+		libellés des matières existantes
+		"""
+		matieres = {}
+		for mef in mefs.values():
+			for option in mef.options_obligatoires:
+				matieres[option.matiere.code] = option.matiere
+			for option in mef.programme:
+				if option.modalite_election == 'F':
+					matieres[option.matiere.code] = option.matiere
+		existantes = MefMatiere.objects.in_bulk(list(matieres))
+		nouvelles = []
+		modifiees = []
+		for code, matiere in matieres.items():
+			libelles = {champ: getattr(matiere, champ)
+					for champ in self.CHAMPS_MATIERE}
+			matiere_db = existantes.get(code)
+			if matiere_db is None:
+				nouvelles.append(MefMatiere(code=code, **libelles))
+			elif any(getattr(matiere_db, champ) != valeur
+					for champ, valeur in libelles.items()):
+				for champ, valeur in libelles.items():
+					setattr(matiere_db, champ, valeur)
+				modifiees.append(matiere_db)
+		MefMatiere.objects.bulk_create(nouvelles)
+		MefMatiere.objects.bulk_update(modifiees, self.CHAMPS_MATIERE)
+		self.matieres_creees = len(nouvelles)
+		self.matieres_modifiees = len(modifiees)
+
+	def importer_options(self, mefs, formations):
+		"""
+		Crée les options des MEF données absentes de la base, et supprime
+		celles qui ne figurent plus dans la nomenclature
+		"""
+		attendues = set()
+		for code_mef, mef in mefs.items():
+			formation = formations[code_mef]
+			for option in mef.options_obligatoires:
+				attendues.add((formation.pk, MefOption.MODALITE_OBLIGATOIRE,
+					option.rang, option.matiere.code))
+			for option in mef.programme:
+				if option.modalite_election == 'F':
+					attendues.add((formation.pk,
+						MefOption.MODALITE_FACULTATIVE, 0,
+						option.matiere.code))
+
+		# Une même option peut avoir été déclinée en plusieurs options
+		# (voir MefOption.detail) : elles sont toutes conservées
+		manquantes = set(attendues)
+		obsoletes = []
+		for option in MefOption.objects.filter(
+				formation__in=formations.values()):
+			cle = (option.formation_id, option.modalite, option.rang,
+					option.matiere_id)
+			if cle in attendues:
+				manquantes.discard(cle)
+			else:
+				obsoletes.append(option.pk)
+
+		MefOption.objects.bulk_create(MefOption(formation_id=formation,
+			modalite=modalite, rang=rang, matiere_id=matiere)
+			for formation, modalite, rang, matiere in sorted(manquantes))
+		self.options_creees = len(manquantes)
+
+		choisies = set(FicheScolarite.options.through.objects.filter(
+			mefoption__in=obsoletes).values_list('mefoption_id', flat=True))
+		MefOption.objects.filter(pk__in=obsoletes).exclude(
+				pk__in=choisies).delete()
+		self.options_supprimees = len(obsoletes) - len(choisies)
+		self.options_conservees = len(choisies)
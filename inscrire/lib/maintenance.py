@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Mode maintenance du site
+
+L'état est décrit par trois fichiers du répertoire scripsup :
+- en_travaux.txt : message affiché à la place du site. Le site est
+  fermé si ce fichier n'est pas vide, ou s'il n'existe pas (le site est
+  alors en cours de configuration) ;
+- maintenance_mode_ip.txt : adresses IP (ou réseaux, en notation CIDR)
+  qui ont accès au site pendant la maintenance, une par ligne ;
+- avertissement_maintenance.txt : avertissement affiché en haut des
+  pages, par exemple pour annoncer une maintenance.
+
+Ces fichiers sont lus une fois et conservés en mémoire. Chaque
+processus vérifie au plus toutes les MAINTENANCE_DELAI_VERIFICATION
+secondes, par un simple appel à stat, s'ils ont été modifiés. La
+commande maintenance permet de les modifier.
+"""
+
+import ipaddress
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+FICHIER_EN_TRAVAUX = 'en_travaux.txt'
+FICHIER_IP = 'maintenance_mode_ip.txt'
+FICHIER_AVERTISSEMENT = 'avertissement_maintenance.txt'
+
+# Message affiché quand le fichier en_travaux.txt n'existe pas
+MESSAGE_CONFIGURATION = "Site en cours de configuration"
+
+def chemin(nom):
+	"""Chemin complet de l'un des fichiers du mode maintenance"""
+	return os.path.join(settings.BASE_DIR, 'scripsup', nom)
+
+def lire(nom):
+	"""
+	Renvoie le contenu du fichier donné, ou None s'il n'existe pas
+	"""
+	try:
+		with open(chemin(nom), encoding='utf-8', newline='') as f:
+			return f.read()
+	except FileNotFoundError:
+		return None
+
+def ecrire(nom, contenu):
+	"""
+	Remplace le contenu du fichier donné. Le fichier est remplacé d'un
+	seul coup, pour qu'aucun processus ne le lise à moitié écrit.
+	"""
+	provisoire = chemin(nom) + '.tmp'
+	with open(provisoire, 'w', encoding='utf-8', newline='') as f:
+		f.write(contenu)
+	os.replace(provisoire, chemin(nom))
+
+def reseau(texte):
+	"""
+	Renvoie le réseau (éventuellement réduit à une adresse) décrit par
+	texte, ou lève ValueError
+	"""
+	return ipaddress.ip_network(texte.strip(), strict=False)
+
+class AdressesAutorisees:
+	"""
+	Ensemble d'adresses IP et de réseaux, construit à partir des lignes
+	du fichier maintenance_mode_ip.txt. Les lignes vides et les
+	commentaires (commençant par #) sont ignorés.
+	"""
+	def __init__(self, lignes):
+		self.adresses = set()
+		self.reseaux = []
+		for ligne in lignes:
+			ligne = ligne.split('#', 1)[0].strip()
+			if not ligne:
+				continue
+			try:
+				autorise = reseau(ligne)
+			except ValueError:
+				logger.warning("Adresse invalide dans %s : %s", FICHIER_IP,
+						ligne)
+				continue
+			if autorise.num_addresses == 1:
+				self.adresses.add(str(autorise.network_address))
+			else:
+				self.reseaux.append(autorise)
+		self.adresses = frozenset(self.adresses)
+
+	def __contains__(self, adresse):
+		if not adresse:
+			return False
+		if adresse in self.adresses:
+			return True
+		if not self.reseaux:
+			return False
+		try:
+			adresse = ipaddress.ip_address(adresse)
+		except ValueError:
+			return False
+		# Forme canonique, par exemple pour une adresse IPv6 abrégée
+		# différemment dans le fichier
+		if str(adresse) in self.adresses:
+			return True
+		return any(adresse in reseau for reseau in self.reseaux)
+
+class Maintenance:
+	"""
+	État du mode maintenance, partagé par tous les fils d'exécution
+	d'un processus.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._signature = None
+		self._prochaine_verification = 0
+		self.message = ""
+		self.adresses = AdressesAutorisees(())
+		self.avertissement = ""
+
+	@staticmethod
+	def _signature_fichiers():
+		"""
+		Date de modification et taille des fichiers, ou None pour un
+		fichier absent
+		"""
+		signature = []
+		for nom in (FICHIER_EN_TRAVAUX, FICHIER_IP, FICHIER_AVERTISSEMENT):
+			try:
+				etat = os.stat(chemin(nom))
+				signature.append((etat.st_mtime_ns, etat.st_size))
+			except FileNotFoundError:
+				signature.append(None)
+		return tuple(signature)
+
+	def _charger(self):
+		en_travaux = lire(FICHIER_EN_TRAVAUX)
+		self.message = MESSAGE_CONFIGURATION if en_travaux is None \
+				else en_travaux.strip()
+		self.adresses = AdressesAutorisees(
+				(lire(FICHIER_IP) or "").splitlines())
+		self.avertissement = (lire(FICHIER_AVERTISSEMENT) or "").strip()
+
+	def _etat(self):
+		"""
+		Relit les fichiers s'ils ont changé, en vérifiant au plus toutes
+		les MAINTENANCE_DELAI_VERIFICATION secondes.
+		"""
+		maintenant = time.monotonic()
+		if maintenant < self._prochaine_verification:
+			return self
+		with self._lock:
+			if maintenant < self._prochaine_verification:
+				return self
+			signature = self._signature_fichiers()
+			if signature != self._signature:
+				self._charger()
+				self._signature = signature
+			self._prochaine_verification = maintenant + getattr(settings,
+					'MAINTENANCE_DELAI_VERIFICATION', 2)
+		return self
+
+	def recharger(self):
+		"""Force la relecture des fichiers à la prochaine consultation"""
+		with self._lock:
+			self._prochaine_verification = 0
+			self._signature = None
+
+	def message_travaux(self, adresse):
+		"""
+		Renvoie le message à afficher à la place du site pour un
+		visiteur d'adresse IP donnée, ou une chaîne vide s'il a accès au
+		site.
+		"""
+		etat = self._etat()
+		if etat.message and adresse not in etat.adresses:
+			return etat.message
+		return ""
+
+	def avertissement_maintenance(self):
+		"""Avertissement à afficher en haut des pages"""
+		return self._etat().avertissement
+
+maintenance = Maintenance()
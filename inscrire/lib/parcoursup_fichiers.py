@@ -23,103 +23,176 @@ Utilitaires pour lire les exports d'admis de Parcoursup
 import csv
 from datetime import datetime
 
-from inscrire.models import Pays, Commune
+from .referentiel import referentiel
 from .parcoursup_rest import ParcoursupCandidat, ParcoursupProposition
 from .utils import parse_french_date
 
-def parse_export_standard(export_fh, code_etablissement, code_formation):
+class ExportInvalide(Exception):
 	"""
-	Prend en paramètre un export Parcousup, soit standard soit
-	paramétrable, et renvoie la liste des admissions contenues dans ce
-	fichier.
+	Exception levée quand un fichier ne ressemble pas à un export de
+	Parcoursup (colonnes indispensables absentes).
+	"""
+	pass
+
+class ExportStandard:
+	"""
+	Export des admis de Parcoursup, soit standard soit paramétrable,
+	lu ligne par ligne.
 
-	Chaque entrée de la liste a le même format que ce qui est produit
-	par l'API REST (dictionnaire avec le candidat et les propositions).
-	La liste des responsables légaux est vide, cette information n'est
-	pas donnée dans les fichiers exportés par Parcoursup.
+	Chaque admission a le même format que ce qui est produit par l'API
+	REST (dictionnaire avec le candidat et les propositions). La liste
+	des responsables légaux est vide, cette information n'est pas donnée
+	dans les fichiers exportés par Parcoursup.
 
 	Pour les fichiers paramétrables, il faut faire attention à inclure
-	toutes les colonnes nécessaires.
+	toutes les colonnes nécessaires : la ligne d'entête est vérifiée dès
+	la création de l'objet, qui lève ExportInvalide s'il en manque.
 
 	Ni l'établissement ni la formation ne sont présents dans l'export
 	standard. Ils sont présents dans les exports paramétrables mais sous
 	une forme textuelle non exploitable. Il faut donc les donner ici en
 	paramètres pour remplir les données de la proposition.
 	"""
-	propositions = []
-	for export_ligne in csv.DictReader(export_fh, delimiter=';'):
-		candidat_defaults = {
-				'nom': export_ligne['Nom'],
-				'prenom': export_ligne['Prénom'],
-
-				'email': export_ligne.get('e-mail du candidat',
-					export_ligne.get('Adresse mail')),
-
-				'date_naissance': parse_french_date(
-					export_ligne.get('Date de Naissance',
-					export_ligne.get('Date de naissance'))),
-
-				'code': export_ligne.get('Numéro candidat',
-					export_ligne.get('Numéro')),
-
-				'ine': export_ligne.get('Numéro INE'),
-
-				'telephone_fixe': export_ligne.get('Téléphone fixe',
-					export_ligne.get('Téléphone')),
-
-				'telephone_mobile': export_ligne.get('Téléphone mobile'),
+	# Noms possibles de chaque colonne, selon le type d'export. Le
+	# premier nom présent dans l'entête est retenu.
+	COLONNES = {
+		'nom': ('Nom',),
+		'prenom': ('Prénom',),
+		'email': ('e-mail du candidat', 'Adresse mail'),
+		'date_naissance': ('Date de Naissance', 'Date de naissance'),
+		'code': ('Numéro candidat', 'Numéro'),
+		'ine': ('Numéro INE',),
+		'telephone_fixe': ('Téléphone fixe', 'Téléphone'),
+		'telephone_mobile': ('Téléphone mobile',),
+		'civilite': ('Etat civil', 'Civilité'),
+		'nationalite': ('Nationalité',),
+		'bac_serie': ('Série diplôme',),
+		'bac_mention': ('Mention diplôme',),
+		'pays_naissance': ('Pays de naissance',),
+		'ville_naissance': ('Ville de naissance',),
+		'pays': ('Pays',),
+		'commune': ('Commune',),
+		'adresse1': ('Adresse 1',),
+		'adresse2': ('Adresse 2',),
+		'adresse3': ('Adresse 3',),
+		'code_postal': ('Code postal',),
+		'cesure': ('Année de césure',),
+		'internat': ('Internat',),
+		'internat_obtenu': ('Internat obtenu',),
+		'date_reponse': ('date réponse', 'Date réponse'),
+	}
+	OBLIGATOIRES = ('nom', 'prenom', 'date_naissance', 'commune',
+			'adresse1', 'adresse2', 'code_postal', 'date_reponse')
+
+	def __init__(self, export_fh, code_etablissement, code_formation):
+		self.code_etablissement = code_etablissement
+		self.code_formation = code_formation
+		self.lecteur = csv.reader(export_fh, delimiter=';')
+		entete = next(self.lecteur, [])
+		# En cas de colonnes homonymes, la dernière l'emporte (comme
+		# avec csv.DictReader)
+		indices = {nom: indice for indice, nom in enumerate(entete)}
+		self.colonnes = {}
+		for cle, noms in self.COLONNES.items():
+			self.colonnes[cle] = next((indices[nom] for nom in noms
+				if nom in indices), None)
+		manquantes = [self.COLONNES[cle][0] for cle in self.OBLIGATOIRES
+				if self.colonnes[cle] is None]
+		if manquantes:
+			raise ExportInvalide("Colonne(s) absente(s) du fichier : "
+					"{}".format(", ".join(manquantes)))
+		# Erreurs de lecture, sous forme de couples (numéro de ligne,
+		# message)
+		self.erreurs = []
+
+	def admissions(self):
+		"""
+		Générateur des admissions du fichier. Les lignes illisibles sont
+		ignorées et signalées dans l'attribut erreurs. Le numéro de la
+		ligne du fichier est ajouté à chaque admission (clé ligne).
+		"""
+		while True:
+			try:
+				ligne = next(self.lecteur)
+			except StopIteration:
+				return
+			except (UnicodeDecodeError, csv.Error) as e:
+				self.erreurs.append((self.lecteur.line_num + 1,
+					"lecture interrompue : {}".format(e)))
+				return
+			if not ligne:
+				continue
+			try:
+				admission = self.admission(ligne)
+			except Exception as e:
+				self.erreurs.append((self.lecteur.line_num,
+					str(e) or type(e).__name__))
+				continue
+			admission['ligne'] = self.lecteur.line_num
+			yield admission
+
+	def admission(self, ligne):
+		colonnes = self.colonnes
+		def valeur(cle, defaut=None):
+			indice = colonnes[cle]
+			if indice is None or indice >= len(ligne):
+				return defaut
+			return ligne[indice]
 
+		candidat_defaults = {
+				'nom': valeur('nom'),
+				'prenom': valeur('prenom'),
+				'email': valeur('email'),
+				'date_naissance': parse_french_date(valeur('date_naissance')),
+				'code': valeur('code'),
+				'ine': valeur('ine'),
+				'telephone_fixe': valeur('telephone_fixe'),
+				'telephone_mobile': valeur('telephone_mobile'),
 				'sexe': ParcoursupCandidat.GENRE_HOMME
-					if export_ligne.get('Etat civil',
-						export_ligne.get('Civilité')) == 'M.'
+					if valeur('civilite') == 'M.'
 					else ParcoursupCandidat.GENRE_FEMME,
-
-				'nationalite': 'FR' if export_ligne.get('Nationalité') == 'FR' else None,
+				'nationalite': 'FR' if valeur('nationalite') == 'FR' else None,
 
 				#TODO à implémenter quand on aura les premiers résultats
 				# de bac, pour l'instant j'ignore quel format va
 				# choisir Parcoursup dans son fichier.
 				'bac_date': None,
-				'bac_serie': export_ligne.get('Série diplôme'),
-				'bac_mention': export_ligne.get('Mention diplôme'),
+				'bac_serie': valeur('bac_serie'),
+				'bac_mention': valeur('bac_mention'),
 		}
-		try:
-			candidat_defaults['pays_naissance'] = Pays.objects.get(
-					nom__iexact=export_ligne.get('Pays de naissance')).pk
-		except:
-			pass
-
-		try:
-			candidat_defaults['commune_naissance'] = Commune.objets.get(
-					nom__iexact=export_ligne.get('Ville de naissance')).pk
-		except:
-			pass
+		pays_naissance = referentiel.pays_par_nom(valeur('pays_naissance'))
+		if pays_naissance is not None:
+			candidat_defaults['pays_naissance'] = pays_naissance.pk
+
+		commune_naissance = referentiel.commune_par_nom(
+				valeur('ville_naissance'))
+		if commune_naissance is not None:
+			candidat_defaults['commune_naissance'] = commune_naissance.pk
 
 		candidat_defaults['adresse'] = ParcoursupCandidat.formate_adresse({
-				'libellePaysadresse': export_ligne.get('Pays') or 'France',
-				'libellecommune': export_ligne['Commune'],
-				'adresse1': export_ligne['Adresse 1'],
-				'adresse2': export_ligne['Adresse 2'],
-				'adresse3': export_ligne.get('Adresse 3'),
-				'codepostal': export_ligne['Code postal'],
+				'libellePaysadresse': valeur('pays') or 'France',
+				'libellecommune': valeur('commune'),
+				'adresse1': valeur('adresse1'),
+				'adresse2': valeur('adresse2'),
+				'adresse3': valeur('adresse3'),
+				'codepostal': valeur('code_postal'),
 			})
 
 		candidat = ParcoursupCandidat(**candidat_defaults)
 		proposition = ParcoursupProposition(
-				code_formation=code_formation,
-				code_etablissement=code_etablissement,
-				cesure=export_ligne.get('Année de césure', 'non').lower() == 'oui',
+				code_formation=self.code_formation,
+				code_etablissement=self.code_etablissement,
+				cesure=valeur('cesure', 'non').lower() == 'oui',
 				internat=
-					export_ligne.get('Internat', 'non').lower() == 'oui' or
-					export_ligne.get('Internat obtenu', 'Sans internat').lower() == 'avec internat',
-				date=datetime.strptime(export_ligne.get('date réponse',
-					export_ligne.get('Date réponse')), '%d/%m/%Y %H:%M'),
+					valeur('internat', 'non').lower() == 'oui' or
+					valeur('internat_obtenu', 'Sans internat').lower() == 'avec internat',
+				date=datetime.strptime(valeur('date_reponse'),
+					'%d/%m/%Y %H:%M'),
 				#TODO info présente dans l'export standard, exploitable ?
 				etat=ParcoursupProposition.ETAT_ACCEPTEE,
 		)
-		propositions.append({
+		return {
 			'candidat': candidat,
 			'proposition': proposition,
 			'responsables': [],
-		})
-	return propositions
+		}
@@ -21,8 +21,14 @@ Utilitaires pour communiquer avec l'API REST de Parcoursup
 """
 
 from datetime import date, datetime
+import hashlib
+import json
+import random
 import re
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from dateutil.tz import gettz
 
 from django.utils import timezone
@@ -51,6 +57,214 @@ class ParcoursupError(Exception):
 	"""
 	pass
 
+# Paramètres par défaut des connexions HTTP vers Parcoursup. Ils peuvent
+# être modifiés par le dictionnaire PARCOURSUP_HTTP des réglages Django.
+PARCOURSUP_HTTP_DEFAULTS = {
+	# Délais (en secondes) d'établissement de la connexion et de lecture
+	# de la réponse.
+	'TIMEOUT_CONNEXION': 5,
+	'TIMEOUT_LECTURE': 30,
+	# Nombre d'hôtes distincts gardés en cache par session, et nombre
+	# maximal de connexions ouvertes simultanément vers un même hôte.
+	'POOL_CONNECTIONS': 1,
+	'POOL_MAXSIZE': 10,
+	# Réutilisation des connexions d'une requête à l'autre.
+	'KEEPALIVE': True,
+	# Durée (en secondes) au-delà de laquelle une session inutilisée est
+	# fermée puis recréée, Parcoursup ayant déjà coupé les connexions
+	# restées ouvertes de son côté.
+	'DUREE_INACTIVITE': 300,
+	# Nombre maximal de tentatives pour une même requête lorsque
+	# Parcoursup est saturé (codes HTTP 429 et 5xx) ou injoignable.
+	'TENTATIVES': 4,
+	# Attente (en secondes) avant la première nouvelle tentative. Elle
+	# double ensuite à chaque échec, sans dépasser ATTENTE_MAX.
+	'ATTENTE_INITIALE': 0.5,
+	'ATTENTE_MAX': 30,
+}
+
+def parcoursup_http_settings():
+	"""
+	Renvoie les paramètres des connexions HTTP vers Parcoursup, en
+	complétant les réglages Django par les valeurs par défaut.
+	"""
+	http_settings = dict(PARCOURSUP_HTTP_DEFAULTS)
+	http_settings.update(getattr(settings, 'PARCOURSUP_HTTP', {}))
+	return http_settings
+
+class ParcoursupSessionPool:
+	"""
+	Réserve de sessions HTTP persistantes vers Parcoursup.
+
+	Chaque utilisateur Parcoursup (identifié par une clé quelconque,
+	en pratique le code de l'établissement et l'identifiant de
+	remontée) dispose de sa propre session requests, dont les
+	connexions TCP et TLS sont réutilisées d'un appel à l'autre. Les
+	sessions survivent aux instances de ParcoursupRest, qui sont
+	recréées à chaque requête HTTP reçue par Django.
+	"""
+	def __init__(self):
+		self._sessions = {}
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _nouvelle_session(http_settings):
+		session = requests.Session()
+		adapter = HTTPAdapter(
+				pool_connections=http_settings['POOL_CONNECTIONS'],
+				pool_maxsize=http_settings['POOL_MAXSIZE'],
+				pool_block=True)
+		session.mount('https://', adapter)
+		session.mount('http://', adapter)
+		if not http_settings['KEEPALIVE']:
+			session.headers['Connection'] = 'close'
+		return session
+
+	def get(self, cle):
+		"""
+		Renvoie la session associée à la clé donnée, en la créant si
+		nécessaire ou si elle est restée inutilisée trop longtemps.
+		"""
+		http_settings = parcoursup_http_settings()
+		maintenant = time.monotonic()
+		with self._lock:
+			session, dernier_usage = self._sessions.get(cle, (None, None))
+			if session is not None and \
+					maintenant - dernier_usage > http_settings['DUREE_INACTIVITE']:
+				session.close()
+				session = None
+			if session is None:
+				session = self._nouvelle_session(http_settings)
+			self._sessions[cle] = (session, maintenant)
+			return session
+
+	def fermer(self, cle=None):
+		"""
+		Ferme la session associée à la clé donnée, ou toutes les
+		sessions si aucune clé n'est précisée.
+		"""
+		with self._lock:
+			cles = list(self._sessions) if cle is None else [cle]
+			for c in cles:
+				session, _ = self._sessions.pop(c, (None, None))
+				if session is not None:
+					session.close()
+
+sessions_parcoursup = ParcoursupSessionPool()
+
+# Débit minimal (en requêtes par seconde) : un débit nul bloquerait
+# toutes les requêtes vers Parcoursup.
+DEBIT_MIN = 0.01
+
+class LimiteurDebit:
+	"""
+	Limiteur de débit à seau de jetons, partagé par tous les fils
+	d'exécution qui s'adressent à Parcoursup avec les mêmes
+	identifiants.
+
+	Le seau contient au plus rafale jetons et se remplit à raison de
+	debit jetons par seconde. Chaque requête consomme un jeton.
+
+	Le débit est adaptatif : il est divisé par deux à chaque fois que
+	Parcoursup signale une saturation, puis remonte progressivement
+	vers le débit nominal au fil des requêtes réussies.
+	"""
+	def __init__(self, debit, rafale):
+		self._lock = threading.Lock()
+		self.configure(debit, rafale)
+		self._jetons = float(self.rafale)
+		self._dernier_remplissage = time.monotonic()
+		self._pause_jusqua = 0.
+
+	def configure(self, debit, rafale):
+		"""
+		Modifie le débit nominal (en requêtes par seconde) et la taille
+		maximale des rafales. Un débit inférieur à DEBIT_MIN est ramené à
+		DEBIT_MIN.
+		"""
+		with self._lock:
+			self.debit = max(DEBIT_MIN, float(debit))
+			self.rafale = max(1, int(rafale))
+			self.debit_courant = self.debit
+
+	def _remplir(self, maintenant):
+		self._jetons = min(self.rafale, self._jetons +
+				(maintenant - self._dernier_remplissage) * self.debit_courant)
+		self._dernier_remplissage = maintenant
+
+	def acquerir(self):
+		"""
+		Attend qu'un jeton soit disponible et le consomme.
+		"""
+		while True:
+			with self._lock:
+				maintenant = time.monotonic()
+				if maintenant < self._pause_jusqua:
+					attente = self._pause_jusqua - maintenant
+				else:
+					self._remplir(maintenant)
+					if self._jetons >= 1:
+						self._jetons -= 1
+						return
+					attente = (1 - self._jetons) / self.debit_courant
+			time.sleep(attente)
+
+	def signaler_saturation(self, pause=0):
+		"""
+		Parcoursup a refusé une requête pour cause de saturation : on
+		réduit le débit et on suspend les envois pendant pause secondes
+		pour tous les fils d'exécution.
+		"""
+		with self._lock:
+			self.debit_courant = max(self.debit / 8, self.debit_courant / 2)
+			self._jetons = min(self._jetons, 0.)
+			self._pause_jusqua = max(self._pause_jusqua,
+					time.monotonic() + pause)
+
+	def signaler_succes(self):
+		"""
+		Une requête a abouti : le débit remonte vers le débit nominal.
+		"""
+		with self._lock:
+			self.debit_courant = min(self.debit,
+					self.debit_courant + self.debit / 10)
+
+class ReserveLimiteurs:
+	"""
+	Ensemble des limiteurs de débit, indexés par la même clé que les
+	sessions HTTP.
+	"""
+	def __init__(self):
+		self._limiteurs = {}
+		self._lock = threading.Lock()
+
+	def get(self, cle, debit, rafale):
+		with self._lock:
+			limiteur = self._limiteurs.get(cle)
+			if limiteur is None:
+				limiteur = LimiteurDebit(debit, rafale)
+				self._limiteurs[cle] = limiteur
+			elif limiteur.debit != max(DEBIT_MIN, float(debit)) \
+					or limiteur.rafale != max(1, int(rafale)):
+				limiteur.configure(debit, rafale)
+			return limiteur
+
+limiteurs_parcoursup = ReserveLimiteurs()
+
+def attente_avant_tentative(tentative, http_settings, retry_after=None):
+	"""
+	Durée d'attente avant une nouvelle tentative : attente
+	exponentielle avec gigue complète, ou la durée demandée par
+	Parcoursup dans l'en-tête Retry-After.
+	"""
+	if retry_after is not None:
+		try:
+			return min(float(retry_after), http_settings['ATTENTE_MAX'])
+		except ValueError:
+			pass
+	return random.uniform(0, min(http_settings['ATTENTE_MAX'],
+		http_settings['ATTENTE_INITIALE'] * 2 ** tentative))
+
 class ParcoursupRequest:
 	"""
 	Légère couche d'abstraction au-dessus du module requests pour gérer
@@ -58,15 +272,18 @@ class ParcoursupRequest:
 	d'identification.
 	"""
 	def __init__(self, login, password, method_name=None,
-			http_method='POST', data={}, endpoint=PARCOURSUP_ENDPOINT):
+			http_method='POST', data=None, endpoint=PARCOURSUP_ENDPOINT,
+			session=None, limiteur=None):
 		self.login = login
 		self.password = password
 		self.response = None
 		self.method_name = method_name
 		self.http_method = http_method
 		self.endpoint = endpoint
+		self.session = session
+		self.limiteur = limiteur
 
-		self.data = data
+		self.data = dict(data or {})
 		self.data.update({
 			'identifiant': {
 				'login': login,
@@ -81,9 +298,20 @@ class ParcoursupRequest:
 		return '{base}{method}'.format(
 			base=self.endpoint, method=self.method_name)
 
+	def _post(self, timeout):
+		if self.session is not None:
+			return self.session.post(self.get_url(), json=self.data,
+					timeout=timeout)
+		return requests.post(self.get_url(), json=self.data,
+				timeout=timeout)
+
 	def send(self):
 		"""
 		Envoi de la requête à Parcoursup.
+
+		La requête respecte le débit imposé par le limiteur, s'il
+		existe. Elle est retentée, après une attente croissante, lorsque
+		Parcoursup est saturé (codes HTTP 429 et 5xx) ou injoignable.
 		"""
 		# Oui, ça a l'air idiot, mais c'est pour plus tard si jamais
 		# Parcoursup nous introduit d'autres méthodes HTTP dans des
@@ -92,7 +320,37 @@ class ParcoursupRequest:
 			raise ValueError("Cette API ne gère pas d'autres méthodes "
 					"HTTP que POST")
 
-		self.response = requests.post(self.get_url(), json=self.data)
+		http_settings = parcoursup_http_settings()
+		timeout = (http_settings['TIMEOUT_CONNEXION'],
+				http_settings['TIMEOUT_LECTURE'])
+		tentatives = max(1, http_settings['TENTATIVES'])
+		for tentative in range(tentatives):
+			derniere_tentative = tentative + 1 == tentatives
+			if self.limiteur is not None:
+				self.limiteur.acquerir()
+
+			try:
+				self.response = self._post(timeout)
+			except (requests.exceptions.ConnectionError,
+					requests.exceptions.Timeout):
+				if derniere_tentative:
+					raise
+				time.sleep(attente_avant_tentative(tentative,
+					http_settings))
+				continue
+
+			if self.response.status_code == 429 or \
+					self.response.status_code >= 500:
+				attente = attente_avant_tentative(tentative, http_settings,
+						self.response.headers.get('Retry-After'))
+				if self.limiteur is not None:
+					self.limiteur.signaler_saturation(attente)
+				if not derniere_tentative:
+					time.sleep(attente)
+					continue
+			elif self.limiteur is not None:
+				self.limiteur.signaler_succes()
+			break
 
 		self.response.raise_for_status()
 
@@ -270,11 +528,50 @@ class ParcoursupProposition:
 			)
 
 class ParcoursupRest:
+	# Débit par défaut (requêtes par seconde et taille des rafales)
+	DEBIT_DEFAUT = 10
+	RAFALE_DEFAUT = 10
+
 	def __init__(self, login="XXX", password="XXX",
-			code_etablissement="XXX"):
+			code_etablissement="XXX", session=None,
+			debit=DEBIT_DEFAUT, rafale=RAFALE_DEFAUT):
 		self.login = login
 		self.password = password
 		self.code_etablissement = code_etablissement
+		self._session = session
+		self.debit = debit
+		self.rafale = rafale
+
+	@property
+	def cle(self):
+		return (str(self.code_etablissement), self.login)
+
+	@property
+	def session(self):
+		"""
+		Session HTTP persistante propre à cet accès Parcoursup.
+		"""
+		if self._session is None:
+			return sessions_parcoursup.get(self.cle)
+		return self._session
+
+	@property
+	def limiteur(self):
+		"""
+		Limiteur de débit partagé par toutes les requêtes envoyées
+		avec cet accès Parcoursup.
+		"""
+		return limiteurs_parcoursup.get(self.cle, self.debit, self.rafale)
+
+	def requete(self, method_name, data):
+		"""
+		Construit une requête vers la méthode method_name de l'API
+		Parcoursup, qui passera par la session persistante et par le
+		limiteur de débit.
+		"""
+		return ParcoursupRequest(self.login, self.password,
+				method_name=method_name, data=data,
+				session=self.session, limiteur=self.limiteur)
 
 	def get_candidats_admis(self, **kwargs):
 		"""
@@ -302,9 +599,7 @@ class ParcoursupRest:
 			raise TypeError("Unexpected named parameters {}".format(
 				', '.join(args_inconnus)))
 
-		request = ParcoursupRequest(self.login, self.password,
-				method_name='getCandidatsAdmis',
-				data=request_data)
+		request = self.requete('getCandidatsAdmis', request_data)
 		response = request.send()
 
 		# Mise en forme de la réponse
@@ -323,6 +618,19 @@ class ParcoursupRest:
 		"""
 		return self.get_candidats_admis(code_candidat=code_candidat)[0]
 
+	@staticmethod
+	def empreinte_admission(psup_json):
+		"""
+		Empreinte (SHA-256) des données d'admission envoyées par
+		Parcoursup, indépendante de l'ordre des clés et des données
+		d'identification. Deux envois identiques d'un même candidat ont
+		la même empreinte.
+		"""
+		donnees = {cle: valeur for cle, valeur in psup_json.items()
+				if cle.lower() != 'identifiant'}
+		return hashlib.sha256(json.dumps(donnees, sort_keys=True,
+			separators=(',', ':')).encode('utf-8')).hexdigest()
+
 	@staticmethod
 	def parse_parcoursup_admission(psup_json):
 		"""
@@ -368,9 +676,8 @@ class ParcoursupRest:
 			'etatInscription': int(etat_inscription),
 			'codeEtablissementAffectation': str(self.code_etablissement),
 		})
-		request = ParcoursupRequest(self.login, self.password,
-				method_name='majInscriptionAdministrative',
-				data=request_data)
+		request = self.requete('majInscriptionAdministrative',
+				request_data)
 		return request.send()
 
 	def requete_test(self):
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Index de recherche par préfixe sur des noms propres
+
+Les noms sont comparés sous leur forme normalisée (voir normalise_nom) :
+« saint etienne » trouve « Saint-Étienne ». L'index est une liste triée
+des fins de noms commençant à chaque début de mot, dans laquelle les
+recherches par préfixe se font par dichotomie.
+"""
+
+import bisect
+import heapq
+import threading
+from collections import OrderedDict
+from operator import itemgetter
+
+from .utils import normalise_nom
+
+# Majorant de tous les caractères d'une forme normalisée
+FIN = '\uffff'
+
+class CacheLRU:
+	"""
+	Cache en mémoire, partagé entre les fils d'exécution d'un processus,
+	qui oublie les entrées utilisées le moins récemment quand il compte
+	plus de taille_max entrées ou quand la taille totale des entrées
+	dépasse octets_max.
+	"""
+	def __init__(self, taille_max, octets_max=None):
+		self.taille_max = taille_max
+		self.octets_max = octets_max
+		self.octets = 0
+		self.entrees = OrderedDict()
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.entrees)
+
+	def get(self, cle):
+		"""Renvoie la valeur associée à cle, ou None"""
+		with self.lock:
+			entree = self.entrees.get(cle)
+			if entree is None:
+				return None
+			self.entrees.move_to_end(cle)
+			return entree[0]
+
+	def set(self, cle, valeur, octets=0):
+		"""
+		Enregistre une valeur, dont la taille (en octets) est donnée
+		si le cache en limite la taille totale.
+		"""
+		with self.lock:
+			ancienne = self.entrees.pop(cle, None)
+			if ancienne is not None:
+				self.octets -= ancienne[1]
+			self.entrees[cle] = (valeur, octets)
+			self.octets += octets
+			while len(self.entrees) > self.taille_max or (self.entrees
+					and self.octets_max is not None
+					and self.octets > self.octets_max):
+				_, (_, taille) = self.entrees.popitem(last=False)
+				self.octets -= taille
+
+class IndexRecherche:
+	"""
+	Index construit à partir de couples (clé, nom).
+
+	rechercher() classe les résultats ainsi :
+	1. les noms qui commencent par le texte cherché,
+	2. les noms dont l'un des mots commence par le texte cherché,
+	3. les noms qui contiennent le texte cherché,
+	puis, à rang égal, les noms les plus courts d'abord.
+
+	Les résultats des dernières recherches sont conservés : les textes
+	courts, qui correspondent à beaucoup de noms, sont aussi les plus
+	souvent cherchés.
+	"""
+	# Nombre de recherches dont le résultat est conservé
+	TAILLE_CACHE = 1024
+
+	def __init__(self, elements):
+		noms = {}
+		for cle, nom in elements:
+			nom = normalise_nom(nom)
+			if nom:
+				noms[cle] = nom
+		# Noms triés par longueur puis par ordre alphabétique, avec leur
+		# rang dans ce classement
+		self.cles = sorted(noms, key=lambda cle: (len(noms[cle]), noms[cle]))
+		self.noms = [noms[cle] for cle in self.cles]
+
+		# Noms entiers, et fins de noms à partir de chaque début de mot
+		# suivant, triés par ordre alphabétique sous la forme (texte,
+		# rang du nom)
+		self.debuts = []
+		self.mots = []
+		for rang, nom in enumerate(self.noms):
+			self.debuts.append((nom, rang))
+			debut = nom.find(' ')
+			while debut >= 0:
+				self.mots.append((nom[debut + 1:], rang))
+				debut = nom.find(' ', debut + 1)
+		self.debuts.sort()
+		self.mots.sort()
+
+		# Tous les noms, séparés par des retours à la ligne, pour les
+		# recherches à l'intérieur des mots
+		self.positions = []
+		position = 0
+		for nom in self.noms:
+			self.positions.append(position)
+			position += len(nom) + 1
+		self.texte = '\n'.join(self.noms)
+
+		self.cache = CacheLRU(self.TAILLE_CACHE)
+
+	def __len__(self):
+		return len(self.cles)
+
+	def rechercher(self, texte, limite):
+		"""
+		Renvoie la liste des clés (au plus limite) des noms
+		correspondant au texte donné, par ordre de pertinence.
+		"""
+		texte = normalise_nom(texte)
+		if not texte:
+			return []
+		resultats = self.cache.get((texte, limite))
+		if resultats is None:
+			resultats = [self.cles[rang] for rang in
+					self._rechercher(texte, limite)]
+			self.cache.set((texte, limite), resultats)
+		return resultats
+
+	def _prefixe(self, liste, texte, trouves, limite):
+		"""
+		Ajoute à trouves (dictionnaire ordonné) les rangs des meilleurs
+		noms de liste commençant par texte, jusqu'à en avoir limite.
+		"""
+		debut = bisect.bisect_left(liste, (texte,))
+		fin = bisect.bisect_left(liste, (texte + FIN,), debut)
+		for rang in heapq.nsmallest(limite, set(map(itemgetter(1),
+				liste[debut:fin]))):
+			trouves.setdefault(rang)
+			if len(trouves) >= limite:
+				break
+
+	def _rechercher(self, texte, limite):
+		trouves = {}
+		for liste in (self.debuts, self.mots):
+			if len(trouves) < limite:
+				self._prefixe(liste, texte, trouves, limite)
+
+		# Recherche à l'intérieur des mots, seulement s'il manque des
+		# résultats. Les noms étant rangés par ordre de classement, les
+		# premiers trouvés sont les meilleurs.
+		position = self.texte.find(texte) if len(trouves) < limite else -1
+		while position >= 0 and len(trouves) < limite:
+			rang = bisect.bisect_right(self.positions, position) - 1
+			trouves.setdefault(rang)
+			# Nom suivant
+			if rang + 1 >= len(self.positions):
+				break
+			position = self.texte.find(texte, self.positions[rang + 1])
+		return list(trouves)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Cache en mémoire des données de référence (communes, pays, professions
+et établissements), et index de recherche sur leurs libellés pour
+l'autocomplétion.
+
+Ces tables ne changent qu'au chargement des fixtures, mais elles sont
+interrogées pour chaque champ de chaque candidat importé. Elles sont
+donc chargées une fois par processus, à la première consultation, sous
+forme d'index compacts.
+
+Un numéro de version, stocké dans la base (voir VersionDonnees), est
+incrémenté à chaque modification de l'une de ces tables, et une seule
+fois à la fin de chaque loaddata. Chaque processus compare
+régulièrement ce numéro à celui des données qu'il a chargées et
+recharge les index si nécessaire.
+"""
+
+import threading
+import time
+from types import MappingProxyType
+
+from django.conf import settings
+
+from .recherche import IndexRecherche, CacheLRU
+from .utils import normalise_nom
+
+NOM_VERSION = 'referentiel'
+
+# Délai (en secondes) entre deux vérifications du numéro de version dans
+# la base.
+DELAI_VERIFICATION = 30
+
+class Instantane:
+	"""
+	Index des données de référence lues dans la base pour un numéro de
+	version donné.
+
+	Un instantané est entièrement construit avant d'être publié, puis
+	n'est plus modifié : les fils d'exécution qui le consultent n'ont
+	pas besoin de verrou. Seuls les index de recherche et les réponses
+	de l'autocomplétion sont ajoutés à la demande, sous le verrou du
+	référentiel.
+
+	Les communes sont stockées sous forme de tuples et ne sont
+	instanciées qu'à la demande. Pour les établissements, seul
+	l'ensemble des numéros UAI est conservé : il suffit à renseigner une
+	clé étrangère.
+	"""
+	def __init__(self, version):
+		from inscrire.models import Commune, Pays, Profession, Etablissement
+
+		communes = {}
+		communes_par_nom = {}
+		for commune in Commune.objects.values_list('code_insee',
+				'nom_clair', 'nom_riche', 'libelle'):
+			communes[commune[0]] = commune
+			for nom in (commune[2], commune[3]):
+				communes_par_nom.setdefault(normalise_nom(nom), set()).add(commune[0])
+
+		pays_iso = {}
+		pays_par_insee = {}
+		pays_par_nom = {}
+		for pays in Pays.objects.order_by('pk'):
+			pays_iso[pays.code_iso2] = pays
+			if pays.num_insee is not None:
+				pays_par_insee.setdefault(pays.num_insee, pays)
+			pays_par_nom.setdefault(normalise_nom(pays.libelle), pays)
+
+		self.version = version
+		self.communes = MappingProxyType(communes)
+		# Un nom partagé par plusieurs communes ne permet pas de
+		# retrouver la commune : on ne garde que les noms non ambigus.
+		self.communes_par_nom = MappingProxyType({nom: codes.pop()
+				for nom, codes in communes_par_nom.items()
+				if len(codes) == 1})
+		self.pays = MappingProxyType(pays_iso)
+		self.pays_par_insee = MappingProxyType(pays_par_insee)
+		self.pays_par_nom = MappingProxyType(pays_par_nom)
+		self.professions = MappingProxyType(Profession.objects.in_bulk())
+		self.uai = frozenset(Etablissement.objects.values_list('pk',
+			flat=True))
+		# Index de recherche, construits à la première recherche, et
+		# réponses de l'autocomplétion
+		self.recherches = {}
+		self.reponses = {}
+
+class Referentiel:
+	"""
+	Index en mémoire des données de référence, sous forme d'un
+	instantané (voir Instantane) remplacé d'un seul coup lorsque les
+	données changent.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._prochaine_verification = 0
+		self._instantane = None
+
+	def invalider(self):
+		"""
+		Signale à tous les processus que les données de référence ont
+		changé. Le processus courant relit le numéro de version dès la
+		prochaine consultation.
+		"""
+		from inscrire.models import VersionDonnees
+		VersionDonnees.objects.incrementer(NOM_VERSION)
+		with self._lock:
+			self._prochaine_verification = 0
+
+	def _index(self):
+		"""
+		Renvoie l'instantané courant, en le rechargeant si nécessaire.
+		Le numéro de version est vérifié au plus toutes les
+		DELAI_VERIFICATION secondes.
+		"""
+		from inscrire.models import VersionDonnees
+		maintenant = time.monotonic()
+		instantane = self._instantane
+		if instantane is not None and maintenant < self._prochaine_verification:
+			return instantane
+		with self._lock:
+			instantane = self._instantane
+			if instantane is not None and \
+					maintenant < self._prochaine_verification:
+				return instantane
+			version = VersionDonnees.objects.numero(NOM_VERSION)
+			if instantane is None or version != instantane.version:
+				instantane = Instantane(version)
+				self._instantane = instantane
+			self._prochaine_verification = maintenant + DELAI_VERIFICATION
+		return instantane
+
+	def commune(self, code_insee):
+		"""
+		Renvoie la commune de code INSEE donné, ou None.
+		"""
+		donnees = self._index().communes.get(code_insee)
+		if donnees is None:
+			return None
+		from inscrire.models import Commune
+		return Commune.from_db(Commune.objects.db,
+				['code_insee', 'nom_clair', 'nom_riche', 'libelle'],
+				donnees)
+
+	def commune_par_nom(self, nom):
+		"""
+		Renvoie la commune portant le nom donné (sans tenir compte des
+		accents ni de la casse), ou None si ce nom est inconnu ou
+		ambigu.
+		"""
+		return self.commune(self._index().communes_par_nom.get(
+			normalise_nom(nom)))
+
+	def pays(self, code):
+		"""
+		Renvoie le pays désigné par son code ISO à deux lettres ou par
+		son numéro INSEE, ou None.
+
+		L'API Parcoursup dit que c'est le code ISO2 qui est renvoyé.
+		Sauf qu'en pratique, c'est le numéro INSEE... On accepte donc
+		les deux, au cas où l'API change silencieusement un jour pour
+		coller à la documentation.
+		"""
+		if code is None:
+			return None
+		code = str(code).strip()
+		if code.isdigit():
+			return self._index().pays_par_insee.get(int(code))
+		return self._index().pays.get(code.upper())
+
+	def pays_par_nom(self, nom):
+		"""
+		Renvoie le pays dont le libellé est donné, ou None.
+		"""
+		return self._index().pays_par_nom.get(normalise_nom(nom))
+
+	def profession(self, code):
+		"""
+		Renvoie la profession de code donné, ou None.
+		"""
+		return self._index().professions.get(code)
+
+	def uai_connu(self, uai):
+		"""
+		Indique si l'établissement de numéro UAI donné existe.
+		"""
+		return bool(uai) and uai.upper() in self._index().uai
+
+	def recherche(self, nom, texte, limite):
+		"""
+		Renvoie les clés primaires (au plus limite) des communes
+		(nom='commune'), pays (nom='pays') ou établissements
+		(nom='etablissement') dont le libellé correspond au texte
+		cherché, par ordre de pertinence (voir IndexRecherche).
+		"""
+		index = self._index()
+		with self._lock:
+			recherche = index.recherches.get(nom)
+			if recherche is None:
+				recherche = index.recherches[nom] = IndexRecherche(
+						self._libelles(nom))
+		return recherche.rechercher(texte, limite)
+
+	def reponses(self, nom):
+		"""
+		Renvoie le numéro de version des données chargées et le cache
+		des réponses de l'autocomplétion sur l'index donné (voir
+		inscrire.views.autocomplete). Le cache est vidé en même temps que
+		les index.
+		"""
+		index = self._index()
+		with self._lock:
+			reponses = index.reponses.get(nom)
+			if reponses is None:
+				reponses = index.reponses[nom] = CacheLRU(
+						getattr(settings, 'AUTOCOMPLETE_CACHE_ENTREES', 2000),
+						getattr(settings, 'AUTOCOMPLETE_CACHE_OCTETS', 4 * 1024 * 1024))
+			return index.version, reponses
+
+	@staticmethod
+	def _libelles(nom):
+		from inscrire.models import Commune, Pays, Etablissement
+		if nom == 'commune':
+			return Commune.objects.values_list('code_insee', 'libelle')
+		if nom == 'pays':
+			return Pays.objects.values_list('code_iso2', 'libelle')
+		if nom == 'etablissement':
+			return Etablissement.objects.values_list('numero_uai', 'nom')
+		raise ValueError("Index de recherche inconnu : {}".format(nom))
+
+referentiel = Referentiel()
+
+def invalider_referentiel(sender, **kwargs):
+	"""
+	Récepteur des signaux post_save et post_delete des modèles de
+	référence. Les enregistrements faits par loaddata (raw) sont
+	ignorés : la commande invalide le référentiel une fois le chargement
+	terminé.
+	"""
+	if kwargs.get('raw'):
+		return
+	referentiel.invalider()
@@ -3,14 +3,76 @@ import xml.etree.ElementTree as ElementTree
 
 from .interfaces import MEF, Matiere, MEFProgramme, MEFOption
 
+def _correspond(tags, chemin):
+	"""
+	Indique si la suite de balises tags correspond au chemin donné
+	(liste de balises, * désignant une balise quelconque)
+	"""
+	return len(tags) == len(chemin) and all(partie in ('*', tag)
+			for tag, partie in zip(tags, chemin))
+
 class ExportSiecle:
+	"""
+	Export XML de SIECLE, lu au fil de l'eau.
+
+	Le fichier n'est jamais chargé entièrement en mémoire : les éléments
+	demandés sont renvoyés un par un pendant la lecture, puis libérés,
+	de même que tous les éléments qui ne sont pas demandés. Chaque
+	lecture parcourt de nouveau le fichier depuis son début.
+	"""
 	def __init__(self, fh):
 		self.file_handle = fh
-		self.xml = ElementTree.parse(fh)
+		self._lectures = 0
+		self._parametres = None
 
-	def parametres(self):
-		params = self.xml.getroot().find('./PARAMETRES')
-		return {
+	def elements(self, *chemins):
+		"""
+		Générateur des couples (chemin, élément) pour les éléments dont le
+		chemin depuis la racine du document est l'un de ceux donnés, par
+		exemple 'DONNEES/MEFS/MEF' ou 'DONNEES/ELEVES/*'.
+
+		Chaque élément est complet (avec ses descendants) lorsqu'il est
+		renvoyé, mais il est vidé dès que l'on passe au suivant.
+		"""
+		chemins = [(chemin, chemin.split('/')) for chemin in chemins]
+		# Les paramètres sont relevés au passage (voir parametres())
+		conserves = [parties for _, parties in chemins] + [['PARAMETRES']]
+		if self._lectures:
+			self.file_handle.seek(0)
+		self._lectures += 1
+
+		# Éléments ouverts, de la racine à l'élément courant
+		pile = []
+		tags = []
+		for evenement, element in ElementTree.iterparse(self.file_handle,
+				events=('start', 'end')):
+			if evenement == 'start':
+				pile.append(element)
+				tags.append(element.tag)
+				continue
+			pile.pop()
+			tags.pop()
+			if not pile:
+				# Fin de la racine
+				element.clear()
+				break
+			chemin_element = tags[1:] + [element.tag]
+			if any(_correspond(chemin_element[:len(parties)], parties)
+					and len(chemin_element) > len(parties)
+					for parties in conserves):
+				# Descendant d'un élément demandé : on le conserve
+				continue
+			if chemin_element == ['PARAMETRES']:
+				self._lire_parametres(element)
+			for chemin, parties in chemins:
+				if _correspond(chemin_element, parties):
+					yield chemin, element
+					break
+			element.clear()
+			pile[-1].remove(element)
+
+	def _lire_parametres(self, params):
+		self._parametres = {
 			'uai': params.find('UAJ').text,
 			'annee_scolaire': params.find('ANNEE_SCOLAIRE').text,
 			'date_export': datetime.strptime(
@@ -21,6 +83,16 @@ class ExportSiecle:
 				'%d/%m/%Y %H:%M:%S')
 		}
 
+	def parametres(self):
+		"""
+		Paramètres de l'export. Ils sont relevés lors de n'importe quelle
+		lecture du fichier ; à défaut, seul le début du fichier est lu.
+		"""
+		if self._parametres is None:
+			for _ in self.elements('PARAMETRES'):
+				break
+		return self._parametres
+
 	@classmethod
 	def guess_type(xml_et):
 		return {
@@ -30,67 +102,106 @@ class ExportSiecle:
 
 class Nomenclature(ExportSiecle):
 	def mefs(self):
+		"""
+		Renvoie le dictionnaire des MEF de la nomenclature, avec leur
+		programme et leurs options obligatoires, lus en un seul passage.
+		"""
 		mefs = {}
-		for mef_et in self.xml.getroot().findall('./DONNEES/MEFS/MEF'):
-			code_mef = mef_et.attrib['CODE_MEF']
-			try:
-				nb_opt_oblig = int(mef_et.find('NB_OPT_OBLIG').text)
-			except:
-				nb_opt_oblig = None
-			try:
-				nb_opt_mini = int(mef_et.find('NB_OPT_MINI').text)
-			except:
-				nb_opt_mini = None
-
-			mefs[code_mef] = MEF(
-				code=mef_et.attrib['CODE_MEF'],
-				formation=mef_et.find('FORMATION').text,
-				libelle_long=mef_et.find('LIBELLE_LONG').text,
-				nb_opt_oblig=nb_opt_oblig,
-				nb_opt_mini=nb_opt_mini,
-			)
-		matieres = self.matieres()
+		matieres = {}
+		# Les programmes et options peuvent précéder les matières dans le
+		# fichier : ils ne sont rattachés qu'à la fin de la lecture
+		programmes = []
+		options = []
+		for chemin, element in self.elements('DONNEES/MEFS/MEF',
+				'DONNEES/MATIERES/MATIERE',
+				'DONNEES/PROGRAMMES/PROGRAMME',
+				'DONNEES/OPTIONS_OBLIGATOIRES/OPTION_OBLIGATOIRE'):
+			if chemin == 'DONNEES/MEFS/MEF':
+				mef = self._mef(element)
+				mefs[mef.code] = mef
+			elif chemin == 'DONNEES/MATIERES/MATIERE':
+				matiere = self._matiere(element)
+				matieres[matiere.code] = matiere
+			elif chemin == 'DONNEES/PROGRAMMES/PROGRAMME':
+				programmes.append((element.find('CODE_MEF').text,
+					element.find('CODE_MATIERE').text,
+					element.find('CODE_MODALITE_ELECT').text,
+					element.find('HORAIRE').text))
+			else:
+				options.append((element.find('CODE_MEF').text,
+					element.find('CODE_MATIERE').text,
+					int(element.find('RANG_OPTION').text)))
 
-		for programme_et in self.xml.getroot().findall('./DONNEES/PROGRAMMES/PROGRAMME'):
-			code_mef = programme_et.find('CODE_MEF').text
+		for code_mef, code_matiere, modalite_election, horaire in programmes:
 			mefs[code_mef].programme.append(
 					MEFProgramme(mef=mefs[code_mef],
-						matiere=matieres[programme_et.find('CODE_MATIERE').text],
-						modalite_election=programme_et.find('CODE_MODALITE_ELECT').text,
-						horaire=programme_et.find('HORAIRE').text,
+						matiere=matieres[code_matiere],
+						modalite_election=modalite_election,
+						horaire=horaire,
 					)
 				)
 
-		for option_et in self.xml.getroot().findall('./DONNEES/OPTIONS_OBLIGATOIRES/OPTION_OBLIGATOIRE'):
-			code_mef = option_et.find('CODE_MEF').text
+		for code_mef, code_matiere, rang in options:
 			option = MEFOption(mef=mefs[code_mef],
-				matiere=matieres[option_et.find('CODE_MATIERE').text],
-				rang=int(option_et.find('RANG_OPTION').text))
+				matiere=matieres[code_matiere],
+				rang=rang)
 			mefs[code_mef].options_obligatoires.append(option)
 
 		return mefs
 
+	@staticmethod
+	def _mef(mef_et):
+		try:
+			nb_opt_oblig = int(mef_et.find('NB_OPT_OBLIG').text)
+		except:
+			nb_opt_oblig = None
+		try:
+			nb_opt_mini = int(mef_et.find('NB_OPT_MINI').text)
+		except:
+			nb_opt_mini = None
+
+		return MEF(
+			code=mef_et.attrib['CODE_MEF'],
+			formation=mef_et.find('FORMATION').text,
+			libelle_long=mef_et.find('LIBELLE_LONG').text,
+			nb_opt_oblig=nb_opt_oblig,
+			nb_opt_mini=nb_opt_mini,
+		)
+
+	@staticmethod
+	def _matiere(matiere_et):
+		return Matiere(
+				code=matiere_et.attrib['CODE_MATIERE'],
+				code_gestion=matiere_et.find('CODE_GESTION').text,
+				libelle_court=matiere_et.find('LIBELLE_COURT').text,
+				libelle_long=matiere_et.find('LIBELLE_LONG').text,
+				libelle_edition=matiere_et.find('LIBELLE_EDITION').text,
+				matiere_etp=matiere_et.find('MATIERE_ETP').text,
+			)
+
 	def matieres(self):
 		matieres = {}
-		for matiere_et in self.xml.getroot().findall('./DONNEES/MATIERES/MATIERE'):
-			code_matiere = matiere_et.attrib['CODE_MATIERE']
-			matieres[code_matiere] = Matiere(
-					code=code_matiere,
-					code_gestion=matiere_et.find('CODE_GESTION').text,
-					libelle_court=matiere_et.find('LIBELLE_COURT').text,
-					libelle_long=matiere_et.find('LIBELLE_LONG').text,
-					libelle_edition=matiere_et.find('LIBELLE_EDITION').text,
-					matiere_etp=matiere_et.find('MATIERE_ETP').text,
-				)
+		for _, matiere_et in self.elements('DONNEES/MATIERES/MATIERE'):
+			matiere = self._matiere(matiere_et)
+			matieres[matiere.code] = matiere
 		return matieres
 
 class Structures(ExportSiecle):
+	def divisions(self):
+		"""
+		Générateur des divisions du fichier, sous la forme de couples
+		(code de la division, liste des codes MEF de la division)
+		"""
+		for _, division in self.elements('DONNEES/DIVISIONS/DIVISION'):
+			yield division.get('CODE_STRUCTURE'), [mef.text for mef in
+					division.findall('MEFS_APPARTENANCE/MEF_APPARTENANCE/CODE_MEF')]
+
 	def mefs(self):
 		"""
 		Renvoie l'ensemble es codes MEF pour lesquels il existe une
 		division avec ce code.
 		"""
 		codes_mefs = set()
-		for mef_et in self.xml.getroot().findall('./DONNEES/DIVISIONS/DIVISION/MEFS_APPARTENANCE/MEF_APPARTENANCE/CODE_MEF'):
-			codes_mefs.add(mef_et.text)
+		for _, mefs in self.divisions():
+			codes_mefs.update(mefs)
 		return codes_mefs
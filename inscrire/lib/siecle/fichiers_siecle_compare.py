@@ -1,62 +1,79 @@
 # Pour comparaison avec les données élèves de SIECLE
 # Fonctionnalité très grosièrement développée
 
-from datetime import datetime
-import xml.etree.ElementTree as ElementTree
-
-from .interfaces import MEF, Matiere, MEFProgramme, MEFOption
+from . import fichiers
 from .fichiers import ExportSiecle
 
 
 class ElevesSansAdresses(ExportSiecle):
-	def eleves(self):
-		lexique_eleves={
-			'ine':'ID_NATIONAL',
-			'email':'MEL',
-			'nom': 'NOM_DE_FAMILLE',
-			'prenom':'PRENOM',
-			'genre':'CODE_SEXE',
-			'mobile':'TEL_PORTABLE',
-		}
-		lexique_options={
-			'numero': 'NUM_OPTION',
-			'modalite': 'CODE_MODALITE_ELECT',
-			'code_matiere': 'CODE_MATIERE'
-		}
-		dic_eleves={}
-		for eleve in self.xml.getroot().findall('./DONNEES/ELEVES/'):
-			dic={}
-			dic_eleves.update({eleve.get('ELEVE_ID'):dic})
-			for key, code in lexique_eleves.items():
-				valeur=eleve.find(code)
-				dic[key]=valeur.text if valeur!=None else ""
-			dic['options']=[]
-			dic['structure']=""
-			dic["bourse"]=""
-		for options in self.xml.getroot().findall('.DONNEES/OPTIONS/'):
-			L=dic_eleves[options.get('ELEVE_ID')]['options']
-			for option in options.findall('OPTIONS_ELEVE'):
+	lexique_eleves={
+		'ine':'ID_NATIONAL',
+		'email':'MEL',
+		'nom': 'NOM_DE_FAMILLE',
+		'prenom':'PRENOM',
+		'genre':'CODE_SEXE',
+		'mobile':'TEL_PORTABLE',
+	}
+	lexique_options={
+		'numero': 'NUM_OPTION',
+		'modalite': 'CODE_MODALITE_ELECT',
+		'code_matiere': 'CODE_MATIERE'
+	}
+
+	def enregistrements(self):
+		"""
+		Générateur, en un seul passage sur le fichier, des couples
+		(section, (identifiant de l'élève, données)) où section vaut
+		'eleve', 'options', 'structure' ou 'bourse'.
+		"""
+		for chemin, element in self.elements('DONNEES/ELEVES/*',
+				'DONNEES/OPTIONS/*', 'DONNEES/STRUCTURES/*',
+				'DONNEES/BOURSES/*'):
+			eleve_id = element.get('ELEVE_ID')
+			if chemin == 'DONNEES/ELEVES/*':
 				dic={}
-				L.append(dic)
-				for key, code in lexique_options.items():
-					valeur=option.find(code)
+				for key, code in self.lexique_eleves.items():
+					valeur=element.find(code)
 					dic[key]=valeur.text if valeur!=None else ""
-		for structure_eleve in self.xml.getroot().findall('.DONNEES/STRUCTURES/'):
-			dic_eleves[structure_eleve.get('ELEVE_ID')]['structure']=structure_eleve.find('STRUCTURE/CODE_STRUCTURE').text
-		for bourse in self.xml.getroot().findall('.DONNEES/BOURSES/'):
-			dic_eleves[bourse.get('ELEVE_ID')]['bourse']=bourse.find('CODE_BOURSE').text
+				yield 'eleve', (eleve_id, dic)
+			elif chemin == 'DONNEES/OPTIONS/*':
+				options=[]
+				for option in element.findall('OPTIONS_ELEVE'):
+					dic={}
+					options.append(dic)
+					for key, code in self.lexique_options.items():
+						valeur=option.find(code)
+						dic[key]=valeur.text if valeur!=None else ""
+				yield 'options', (eleve_id, options)
+			elif chemin == 'DONNEES/STRUCTURES/*':
+				yield 'structure', (eleve_id,
+						element.find('STRUCTURE/CODE_STRUCTURE').text)
+			else:
+				yield 'bourse', (eleve_id, element.find('CODE_BOURSE').text)
+
+	def eleves(self):
+		dic_eleves={}
+		for section, (eleve_id, valeur) in self.enregistrements():
+			if section == 'eleve':
+				valeur['options']=[]
+				valeur['structure']=""
+				valeur["bourse"]=""
+				dic_eleves[eleve_id]=valeur
+			elif section == 'options':
+				dic_eleves[eleve_id]['options'].extend(valeur)
+			else:
+				dic_eleves[eleve_id][section]=valeur
 		return dic_eleves
 
-class Structures(ExportSiecle):
+class Structures(fichiers.Structures):
 	def structures(self):
 		"""retourne un dictionnaire dont les clés sont
 		les codes mefs et les valeurs sont des sets contentant
 		les divisions correspondantes"""
 		dic_structures={}
-		for division in self.xml.getroot().findall('.DONNEES/DIVISIONS/'):
-			for mef in division.findall('MEFS_APPARTENANCE/MEF_APPARTENANCE'):
-				code_mef=mef.find('CODE_MEF').text
+		for division, mefs in self.divisions():
+			for code_mef in mefs:
 				if not code_mef in dic_structures:
 					dic_structures[code_mef]=set()
-				dic_structures[code_mef].add(division.get('CODE_STRUCTURE'))
+				dic_structures[code_mef].add(division)
 		return dic_structures
@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Statistiques des tableaux de bord de la direction.
+
+Les nombres de dossiers de toutes les formations sont obtenus en une
+seule requête groupée sur la table DossierEtat, puis conservés quelques
+instants dans le cache Django. Le cache est vidé dès qu'un état de
+dossier change ; les autres processus voient au plus tard les nouvelles
+valeurs à l'expiration de la durée de conservation.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+CLE_COMPTEURS = 'inscrire:statistiques:compteurs'
+
+def invalider_statistiques():
+	"""
+	Vide le cache des statistiques, à appeler après toute modification
+	de l'état des dossiers.
+	"""
+	cache.delete(CLE_COMPTEURS)
+
+def _compteurs_dossiers():
+	from inscrire.models import DossierEtat
+	compteurs = cache.get(CLE_COMPTEURS)
+	if compteurs is None:
+		compteurs = DossierEtat.compteurs()
+		cache.set(CLE_COMPTEURS, compteurs,
+				getattr(settings, 'STATISTIQUES_DUREE_CACHE', 60))
+	return compteurs
+
+def compteurs_formations(formations):
+	"""
+	Renvoie, pour chaque formation donnée, un dictionnaire
+	associant à sa clé primaire les nombres de candidats :
+	- total : candidats ayant accepté la formation,
+	- edition, complet, termine, demission : candidats dont le dossier
+	  est dans l'état correspondant.
+	"""
+	from inscrire.models import DossierEtat
+	compteurs = _compteurs_dossiers()
+	resultat = {}
+	for formation in formations:
+		compteurs_formation = compteurs.get(formation.pk, {})
+		resultat[formation.pk] = {
+			'edition': compteurs_formation.get(DossierEtat.ETAT_EDITION, 0),
+			'complet': compteurs_formation.get(DossierEtat.ETAT_COMPLET, 0),
+			'termine': compteurs_formation.get(DossierEtat.ETAT_TERMINE, 0),
+			'demission': compteurs_formation.get(DossierEtat.ETAT_DEMISSION, 0),
+		}
+		resultat[formation.pk]['total'] = resultat[formation.pk]['edition'] \
+				+ resultat[formation.pk]['complet'] \
+				+ resultat[formation.pk]['termine']
+	return resultat
+
+def formations_avec_compteurs(formations):
+	"""
+	Évalue la liste de formations donnée et ajoute à chacune un
+	attribut compteurs (voir compteurs_formations), utilisé par le
+	gabarit formation_tableau.html.
+	"""
+	formations = list(formations)
+	compteurs = compteurs_formations(formations)
+	for formation in formations:
+		formation.compteurs = compteurs[formation.pk]
+	return formations
@@ -0,0 +1,98 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Commande de gestion générique exécutant les tâches d'une file
+(voir inscrire.models.taches)
+"""
+
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+class TravailleursCommand(BaseCommand):
+	"""
+	Commande qui lance plusieurs travailleurs (fils d'exécution)
+	chargés de réserver et d'exécuter les tâches du modèle self.modele,
+	sous-classe de inscrire.models.Tache. Chaque travailleur réserve
+	jusqu'à self.taille_lot tâches à la fois (option --lot), exécutées
+	ensemble par self.modele.traiter_lot.
+
+	Sans l'option --une-fois, la commande tourne jusqu'à ce qu'elle
+	reçoive SIGINT ou SIGTERM : les travailleurs terminent alors leur
+	tâche en cours avant de s'arrêter.
+	"""
+	modele = None
+	taille_lot = 1
+
+	def add_arguments(self, parser):
+		parser.add_argument('--travailleurs', type=int, default=1,
+				help="Nombre de tâches exécutées simultanément")
+		parser.add_argument('--attente', type=float, default=2,
+				help="Durée (en secondes) entre deux consultations de la "
+				"file lorsqu'elle est vide")
+		parser.add_argument('--une-fois', action='store_true',
+				help="S'arrêter dès que la file est vide")
+		parser.add_argument('--lot', type=int, default=self.taille_lot,
+				help="Nombre de tâches réservées et exécutées ensemble")
+
+	def travailleur(self, arret, une_fois, attente, lot, compteurs):
+		try:
+			while not arret.is_set():
+				taches = self.modele.reserver_lot(lot)
+				if not taches:
+					if une_fois:
+						break
+					arret.wait(attente)
+					continue
+				resultats = self.modele.traiter_lot(taches)
+				with self.verrou:
+					for succes in resultats:
+						if succes is not None:
+							compteurs['succes' if succes else 'echecs'] += 1
+		finally:
+			# Chaque fil ouvre sa propre connexion à la base
+			connection.close()
+
+	def handle(self, *args, **options):
+		arret = threading.Event()
+		self.verrou = threading.Lock()
+		compteurs = {'succes': 0, 'echecs': 0}
+
+		def interruption(signum, frame):
+			arret.set()
+		signal.signal(signal.SIGINT, interruption)
+		signal.signal(signal.SIGTERM, interruption)
+
+		fils = [threading.Thread(target=self.travailleur,
+				args=(arret, options['une_fois'], options['attente'],
+					max(1, options['lot']), compteurs))
+				for _ in range(max(1, options['travailleurs']))]
+		for fil in fils:
+			fil.start()
+		# Attente par intervalles, pour que le fil principal reste
+		# réceptif aux signaux
+		while any(fil.is_alive() for fil in fils):
+			for fil in fils:
+				fil.join(0.5)
+
+		self.stdout.write("{} : {} tâche(s) réussie(s), {} échec(s)".format(
+			self.modele._meta.verbose_name_plural,
+			compteurs['succes'], compteurs['echecs']))
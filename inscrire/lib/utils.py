@@ -18,6 +18,7 @@
 
 import datetime
 import re
+import unicodedata
 from dateutil.tz import gettz
 
 date_re = re.compile(r'(?P<day>\d{1,2})/(?P<month>\d{1,2})/(?P<year>\d{4})$')
@@ -27,8 +28,9 @@ def parse_french_date(date):
 	JJ/MM/AAAA.
 	"""
 	match = date_re.match(date)
-	if match:
-		kw = {k: int(v) for k, v in match.groupdict().items()}
+	if not match:
+		raise ValueError("Date invalide : {}".format(date))
+	kw = {k: int(v) for k, v in match.groupdict().items()}
 	return datetime.date(**kw)
 
 def format_adresse_pays(**parts):
@@ -53,3 +55,17 @@ def parse_datetime(date):
 	"""
 	paris_tz = gettz('Europe/Paris')
 	return datetime.datetime.strptime(date, "%d/%m/%Y %H:%M").replace(tzinfo=paris_tz)
+
+def normalise_nom(nom):
+	"""
+	Forme normalisée d'un nom propre (commune, pays, établissement),
+	utilisée pour comparer des noms sans tenir compte de la casse, des
+	accents ni de la ponctuation : « Saint-Étienne » et « SAINT ETIENNE »
+	ont la même forme normalisée.
+	"""
+	if not nom:
+		return ''
+	nom = unicodedata.normalize('NFKD', nom)
+	nom = ''.join(c for c in nom if not unicodedata.combining(c))
+	nom = re.sub(r"[^0-9A-Za-z]+", ' ', nom)
+	return nom.strip().upper()
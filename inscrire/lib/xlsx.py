@@ -0,0 +1,172 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Écriture de classeurs XLSX au fil de l'eau
+
+Les lignes d'une feuille sont écrites dans l'archive au fur et à mesure
+qu'elles sont produites, sans jamais garder la feuille entière en
+mémoire. Les chaînes sont écrites en ligne (inlineStr), ce qui évite de
+construire la table des chaînes partagées.
+"""
+
+import re
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+# Caractères interdits par XML 1.0
+CARACTERES_INTERDITS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+{feuilles}</Types>"""
+
+CONTENT_TYPE_FEUILLE = """<Override PartName="/xl/worksheets/sheet{numero}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+"""
+
+RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>
+{feuilles}</sheets>
+</workbook>"""
+
+WORKBOOK_FEUILLE = """<sheet name={nom} sheetId="{numero}" r:id="rId{numero}"/>
+"""
+
+WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+{feuilles}<Relationship Id="rId{styles}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+WORKBOOK_RELS_FEUILLE = """<Relationship Id="rId{numero}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{numero}.xml"/>
+"""
+
+STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="1"><fill><patternFill patternType="none"/></fill></fills>
+<borders count="1"><border/></borders>
+<cellStyleXfs count="1"><xf/></cellStyleXfs>
+<cellXfs count="1"><xf xfId="0"/></cellXfs>
+</styleSheet>"""
+
+DEBUT_FEUILLE = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<sheetData>
+"""
+
+FIN_FEUILLE = """</sheetData>
+</worksheet>"""
+
+def nom_colonne(indice):
+	"""
+	Renvoie le nom de la colonne d'indice donné (0 pour A, 25 pour Z, 26
+	pour AA…)
+	"""
+	nom = ""
+	indice += 1
+	while indice:
+		indice, reste = divmod(indice - 1, 26)
+		nom = chr(ord('A') + reste) + nom
+	return nom
+
+def cellule(reference, valeur):
+	"""
+	Renvoie le XML d'une cellule, ou une chaîne vide pour une cellule
+	sans valeur.
+	"""
+	if valeur is None or valeur == "":
+		return ""
+	if isinstance(valeur, bool):
+		return '<c r="{}" t="b"><v>{}</v></c>'.format(reference, int(valeur))
+	if isinstance(valeur, (int, float)):
+		return '<c r="{}"><v>{}</v></c>'.format(reference, valeur)
+	texte = CARACTERES_INTERDITS.sub('', str(valeur))
+	return '<c r="{}" t="inlineStr"><is><t xml:space="preserve">{}</t></is></c>'.format(
+			reference, escape(texte))
+
+class ClasseurXlsx:
+	"""
+	Classeur XLSX écrit dans le fichier donné (chemin ou objet fichier
+	binaire).
+
+	Les feuilles sont ajoutées l'une après l'autre par ajouter_feuille ;
+	le classeur n'est valide qu'après l'appel à fermer(). La classe
+	s'utilise de préférence comme gestionnaire de contexte.
+	"""
+	def __init__(self, fichier):
+		self.zip = zipfile.ZipFile(fichier, 'w',
+				compression=zipfile.ZIP_DEFLATED)
+		self.feuilles = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.fermer()
+		else:
+			self.zip.close()
+
+	def ajouter_feuille(self, nom, lignes):
+		"""
+		Ajoute une feuille nommée nom, dont les lignes sont lues une à une
+		dans l'itérable lignes. Chaque ligne est une liste de valeurs.
+		"""
+		# Excel limite les noms de feuilles à 31 caractères, sans les
+		# caractères []:*?/\
+		nom = re.sub(r'[\[\]:*?/\\]', '_', nom)[:31]
+		self.feuilles.append(nom)
+		numero = len(self.feuilles)
+		with self.zip.open('xl/worksheets/sheet{}.xml'.format(numero), 'w',
+				force_zip64=True) as flux:
+			flux.write(DEBUT_FEUILLE.encode('utf-8'))
+			for n, ligne in enumerate(lignes, 1):
+				xml = ''.join(cellule('{}{}'.format(nom_colonne(i), n), valeur)
+						for i, valeur in enumerate(ligne))
+				flux.write('<row r="{}">{}</row>\n'.format(n, xml).encode('utf-8'))
+			flux.write(FIN_FEUILLE.encode('utf-8'))
+
+	def fermer(self):
+		"""
+		Écrit les parties communes du classeur et ferme l'archive
+		"""
+		numeros = range(1, len(self.feuilles) + 1)
+		self.zip.writestr('[Content_Types].xml', CONTENT_TYPES.format(
+			feuilles=''.join(CONTENT_TYPE_FEUILLE.format(numero=numero)
+				for numero in numeros)))
+		self.zip.writestr('_rels/.rels', RELS)
+		self.zip.writestr('xl/workbook.xml', WORKBOOK.format(
+			feuilles=''.join(WORKBOOK_FEUILLE.format(numero=numero,
+				nom=quoteattr(nom))
+				for numero, nom in zip(numeros, self.feuilles))))
+		self.zip.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS.format(
+			feuilles=''.join(WORKBOOK_RELS_FEUILLE.format(numero=numero)
+				for numero in numeros),
+			styles=len(self.feuilles) + 1))
+		self.zip.writestr('xl/styles.xml', STYLES)
+		self.zip.close()
@@ -0,0 +1,55 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inscrire.models import ParcoursupUser
+
+class Command(BaseCommand):
+	help = "Confirme à Parcoursup l'inscription administrative des " \
+			"candidats dont le dossier est terminé"
+
+	def add_arguments(self, parser):
+		parser.add_argument('etablissements', nargs='*', metavar='UAI',
+				help="Établissements à traiter (par défaut, tous ceux "
+				"dont les inscriptions sont gérées)")
+		parser.add_argument('--concurrence', type=int, default=None,
+				help="Nombre maximal de requêtes simultanées vers "
+				"Parcoursup")
+
+	def handle(self, *args, **options):
+		psup_users = ParcoursupUser.objects.filter(
+				etablissement__inscriptions=True)
+		if options['etablissements']:
+			psup_users = psup_users.filter(
+					etablissement__numero_uai__in=options['etablissements'])
+		if not psup_users:
+			raise CommandError("Aucun établissement à traiter")
+
+		for psup_user in psup_users:
+			etablissement = psup_user.etablissement
+			resultats = etablissement.confirme_inscription_administrative(
+					concurrence=options['concurrence'])
+			for resultat in resultats:
+				if not resultat.succes:
+					self.stderr.write("{} : {}".format(resultat.candidat,
+						resultat.message))
+			self.stdout.write("{} : {} inscription(s) confirmée(s), "
+					"{} échec(s)".format(etablissement,
+						sum(1 for r in resultats if r.succes),
+						sum(1 for r in resultats if not r.succes)))
@@ -0,0 +1,33 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.commands import loaddata
+
+from inscrire.lib.referentiel import referentiel
+from inscrire.lib.configuration import configurations
+
+class Command(loaddata.Command):
+	"""
+	Chargement de fixtures, suivi d'une seule invalidation des données
+	conservées en mémoire par les processus : les signaux émis pour
+	chaque objet chargé (raw) sont ignorés.
+	"""
+	def handle(self, *fixture_labels, **options):
+		super().handle(*fixture_labels, **options)
+		referentiel.invalider()
+		configurations.invalider()
@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inscrire.lib.maintenance import (maintenance, reseau, lire, ecrire,
+		FICHIER_EN_TRAVAUX, FICHIER_IP, FICHIER_AVERTISSEMENT)
+
+class Command(BaseCommand):
+	help = "Active ou désactive le mode maintenance du site"
+
+	def add_arguments(self, parser):
+		actions = parser.add_subparsers(dest='action', metavar='action')
+		actions.required = True
+		actions.add_parser('etat', help="Affiche l'état du mode maintenance")
+		activer = actions.add_parser('activer',
+				help="Ferme le site, sauf pour les adresses autorisées")
+		activer.add_argument('message', nargs='?',
+				default="Site en maintenance",
+				help="Message affiché à la place du site")
+		actions.add_parser('desactiver', help="Rouvre le site")
+		autoriser = actions.add_parser('autoriser',
+				help="Remplace la liste des adresses IP ou réseaux (notation "
+				"CIDR) ayant accès au site pendant la maintenance")
+		autoriser.add_argument('adresses', nargs='*', metavar='adresse')
+		avertir = actions.add_parser('avertir',
+				help="Affiche un avertissement en haut des pages (sans "
+				"message, retire l'avertissement)")
+		avertir.add_argument('message', nargs='?', default="")
+
+	def handle(self, *args, **options):
+		action = options['action']
+		if action == 'activer':
+			if not options['message'].strip():
+				raise CommandError("Le message ne peut pas être vide")
+			ecrire(FICHIER_EN_TRAVAUX, options['message'].strip() + "\n")
+		elif action == 'desactiver':
+			ecrire(FICHIER_EN_TRAVAUX, "")
+		elif action == 'autoriser':
+			invalides = []
+			for adresse in options['adresses']:
+				try:
+					reseau(adresse)
+				except ValueError:
+					invalides.append(adresse)
+			if invalides:
+				raise CommandError("Adresse(s) invalide(s) : {}".format(
+					", ".join(invalides)))
+			ecrire(FICHIER_IP, "".join(adresse + "\n"
+				for adresse in options['adresses']))
+		elif action == 'avertir':
+			ecrire(FICHIER_AVERTISSEMENT, options['message'].strip() + "\n"
+					if options['message'].strip() else "")
+
+		# Les autres processus relisent les fichiers dès qu'ils
+		# constatent leur modification
+		maintenance.recharger()
+		message = maintenance.message_travaux(None)
+		if message:
+			self.stdout.write("Site fermé : {}".format(message))
+		else:
+			self.stdout.write("Site ouvert")
+		adresses = [ligne.strip() for ligne in
+				(lire(FICHIER_IP) or "").splitlines() if ligne.strip()]
+		self.stdout.write("Adresses autorisées : {}".format(
+			", ".join(adresses) or "aucune"))
+		avertissement = maintenance.avertissement_maintenance()
+		if avertissement:
+			self.stdout.write("Avertissement : {}".format(avertissement))
@@ -0,0 +1,44 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inscrire.models import Etablissement, DossierEtat
+
+class Command(BaseCommand):
+	help = "Recalcule entièrement l'état des dossiers d'inscription " \
+			"des candidats"
+
+	def add_arguments(self, parser):
+		parser.add_argument('etablissements', nargs='*', metavar='UAI',
+				help="Établissements à traiter (par défaut, tous)")
+
+	def handle(self, *args, **options):
+		if not options['etablissements']:
+			nombre = DossierEtat.objects.reconstruire()
+			self.stdout.write("{} candidat(s) traité(s)".format(nombre))
+			return
+
+		etablissements = Etablissement.objects.filter(
+				numero_uai__in=options['etablissements'])
+		if not etablissements:
+			raise CommandError("Aucun établissement à traiter")
+		for etablissement in etablissements:
+			nombre = DossierEtat.objects.reconstruire(etablissement)
+			self.stdout.write("{} : {} candidat(s) traité(s)".format(
+				etablissement, nombre))
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0042_auto_20200824_1127'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parcoursupmessageenvoyelog',
+            name='candidat',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inscrire.Candidat'),
+        ),
+        migrations.AddField(
+            model_name='parcoursupmessageenvoyelog',
+            name='endpoint',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='parcoursupmessageenvoyelog',
+            name='message',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='parcoursupmessageenvoyelog',
+            name='succes',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='parcoursupmessageenvoyelog',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inscrire.ParcoursupUser'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0043_parcoursupmessageenvoyelog_details'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parcoursupuser',
+            name='debit_max',
+            field=models.FloatField(default=10, help_text='Nombre maximal de requêtes envoyées à Parcoursup par seconde', verbose_name='débit maximal'),
+        ),
+        migrations.AddField(
+            model_name='parcoursupuser',
+            name='rafale_max',
+            field=models.PositiveSmallIntegerField(default=10, help_text="Nombre de requêtes pouvant être envoyées d'un coup avant que le débit maximal ne s'applique", verbose_name='rafale maximale'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0044_parcoursupuser_debit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TacheAdmission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('etat', models.PositiveSmallIntegerField(choices=[(1, 'en attente'), (2, 'en cours'), (3, 'terminée'), (4, 'abandonnée')], default=1)),
+                ('date_creation', models.DateTimeField(auto_now_add=True, verbose_name='date de création')),
+                ('prochaine_tentative', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('date_debut', models.DateTimeField(blank=True, null=True, verbose_name='début du traitement')),
+                ('date_fin', models.DateTimeField(blank=True, null=True, verbose_name='fin du traitement')),
+                ('tentatives', models.PositiveSmallIntegerField(default=0)),
+                ('erreur', models.TextField(blank=True, default='')),
+                ('donnees', models.TextField(verbose_name='données reçues')),
+                ('url_base', models.URLField(help_text="Adresse du site utilisée dans les liens de l'e-mail de bienvenue", max_length=300)),
+                ('candidat', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inscrire.Candidat')),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inscrire.ParcoursupMessageRecuLog')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inscrire.ParcoursupUser')),
+            ],
+            options={
+                'verbose_name': 'admission Parcoursup à traiter',
+                'verbose_name_plural': 'admissions Parcoursup à traiter',
+            },
+        ),
+    ]
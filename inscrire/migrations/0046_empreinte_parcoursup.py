@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0045_tacheadmission'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parcoursupmessagereculog',
+            name='empreinte',
+            field=models.CharField(blank=True, db_index=True, default='', help_text="Empreinte SHA-256 des données d'admission reçues", max_length=64),
+        ),
+        migrations.AddField(
+            model_name='voeu',
+            name='empreinte_parcoursup',
+            field=models.CharField(blank=True, default='', editable=False, help_text="Empreinte des dernières données d'admission Parcoursup importées pour ce vœu", max_length=64),
+        ),
+    ]
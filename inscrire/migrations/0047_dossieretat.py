@@ -0,0 +1,84 @@
+# Generated by Django 2.2.28 on 2026-10-18 06:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+# Fiches que le candidat doit lui-même compléter (voir
+# inscrire.models.fiches.all_fiche_validation_candidat)
+FICHES_CANDIDAT = ('ficheidentite', 'fichescolariteanterieure',
+        'fichescolarite', 'fichehebergement', 'ficheinternat', 'fichecesure',
+        'fichebourse', 'fichereglement', 'fichepiecejustificative')
+
+def remplit_dossiers(apps, schema_editor):
+    """
+    Calcul initial de l'état des dossiers (voir DossierEtat.etat_dossier)
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Etablissement = apps.get_model('inscrire', 'Etablissement')
+    Fiche = apps.get_model('inscrire', 'Fiche')
+    Voeu = apps.get_model('inscrire', 'Voeu')
+    DossierEtat = apps.get_model('inscrire', 'DossierEtat')
+
+    types_candidat = set(ContentType.objects.filter(app_label='inscrire',
+        model__in=FICHES_CANDIDAT).values_list('pk', flat=True))
+    types_etablissement = {}
+    for etablissement_id, ctype_id in Etablissement.fiches.through.objects.values_list(
+            'etablissement_id', 'contenttype_id'):
+        types_etablissement.setdefault(etablissement_id, set()).add(ctype_id)
+    fiches = {}
+    for candidat_id, ctype_id, etat in Fiche.objects.values_list(
+            'candidat_id', 'polymorphic_ctype_id', 'etat'):
+        fiches.setdefault(candidat_id, []).append((ctype_id, etat))
+
+    dossiers = []
+    for pk, candidat_id, formation_id, etablissement_id, etat_voeu in \
+            Voeu.objects.values_list('pk', 'candidat_id', 'formation_id',
+                'formation__etablissement_id', 'etat'):
+        fiches_voeu = [(ctype_id, etat) for ctype_id, etat in fiches.get(candidat_id, [])
+                if ctype_id in types_etablissement.get(etablissement_id, ())]
+        if etat_voeu == 3:
+            etat = 4
+        elif etat_voeu not in (1, 2):
+            continue
+        elif any(ctype_id in types_candidat and etat == 1
+                for ctype_id, etat in fiches_voeu):
+            etat = 1
+        elif any(etat != 3 for _, etat in fiches_voeu):
+            etat = 2
+        else:
+            etat = 3
+        dossiers.append(DossierEtat(voeu_id=pk, candidat_id=candidat_id,
+            formation_id=formation_id, etat=etat))
+    DossierEtat.objects.bulk_create(dossiers, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('inscrire', '0046_empreinte_parcoursup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DossierEtat',
+            fields=[
+                ('voeu', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='dossier', serialize=False, to='inscrire.Voeu')),
+                ('etat', models.PositiveSmallIntegerField(choices=[(1, 'édition'), (2, 'complet'), (3, 'terminé'), (4, 'démission')], verbose_name='état')),
+                ('date_maj', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date de mise à jour')),
+                ('candidat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inscrire.Candidat')),
+                ('formation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inscrire.Formation')),
+            ],
+            options={
+                'verbose_name': 'état de dossier',
+                'verbose_name_plural': 'états de dossier',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dossieretat',
+            index=models.Index(fields=['formation', 'etat'], name='inscrire_do_formati_19b22b_idx'),
+        ),
+        migrations.RunPython(remplit_dossiers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0047_dossieretat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TacheExport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('etat', models.PositiveSmallIntegerField(choices=[(1, 'en attente'), (2, 'en cours'), (3, 'terminée'), (4, 'abandonnée')], default=1)),
+                ('date_creation', models.DateTimeField(auto_now_add=True, verbose_name='date de création')),
+                ('prochaine_tentative', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('date_debut', models.DateTimeField(blank=True, null=True, verbose_name='début du traitement')),
+                ('date_fin', models.DateTimeField(blank=True, null=True, verbose_name='fin du traitement')),
+                ('tentatives', models.PositiveSmallIntegerField(default=0)),
+                ('erreur', models.TextField(blank=True, default='')),
+                ('format', models.PositiveSmallIntegerField(choices=[(1, 'CSV des candidats'), (2, 'classeur XLSX (candidats et responsables légaux)'), (3, 'archive ZIP (CSV et documents déposés)')], default=1)),
+                ('url_base', models.URLField(help_text='Adresse du site utilisée dans les liens vers les photos', max_length=300)),
+                ('avance', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('fichier', models.FileField(blank=True, upload_to='exports/')),
+                ('demandeur', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('etablissement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inscrire.Etablissement', verbose_name='établissement')),
+            ],
+            options={
+                'verbose_name': 'export',
+                'verbose_name_plural': 'exports',
+            },
+        ),
+    ]
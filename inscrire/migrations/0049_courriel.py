@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0048_tacheexport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Courriel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('etat', models.PositiveSmallIntegerField(choices=[(1, 'en attente'), (2, 'en cours'), (3, 'terminée'), (4, 'abandonnée')], default=1)),
+                ('date_creation', models.DateTimeField(auto_now_add=True, verbose_name='date de création')),
+                ('prochaine_tentative', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('date_debut', models.DateTimeField(blank=True, null=True, verbose_name='début du traitement')),
+                ('date_fin', models.DateTimeField(blank=True, null=True, verbose_name='fin du traitement')),
+                ('tentatives', models.PositiveSmallIntegerField(default=0)),
+                ('erreur', models.TextField(blank=True, default='')),
+                ('expediteur', models.CharField(max_length=300, verbose_name='expéditeur')),
+                ('destinataires', models.TextField(help_text='Une adresse par ligne')),
+                ('copie', models.TextField(blank=True, default='', help_text='Une adresse par ligne')),
+                ('repondre_a', models.TextField(blank=True, default='', help_text='Une adresse par ligne', verbose_name='répondre à')),
+                ('sujet', models.CharField(max_length=300)),
+                ('message', models.TextField()),
+                ('message_html', models.TextField(blank=True, default='', verbose_name='message HTML')),
+                ('candidat', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inscrire.Candidat')),
+                ('envoi', models.OneToOneField(blank=True, help_text="Envoi de mailing à l'origine de ce message", null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='courriel', to='inscrire.Envoi')),
+            ],
+            options={
+                'verbose_name': 'e-mail',
+                'verbose_name_plural': 'e-mails',
+            },
+        ),
+    ]
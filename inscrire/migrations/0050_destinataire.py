@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def remplit_destinataires(apps, schema_editor):
+    """
+    Les candidats ayant déjà reçu un mailing forment sa liste d'envoi
+    """
+    Envoi = apps.get_model('inscrire', 'Envoi')
+    Destinataire = apps.get_model('inscrire', 'Destinataire')
+    Destinataire.objects.bulk_create([
+        Destinataire(mailing_id=mailing, candidat_id=candidat, en_file=True)
+        for mailing, candidat in Envoi.objects.values_list(
+            'mailing', 'candidat').distinct()], batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0049_courriel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Destinataire',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('en_file', models.BooleanField(default=False)),
+                ('candidat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inscrire.Candidat')),
+                ('mailing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='destinataires', to='inscrire.Mailing')),
+            ],
+            options={
+                'unique_together': {('mailing', 'candidat')},
+            },
+        ),
+        migrations.RunPython(remplit_destinataires, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:42
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0050_destinataire'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='parcoursupuser',
+            name='debit_max',
+            field=models.FloatField(default=10, help_text='Nombre maximal de requêtes envoyées à Parcoursup par seconde', validators=[django.core.validators.MinValueValidator(0.01)], verbose_name='débit maximal'),
+        ),
+    ]
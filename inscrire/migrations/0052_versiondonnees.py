@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0051_parcoursupuser_debit_min'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionDonnees',
+            fields=[
+                ('nom', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('numero', models.PositiveIntegerField(default=0, verbose_name='numéro')),
+            ],
+            options={
+                'verbose_name': 'version de données',
+                'verbose_name_plural': 'versions de données',
+            },
+        ),
+    ]
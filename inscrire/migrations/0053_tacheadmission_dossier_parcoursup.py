@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:14
+
+import json
+
+from django.db import migrations, models
+
+
+def remplit_dossiers(apps, schema_editor):
+    """
+    Le numéro de dossier des admissions existantes est lu dans les
+    données reçues de Parcoursup
+    """
+    TacheAdmission = apps.get_model('inscrire', 'TacheAdmission')
+    for tache in TacheAdmission.objects.all():
+        donnees = {cle.lower(): valeur
+                for cle, valeur in json.loads(tache.donnees).items()}
+        try:
+            tache.dossier_parcoursup = int(donnees['codecandidat'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        tache.save(update_fields=['dossier_parcoursup'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0052_versiondonnees'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tacheadmission',
+            name='dossier_parcoursup',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='numéro Parcoursup'),
+        ),
+        migrations.RunPython(remplit_dossiers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:20
+
+import os
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+from django.utils.crypto import get_random_string
+import inscrire.models.exports
+
+
+def deplace_exports(apps, schema_editor):
+    """
+    Les exports déjà produits quittent MEDIA_ROOT, où ils étaient
+    publiés sous un nom prévisible
+    """
+    TacheExport = apps.get_model('inscrire', 'TacheExport')
+    stockage = inscrire.models.exports.StockageExports()
+    for tache in TacheExport.objects.exclude(fichier=''):
+        ancien = tache.fichier.name
+        racine, extension = os.path.splitext(os.path.basename(ancien))
+        try:
+            source = default_storage.open(ancien, 'rb')
+        except FileNotFoundError:
+            tache.fichier.name = ''
+        else:
+            with source:
+                tache.fichier.name = stockage.save('{}_{}{}'.format(racine,
+                    get_random_string(16), extension), source)
+            default_storage.delete(ancien)
+        tache.save(update_fields=['fichier'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inscrire', '0053_tacheadmission_dossier_parcoursup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tacheexport',
+            name='fichier',
+            field=models.FileField(blank=True, storage=inscrire.models.exports.StockageExports(), upload_to=''),
+        ),
+        migrations.RunPython(deplace_exports, migrations.RunPython.noop),
+    ]
@@ -21,11 +21,15 @@ from .personnes import Personne, Candidat, ResponsableLegal, \
 		CandidatActionLog, Commune, Pays, Profession
 from .formation import Etablissement, Formation, MefMatiere, MefOption, \
 		PieceJustificative, ChampExclu, Classement
+from .taches import Tache
 from .parcoursup import ParcoursupUserManager, ParcoursupUser, \
 		ParcoursupMessageRecuLog, ParcoursupMessageEnvoyeLog, \
-		Voeu, HistoriqueVoeu, EtatVoeu
+		TacheAdmission, Voeu, HistoriqueVoeu, EtatVoeu, DossierEtat
 from .fiches import Fiche, FicheIdentite, FicheScolarite, \
 		FicheHebergement, FicheScolariteAnterieure, BulletinScolaire, \
 		FicheBourse, FicheReglement, FicheInternat, FicheCesure, \
 		FichePieceJustificative, FichePieceJustificativeSuivi, EnteteFiche
-from .mailing import Mailing, Envoi
+from .courriels import Courriel
+from .mailing import Mailing, Envoi, Destinataire
+from .exports import TacheExport
+from .versions import VersionDonnees
@@ -0,0 +1,154 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+File d'envoi des e-mails
+
+Aucun e-mail n'est envoyé pendant le traitement d'une requête : les
+messages sont enregistrés en base puis remis au serveur SMTP par la
+commande traite_courriels.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import models
+from django.utils import timezone
+
+from .taches import Tache
+from .personnes import Candidat
+
+def _adresses(adresses):
+	"""Liste d'adresses, stockée une par ligne"""
+	if isinstance(adresses, str):
+		adresses = (adresses,)
+	return "\n".join(adresses)
+
+class CourrielManager(models.Manager):
+	def preparer(self, sujet, message, expediteur, destinataires, copie=(),
+			repondre_a=(), message_html="", **kwargs):
+		"""
+		Renvoie un e-mail prêt à être mis en file, sans l'enregistrer
+		(pour une création en bloc). Les paramètres reprennent ceux de
+		django.core.mail.send_mail.
+		"""
+		return self.model(sujet=sujet, message=message,
+				expediteur=expediteur,
+				destinataires=_adresses(destinataires),
+				copie=_adresses(copie),
+				repondre_a=_adresses(repondre_a),
+				message_html=message_html or "", **kwargs)
+
+	def mettre_en_file(self, *args, **kwargs):
+		"""
+		Enregistre un e-mail à envoyer par la commande traite_courriels
+		"""
+		courriel = self.preparer(*args, **kwargs)
+		courriel.save()
+		return courriel
+
+class Courriel(Tache):
+	"""
+	E-mail en attente d'envoi, ou déjà envoyé.
+
+	Les e-mails sont remis par lots sur une même connexion SMTP. Le
+	nombre de messages remis par minute pour une même adresse
+	d'expédition est limité par le réglage COURRIELS_DEBIT_MAX : au-delà,
+	les messages sont reportés.
+	"""
+	expediteur = models.CharField(verbose_name="expéditeur", max_length=300)
+	destinataires = models.TextField(help_text="Une adresse par ligne")
+	copie = models.TextField(blank=True, default="",
+			help_text="Une adresse par ligne")
+	repondre_a = models.TextField(verbose_name="répondre à", blank=True,
+			default="", help_text="Une adresse par ligne")
+	sujet = models.CharField(max_length=300)
+	message = models.TextField()
+	message_html = models.TextField(verbose_name="message HTML", blank=True,
+			default="")
+	candidat = models.ForeignKey(Candidat, on_delete=models.SET_NULL,
+			blank=True, null=True)
+	envoi = models.OneToOneField('Envoi', on_delete=models.SET_NULL,
+			blank=True, null=True, related_name='courriel',
+			help_text="Envoi de mailing à l'origine de ce message")
+
+	objects = CourrielManager()
+
+	class Meta:
+		verbose_name = "e-mail"
+		verbose_name_plural = "e-mails"
+
+	def __str__(self):
+		return "{} ({})".format(self.sujet, self.get_etat_display())
+
+	def email(self, connection=None):
+		"""Renvoie le message Django correspondant"""
+		email = EmailMultiAlternatives(
+				subject=self.sujet,
+				body=self.message,
+				from_email=self.expediteur,
+				to=self.destinataires.splitlines(),
+				cc=self.copie.splitlines(),
+				reply_to=self.repondre_a.splitlines(),
+				connection=connection)
+		if self.message_html:
+			email.attach_alternative(self.message_html, 'text/html')
+		return email
+
+	def executer(self):
+		connexion = getattr(self, 'connexion', None)
+		if connexion is not None:
+			# Sans effet si la connexion du lot est déjà ouverte
+			connexion.open()
+		self.email(connexion).send()
+
+	@classmethod
+	def traiter_lot(cls, courriels):
+		"""
+		Envoie les e-mails donnés sur une même connexion SMTP, rouverte
+		après un échec. Les e-mails dont l'expéditeur a atteint son
+		débit maximal sont reportés.
+		"""
+		debit_max = getattr(settings, 'COURRIELS_DEBIT_MAX', 0)
+		envoyes = {}
+		if debit_max:
+			envoyes = dict(cls.objects.filter(etat=cls.ETAT_TERMINEE,
+				date_fin__gte=timezone.now() - datetime.timedelta(minutes=1)
+				).values('expediteur').annotate(nombre=models.Count('pk')
+				).values_list('expediteur', 'nombre'))
+
+		connexion = get_connection()
+		resultats = []
+		try:
+			for courriel in courriels:
+				if debit_max and envoyes.get(courriel.expediteur, 0) >= debit_max:
+					courriel.differer(60)
+					resultats.append(None)
+					continue
+				courriel.connexion = connexion
+				succes = courriel.traiter()
+				if succes:
+					envoyes[courriel.expediteur] = \
+							envoyes.get(courriel.expediteur, 0) + 1
+				else:
+					connexion.close()
+				resultats.append(succes)
+		finally:
+			connexion.close()
+		return resultats
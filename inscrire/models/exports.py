@@ -0,0 +1,222 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import io
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import models
+from django.utils.crypto import get_random_string
+from django.utils.deconstruct import deconstructible
+
+from .taches import Tache
+from .formation import Etablissement
+
+logger = logging.getLogger(__name__)
+
+def ecrire_csv(flux, entete, lignes):
+	"""
+	Écrit un fichier CSV (séparateur point-virgule, UTF-8) dans le flux
+	binaire donné, sans le fermer
+	"""
+	texte = io.TextIOWrapper(flux, encoding='utf-8', newline='')
+	writer = csv.writer(texte, delimiter=';')
+	writer.writerow(entete)
+	writer.writerows(lignes)
+	texte.flush()
+	texte.detach()
+
+@deconstructible
+class StockageExports(FileSystemStorage):
+	"""
+	Stockage des fichiers d'export dans EXPORTS_ROOT, hors de
+	MEDIA_ROOT : ils ne sont pas publiés par le serveur web et ne sont
+	servis que par la vue ExportTelechargementView.
+	"""
+	@property
+	def base_location(self):
+		return getattr(settings, 'EXPORTS_ROOT',
+				os.path.join(settings.BASE_DIR, 'exports'))
+
+	@property
+	def location(self):
+		return os.path.abspath(self.base_location)
+
+	def url(self, name):
+		raise ValueError("Les fichiers d'export n'ont pas d'adresse "
+				"publique")
+
+class TacheExport(Tache):
+	"""
+	Export des données des candidats admis dans les formations d'un
+	établissement, produit en arrière-plan par la commande
+	traite_exports.
+
+	Le fichier est écrit au fur et à mesure dans un fichier temporaire,
+	sans jamais charger l'ensemble des données en mémoire, puis
+	enregistré dans EXPORTS_ROOT sous un nom imprévisible. Les champs
+	avance et total permettent de suivre la progression depuis
+	l'interface.
+	"""
+	FORMAT_CSV = 1
+	FORMAT_XLSX = 2
+	FORMAT_ZIP = 3
+	FORMAT_CHOICES = (
+		(FORMAT_CSV, "CSV des candidats"),
+		(FORMAT_XLSX, "classeur XLSX (candidats et responsables légaux)"),
+		(FORMAT_ZIP, "archive ZIP (CSV et documents déposés)"),
+	)
+	EXTENSIONS = {
+		FORMAT_CSV: 'csv',
+		FORMAT_XLSX: 'xlsx',
+		FORMAT_ZIP: 'zip',
+	}
+	# Fréquence de mise à jour de l'avancement en base
+	PAS_AVANCEMENT = 100
+
+	etablissement = models.ForeignKey(Etablissement, on_delete=models.CASCADE,
+			verbose_name="établissement")
+	demandeur = models.ForeignKey(settings.AUTH_USER_MODEL,
+			on_delete=models.SET_NULL, blank=True, null=True)
+	format = models.PositiveSmallIntegerField(choices=FORMAT_CHOICES,
+			default=FORMAT_CSV)
+	url_base = models.URLField(max_length=300,
+			help_text="Adresse du site utilisée dans les liens vers les photos")
+	avance = models.PositiveIntegerField(default=0)
+	total = models.PositiveIntegerField(default=0)
+	fichier = models.FileField(storage=StockageExports(), blank=True)
+
+	class Meta:
+		verbose_name = "export"
+		verbose_name_plural = "exports"
+
+	def __str__(self):
+		return "Export n°{} {} ({})".format(self.pk, self.etablissement_id,
+				self.get_etat_display())
+
+	@property
+	def progression(self):
+		"""Avancement de l'export, en pourcentage"""
+		if self.etat == self.ETAT_TERMINEE:
+			return 100
+		if not self.total:
+			return 0
+		return min(100, 100 * self.avance // self.total)
+
+	def nom_telechargement(self):
+		"""Nom proposé au navigateur lors du téléchargement"""
+		return "admis_{uai}_{pk}.{extension}".format(
+				uai=self.etablissement_id, pk=self.pk,
+				extension=self.EXTENSIONS[self.format])
+
+	def nom_fichier(self):
+		"""Nom, imprévisible, du fichier dans le stockage des exports"""
+		return "admis_{uai}_{pk}_{aleatoire}.{extension}".format(
+				uai=self.etablissement_id, pk=self.pk,
+				aleatoire=get_random_string(16),
+				extension=self.EXTENSIONS[self.format])
+
+	def avancer(self, avance=None, total=None):
+		"""
+		Enregistre l'avancement sans toucher aux autres champs de la
+		tâche
+		"""
+		champs = {}
+		if avance is not None:
+			self.avance = champs['avance'] = avance
+		if total is not None:
+			self.total = champs['total'] = total
+		type(self).objects.filter(pk=self.pk).update(**champs)
+
+	def suivre(self, lignes):
+		"""
+		Renvoie les lignes données en mettant à jour l'avancement au fur
+		et à mesure
+		"""
+		for ligne in lignes:
+			yield ligne
+			avance = self.avance + 1
+			if avance % self.PAS_AVANCEMENT == 0:
+				self.avancer(avance=avance)
+			else:
+				self.avance = avance
+
+	def executer(self):
+		from inscrire.lib.exports import ExportAdmis
+
+		formations = self.etablissement.formation_set.order_by('nom')
+		export = ExportAdmis(formations,
+				lambda url: urljoin(self.url_base, url),
+				colonne_formation=True)
+		total = export.nombre()
+		if self.format == self.FORMAT_ZIP:
+			total += export.nombre_fichiers()
+		self.avancer(avance=0, total=total)
+
+		# Le fichier n'est confié au stockage qu'une fois complet : une
+		# relance ne laisse jamais d'export partiel téléchargeable
+		with tempfile.TemporaryFile() as fichier:
+			getattr(self, 'ecrire_' + self.EXTENSIONS[self.format])(
+					fichier, export)
+			nom = self.fichier.storage.save(self.nom_fichier(), File(fichier))
+		ancien = self.fichier.name
+		self.fichier.name = nom
+		if ancien:
+			self.fichier.storage.delete(ancien)
+		self.avancer(avance=self.total)
+
+	def ecrire_csv(self, fichier, export):
+		ecrire_csv(fichier, export.entete(), self.suivre(export.lignes()))
+
+	def ecrire_xlsx(self, fichier, export):
+		from inscrire.lib.xlsx import ClasseurXlsx
+
+		with ClasseurXlsx(fichier) as classeur:
+			classeur.ajouter_feuille("Candidats", itertools.chain(
+				[export.entete()], self.suivre(export.lignes())))
+			classeur.ajouter_feuille("Responsables légaux", itertools.chain(
+				[export.entete_responsables()], export.lignes_responsables()))
+
+	def ecrire_zip(self, fichier, export):
+		with zipfile.ZipFile(fichier, 'w',
+				compression=zipfile.ZIP_DEFLATED) as archive:
+			with archive.open('candidats.csv', 'w') as flux:
+				self.ecrire_csv(flux, export)
+			with archive.open('responsables.csv', 'w') as flux:
+				ecrire_csv(flux, export.entete_responsables(),
+						export.lignes_responsables())
+			# Les documents sont copiés par blocs depuis le stockage,
+			# sans être chargés entièrement en mémoire
+			for nom in self.suivre(export.fichiers()):
+				try:
+					source = default_storage.open(nom, 'rb')
+				except FileNotFoundError:
+					logger.warning("Export %s : fichier %s introuvable",
+							self.pk, nom)
+					continue
+				with source, archive.open(nom, 'w', force_zip64=True) as flux:
+					shutil.copyfileobj(source, flux)
@@ -26,14 +26,18 @@ import os
 from operator import or_
 from functools import reduce
 
-from django.db import models
+from django.db import models, connections
 from django.db.models import Q
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 from polymorphic.models import PolymorphicModel, PolymorphicManager
 import localflavor.generic.models as lfmodels
 
+from inscrire.lib.referentiel import referentiel
+from inscrire.lib.configuration import configurations
+
 from .personnes import Candidat, Commune, Pays, ResponsableLegal
 from .formation import MefOption, Formation, Etablissement, PieceJustificative
 
@@ -47,6 +51,89 @@ class FicheManager(PolymorphicManager):
 	Manager qui permet la création rapide de toutes les fiches pour un
 	candidat.
 	"""
+	@staticmethod
+	def _formation_actuelle(voeu):
+		"""
+		Formation rattachée aux fiches qui en dépendent (voir par
+		exemple FicheScolarite.save)
+		"""
+		if voeu.etat in (voeu.ETAT_ACCEPTE_AUTRES, voeu.ETAT_ACCEPTE_DEFINITIF):
+			return voeu.formation
+		return voeu.candidat.voeu_actuel.formation
+
+	def _nouvelle_fiche(self, fiche_kls, voeu, parcoursup, **kwargs):
+		"""
+		Construit, sans l'enregistrer, une nouvelle fiche de la classe
+		fiche_kls pour le vœu donné, avec ses valeurs initiales.
+		"""
+		fiche = fiche_kls(candidat=voeu.candidat, **kwargs)
+		# La clé du candidat peut avoir été renseignée telle que reçue
+		# de Parcoursup, sous forme de chaîne.
+		fiche.candidat_id = Candidat._meta.pk.to_python(fiche.candidat_id)
+		# Les fiches liées à une formation la déterminent normalement
+		# dans leur méthode save(), que l'insertion en bloc n'appelle
+		# pas.
+		if any(field.name == 'formation'
+				for field in fiche_kls._meta.local_fields):
+			fiche.formation = self._formation_actuelle(voeu)
+		if parcoursup:
+			fiche.init_from_parcoursup(parcoursup)
+		return fiche
+
+	def _inserer(self, fiches):
+		"""
+		Insertion en bloc de nouvelles fiches, de classes quelconques
+		héritées de Fiche, concernant des candidats distincts (au plus
+		une fiche de chaque classe par candidat).
+
+		Les lignes de la table Fiche sont insérées d'un bloc, puis
+		celles de la table de chaque sous-classe.
+		"""
+		if not fiches:
+			return
+		connection = connections[self.db]
+
+		for fiche in fiches:
+			fiche.pre_save_polymorphic(using=self.db)
+		parents = [Fiche(candidat_id=fiche.candidat_id, valide=fiche.valide,
+			etat=fiche.etat, polymorphic_ctype_id=fiche.polymorphic_ctype_id)
+			for fiche in fiches]
+
+		if connection.features.can_return_ids_from_bulk_insert:
+			Fiche.objects.db_manager(self.db).bulk_create(parents)
+			pks = [parent.pk for parent in parents]
+		else:
+			# Sans récupération des clés primaires lors d'une insertion
+			# en bloc, les lignes sont insérées une par une : les
+			# retrouver après coup d'après le candidat et la classe
+			# pourrait confondre des lignes insérées au même moment par
+			# un autre processus.
+			fields = [field for field in Fiche._meta.local_concrete_fields
+				if field is not Fiche._meta.auto_field]
+			pks = [Fiche._base_manager._insert([parent], fields=fields,
+				return_id=True, using=self.db) for parent in parents]
+
+		for fiche, parent in zip(fiches, parents):
+			fiche.date_modification = parent.date_modification
+		for fiche, pk in zip(fiches, pks):
+			setattr(fiche, Fiche._meta.pk.attname, pk)
+			fiche.pk = pk
+
+		par_classe = {}
+		for fiche in fiches:
+			par_classe.setdefault(type(fiche), []).append(fiche)
+		for fiche_kls, fiches_kls in par_classe.items():
+			fields = fiche_kls._meta.local_concrete_fields
+			taille_lot = connection.ops.bulk_batch_size(fields, fiches_kls) \
+					or len(fiches_kls)
+			for debut in range(0, len(fiches_kls), taille_lot):
+				fiche_kls._base_manager._insert(
+						fiches_kls[debut:debut + taille_lot],
+						fields=fields, using=self.db)
+		for fiche in fiches:
+			fiche._state.adding = False
+			fiche._state.db = self.db
+
 	def create_applicable(self, voeu, **kwargs):
 		"""
 		Méthode qui crée toutes les classes héritées de Fiche, parmi
@@ -54,15 +141,14 @@ class FicheManager(PolymorphicManager):
 		applicables au voeu donné (vérifié avec la méthode de classe
 		applicable).
 		"""
-		fiches = []
 		parcoursup = kwargs.pop('parcoursup', {})
-		for fiche_kls in filter(lambda kls: kls.applicable(voeu),
-				all_fiche):
-			fiche = fiche_kls(candidat=voeu.candidat, **kwargs)
-			if parcoursup:
-				fiche.update_from_parcoursup(parcoursup)
-			fiche.save()
-			fiches.append(fiche)
+		fiches = [self._nouvelle_fiche(fiche_kls, voeu, parcoursup, **kwargs)
+				for fiche_kls in all_fiche if fiche_kls.applicable(voeu)]
+		self._inserer(fiches)
+		if parcoursup:
+			for fiche_kls in set(map(type, fiches)):
+				fiche_kls.post_init_from_parcoursup(
+						[fiche for fiche in fiches if type(fiche) is fiche_kls])
 		return fiches
 
 	def create_or_update_applicable(self, voeu, **kwargs):
@@ -85,58 +171,114 @@ class FicheManager(PolymorphicManager):
 		vaut True quand la fiche est nouvelle et False quand elle a
 		juste été mise à jour.
 		"""
-		fiches = []
 		parcoursup = kwargs.pop('parcoursup', {})
+		return self.create_or_update_applicable_lot([(voeu, parcoursup)],
+				**kwargs)[voeu.candidat_id]
 
-		fiches_applicables = dict([(kls, None)
-			for kls in filter(lambda kls: kls.applicable(voeu), all_fiche)])
-
-		# On commence par recycler les fiches existantes
-		for fiche in Fiche.objects.filter(candidat=voeu.candidat):
-			if type(fiche) in fiches_applicables:
-				if fiche.recyclable(voeu):
-					fiches_applicables[type(fiche)] = fiche
-
-					# On remet la fiche en mode édition
-					# CORRECTIF : il ne faut pas remettre la fiche en mode édition
-					# car PS est susceptible de renvoyer le même voeu
-					# lorsque qu'on utilise "Relancer" (ce qui est parfois nécessaire
-					# pour quand certain candidats en Oui définitif
-					# ne sont pas "spontanément ajoutés" à l'interface synchrone)
-					# un candidat qui a complété son dossier
-					#if fiche.etat in (Fiche.ETAT_CONFIRMEE,
-					#		Fiche.ETAT_ANNULEE):
-					#	fiche.etat = Fiche.ETAT_EDITION
-					#	fiche.save()
-
-					fiches.append((fiche, False))
+	def create_or_update_applicable_lot(self, voeux, **kwargs):
+		"""
+		Version en bloc de create_or_update_applicable, qui traite une
+		liste de couples (voeu, parcoursup) concernant des candidats
+		distincts. Les données parcoursup peuvent être vides.
+
+		Les fiches existantes de tous les candidats sont chargées en une
+		fois. Les fiches manquantes sont construites directement avec
+		leurs valeurs initiales issues de Parcoursup, puis insérées par
+		lots : chaque nouvelle fiche n'est ainsi écrite qu'une seule
+		fois.
+
+		Renvoie un dictionnaire qui associe à la clé primaire de chaque
+		candidat la liste de couples (fiche, created) décrite dans
+		create_or_update_applicable.
+
+		L'état des dossiers des candidats (DossierEtat) est mis à jour en
+		conséquence.
+		"""
+		from .parcoursup import DossierEtat # Import ici, sinon dépendance circulaire
+		with DossierEtat.objects.differer():
+			resultat = self._create_or_update_applicable_lot(voeux, **kwargs)
+			for voeu, _ in voeux:
+				DossierEtat.objects.signaler(voeu.candidat_id)
+		return resultat
+
+	def _create_or_update_applicable_lot(self, voeux, **kwargs):
+		candidat_pk = Candidat._meta.pk.to_python
+		existantes = {}
+		for fiche in self.filter(candidat__in=[voeu.candidat_id
+				for voeu, _ in voeux]):
+			existantes.setdefault(fiche.candidat_id, []).append(fiche)
+
+		resultat = {}
+		annulees = []
+		nouvelles = []
+		for voeu, parcoursup in voeux:
+			fiches = []
+			fiches_applicables = dict([(kls, None)
+				for kls in filter(lambda kls: kls.applicable(voeu), all_fiche)])
+
+			# On commence par recycler les fiches existantes
+			for fiche in existantes.get(candidat_pk(voeu.candidat_id), []):
+				if type(fiche) in fiches_applicables:
+					if fiche.recyclable(voeu):
+						fiches_applicables[type(fiche)] = fiche
+
+						# On remet la fiche en mode édition
+						# CORRECTIF : il ne faut pas remettre la fiche en mode édition
+						# car PS est susceptible de renvoyer le même voeu
+						# lorsque qu'on utilise "Relancer" (ce qui est parfois nécessaire
+						# pour quand certain candidats en Oui définitif
+						# ne sont pas "spontanément ajoutés" à l'interface synchrone)
+						# un candidat qui a complété son dossier
+						#if fiche.etat in (Fiche.ETAT_CONFIRMEE,
+						#		Fiche.ETAT_ANNULEE):
+						#	fiche.etat = Fiche.ETAT_EDITION
+						#	fiche.save()
+
+						fiches.append((fiche, False))
+					else:
+						# L'ancienne fiche ne peut pas servir, on en
+						# créera une nouvelle à la fin de la fonction.
+						# Pour l'instant, on marque l'actuelle comme
+						# étant annulée.
+						annulees.append(fiche)
 				else:
-					# L'ancienne fiche ne peut pas servir, on en créera
-					# une nouvelle à la fin de la fonction. Pour
-					# l'instant, on marque l'actuelle comme étant
-					# annulée.
-					fiche.etat = Fiche.ETAT_ANNULEE
-					fiche.save()
-			else:
-				# Il existe une fiche qui n'est pas applicable, on
-				# l'annule.
-				fiche.etat = Fiche.ETAT_ANNULEE
-				fiche.save()
+					# Il existe une fiche qui n'est pas applicable, on
+					# l'annule.
+					annulees.append(fiche)
 
-		# On crée enfin les instances manquantes
-		for fiche_kls in fiches_applicables:
-			if fiches_applicables[fiche_kls] is None:
-				fiche = fiche_kls(candidat=voeu.candidat, **kwargs)
-				fiche.save()
-				fiches.append((fiche, True))
+			# Mise à jour des fiches recyclées depuis Parcoursup si
+			# nécessaire.
+			if parcoursup:
+				for (fiche, _) in fiches:
+					fiche.update_from_parcoursup(parcoursup)
+
+			# On prépare enfin les instances manquantes
+			for fiche_kls in fiches_applicables:
+				if fiches_applicables[fiche_kls] is None:
+					fiche = self._nouvelle_fiche(fiche_kls, voeu,
+							parcoursup, **kwargs)
+					nouvelles.append((fiche, parcoursup))
+					fiches.append((fiche, True))
+
+			resultat[voeu.candidat_id] = fiches
+
+		if annulees:
+			maintenant = timezone.now()
+			self.filter(pk__in=[fiche.pk for fiche in annulees]).update(
+					etat=Fiche.ETAT_ANNULEE, date_modification=maintenant)
+			for fiche in annulees:
+				fiche.etat = Fiche.ETAT_ANNULEE
+				fiche.date_modification = maintenant
 
-		# Enfin, on met à jour les données depuis Parcoursup si
-		# nécessaire.
-		if parcoursup:
-			for (fiche, _) in fiches:
-				fiche.update_from_parcoursup(parcoursup)
+		self._inserer([fiche for fiche, _ in nouvelles])
+		par_classe = {}
+		for fiche, parcoursup in nouvelles:
+			if parcoursup:
+				par_classe.setdefault(type(fiche), []).append(fiche)
+		for fiche_kls, fiches_kls in par_classe.items():
+			fiche_kls.post_init_from_parcoursup(fiches_kls)
 
-		return fiches
+		return resultat
 
 
 class Fiche(PolymorphicModel):
@@ -211,6 +353,22 @@ class Fiche(PolymorphicModel):
 				Fiche.ETAT_ANNULEE: 'etat-annulee',
 			}.get(self.etat, '')
 
+	def init_from_parcoursup(self, parcoursup):
+		"""
+		Initialisation des champs à partir des données Parcoursup, sans
+		enregistrer la fiche (voir FicheManager.create_applicable)
+		"""
+		pass
+
+	@classmethod
+	def post_init_from_parcoursup(kls, fiches):
+		"""
+		Complète en bloc les fiches nouvellement insérées après
+		init_from_parcoursup, par exemple pour les relations
+		plusieurs-à-plusieurs qui exigent une clé primaire.
+		"""
+		pass
+
 	def update_from_parcoursup(self, parcoursup):
 		"""
 		Mise à jour des champs à partir des données Parcoursup
@@ -220,8 +378,9 @@ class Fiche(PolymorphicModel):
 	@property
 	def exclus(self):
 		"""champs exclus -> ne pas les prendre en compte dans valider()"""
-		etablissement = self.candidat.voeu_actuel.formation.etablissement
-		return etablissement.champs_exclus.filter(fiche = ContentType.objects.get_for_model(self)).values_list('champ', flat= True)
+		return configurations.get(
+				self.candidat.voeu_actuel.formation.etablissement_id
+				).champs_exclus(self)
 
 
 class FicheIdentite(Fiche):
@@ -280,44 +439,17 @@ class FicheIdentite(Fiche):
 			('pays_naissance' in exclus or self.pays_naissance is not None)
 		)
 
-	def update_from_parcoursup(self, parcoursup):
-		try:
-			self.ville = Commune.objects.get(
-					code_insee=parcoursup['candidat'].code_commune)
-		except:
-			pass
-
-		try:
-			# L'API Parcoursup dit que c'est le code ISO2 qui est
-			# renvoyé. Sauf qu'en pratique, c'est le numéro INSEE... On
-			# prend des précautions au cas où l'API change
-			# silencieusement un jour pour coller à la documentation.
-			if parcoursup['candidat'].code_pays.isdigit():
-				self.pays = Pays.objects.filter(
-						num_insee=int(parcoursup['candidat'].code_pays)).first()
-			else:
-				self.pays = Pays.objects.get(code_iso2=parcoursup['candidat'].code_pays)
-		except:
-			pass
-
-		try:
-			self.commune_naissance = Commune.objects.get(
-					code_insee=parcoursup['candidat'].commune_naissance)
-		except:
-			pass
-
-		try:
-			# L'API Parcoursup dit que c'est le code ISO2 qui est
-			# renvoyé. Sauf qu'en pratique, c'est le numéro INSEE... On
-			# prend des précautions au cas où l'API change
-			# silencieusement un jour pour coller à la documentation.
-			if parcoursup['candidat'].code_pays.isdigit():
-				self.pays_naissance = Pays.objects.filter(
-						num_insee=int(parcoursup['candidat'].pays_naissance)).first()
-			else:
-				self.pays_naissance = Pays.objects.get(code_iso2=parcoursup['candidat'].pays_naissance)
-		except:
-			pass
+	def init_from_parcoursup(self, parcoursup):
+		self.ville = referentiel.commune(parcoursup['candidat'].code_commune) \
+				or self.ville
+		self.pays = referentiel.pays(parcoursup['candidat'].code_pays) \
+				or self.pays
+		self.commune_naissance = referentiel.commune(
+				parcoursup['candidat'].commune_naissance) \
+				or self.commune_naissance
+		self.pays_naissance = referentiel.pays(
+				parcoursup['candidat'].pays_naissance) \
+				or self.pays_naissance
 
 		try:
 			self.adresse = parcoursup['candidat'].adresse
@@ -329,6 +461,21 @@ class FicheIdentite(Fiche):
 		except:
 			pass
 
+	@classmethod
+	def post_init_from_parcoursup(kls, fiches):
+		responsables = {}
+		for responsable in ResponsableLegal.objects.filter(
+				candidat__in=[fiche.candidat_id for fiche in fiches]):
+			responsables.setdefault(responsable.candidat_id, []).append(responsable)
+		kls.responsables.through.objects.bulk_create([
+			kls.responsables.through(ficheidentite_id=fiche.pk,
+				responsablelegal_id=responsable.pk)
+			for fiche in fiches
+			for responsable in responsables.get(fiche.candidat_id, [])])
+
+	def update_from_parcoursup(self, parcoursup):
+		self.init_from_parcoursup(parcoursup)
+
 		if not self.responsables.all():
 			self.responsables.set(self.candidat.responsables.all())
 
@@ -370,18 +517,17 @@ class FicheScolariteAnterieure(Fiche):
 				and bool(self.bulletinscolaire_set.all())
 			)
 
-	def update_from_parcoursup(self, parcoursup):
-		try:
-			self.etablissement = Etablissement.objects.get(
-					numero_uai=parcoursup['candidat'].etablissement_origine_uai)
-		except:
-			pass
+	def init_from_parcoursup(self, parcoursup):
+		if referentiel.uai_connu(parcoursup['candidat'].etablissement_origine_uai):
+			self.etablissement_id = parcoursup['candidat'].etablissement_origine_uai.upper()
 
-		if self.etablissement is None and parcoursup['candidat'].etablissement_origine_nom:
+		if self.etablissement_id is None and parcoursup['candidat'].etablissement_origine_nom:
 			self.autre_formation = parcoursup['candidat'].etablissement_origine_nom
 
 		self.specialite_terminale = parcoursup['candidat'].bac_serie or ''
 
+	def update_from_parcoursup(self, parcoursup):
+		self.init_from_parcoursup(parcoursup)
 		self.save()
 
 class BulletinScolaire(models.Model):
@@ -580,9 +726,12 @@ class FicheHebergement(Fiche):
 	def valider(self):
 		self.valide = self.regime is not None
 
-	def update_from_parcoursup(self, parcoursup):
+	def init_from_parcoursup(self, parcoursup):
 		if parcoursup['proposition'].internat:
 			self.regime = self.REGIME_INTERNE
+
+	def update_from_parcoursup(self, parcoursup):
+		self.init_from_parcoursup(parcoursup)
 		self.save()
 
 class FicheInternat(Fiche):
@@ -15,7 +15,6 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import ast
 from operator import or_
 from functools import reduce
 
@@ -107,11 +106,18 @@ class Etablissement(models.Model):
 				voeu__etat__in=(Voeu.ETAT_ACCEPTE_AUTRES,
 					Voeu.ETAT_ACCEPTE_DEFINITIF))
 
+	@property
+	def configuration(self):
+		"""Instantané de la configuration de l'établissement (voir
+		inscrire.lib.configuration)"""
+		from inscrire.lib.configuration import configurations
+		return configurations.get(self.pk)
+
 	@cached_property
 	def types_fiches_a_valider_candidats(self):
 		"""liste des types de fiches à valider par les candidats"""
 		from .fiches import all_fiche_validation_candidat
-		return [fiche for fiche in all_fiche_validation_candidat if ContentType.objects.get_for_model(fiche) in self.fiches.all()]
+		return self.configuration.types_fiches(all_fiche_validation_candidat)
 
 	@cached_property
 	def fiches_a_valider_candidats(self):
@@ -127,7 +133,7 @@ class Etablissement(models.Model):
 	def types_fiches_a_valider_lycee(self):
 		"""liste des types de fiches à valider par les candidats ou l"établissement"""
 		from .fiches import all_fiche
-		return [fiche for fiche in all_fiche if ContentType.objects.get_for_model(fiche) in self.fiches.all()]
+		return self.configuration.types_fiches(all_fiche)
 
 
 	@cached_property
@@ -171,41 +177,44 @@ class Etablissement(models.Model):
 			[models.Q(**{"{}__etat".format(fiche._meta.model_name):Fiche.ETAT_TERMINEE})
 				for fiche in self.types_fiches_a_valider_lycee]))
 
+	def candidats_etat(self, etat):
+		"""Candidats dont le dossier est dans l'état donné (voir
+		DossierEtat)"""
+		return Candidat.objects.filter(dossieretat__formation__etablissement=self,
+				dossieretat__etat=etat).distinct()
+
 	def candidats_etat_edition(self):
 		"""Candidats dont au moins une fiche à valider
 		par leurs soins est en etat édition"""
-		return self.candidats.filter(fiche__in=self.fiches_edition_candidats).distinct()
+		from .parcoursup import DossierEtat
+		return self.candidats_etat(DossierEtat.ETAT_EDITION)
 
 	def candidats_etat_complet(self):
 		"""Candidats dont
 		- aucune fiche qu'il doit valider n'est en etat édition
 		- au moins une fiche (editable par le candidat ou non) n'est pas terminée."""
-		return self.candidats.exclude(fiche__in=self.fiches_edition_candidats).filter(
-			fiche__in=self.fiches_non_terminees_lycee).distinct()
+		from .parcoursup import DossierEtat
+		return self.candidats_etat(DossierEtat.ETAT_COMPLET)
 
 	def candidats_etat_termine(self):
 		"""Candidats dont toutes les fiches sont dans l'état terminé"""
-		return self.candidats.exclude(models.Q(fiche__in=self.fiches_non_terminees_lycee)).distinct()
+		from .parcoursup import DossierEtat
+		return self.candidats_etat(DossierEtat.ETAT_TERMINE)
 
 	def candidats_etat_demission(self):
-		from .parcoursup import Voeu
-		voeux_demissionnes=Voeu.objects.filter(formation__etablissement=self, etat=Voeu.ETAT_REFUSE)
-		return Candidat.objects.filter(voeu__in = voeux_demissionnes)
+		from .parcoursup import DossierEtat
+		return self.candidats_etat(DossierEtat.ETAT_DEMISSION)
 
-	def confirme_inscription_administrative(self):
+	def confirme_inscription_administrative(self, concurrence=None):
 		"""Confirme à Parcoursup l'inscription administrative des candidats
-		de l'établissement dans l'état terminé"""
-		parcoursupuser = self.parcoursupuser
-		for candidat in self.candidats_etat_termine().filter(
-			inscription_administrative_confirmee=False):
-			reponse=parcoursupuser.set_inscription(candidat)
-			if reponse.status_code==200:
-				str_reponse=reponse.content.decode("UTF-8")
-				dict_reponse=ast.literal_eval(str_reponse)
-				if dict_reponse['retour']=="OK":
-					candidat.inscription_administrative_confirmee=True
-					candidat.inscription_administrative_message=dict_reponse['message']
-					candidat.save()
+		de l'établissement dans l'état terminé.
+
+		Renvoie la liste des résultats par candidat (voir
+		ParcoursupUser.confirme_inscriptions)."""
+		return self.parcoursupuser.confirme_inscriptions(
+			self.candidats_etat_termine().filter(
+				inscription_administrative_confirmee=False),
+			concurrence=concurrence)
 
 
 class Formation(models.Model):
@@ -261,26 +270,33 @@ class Formation(models.Model):
 				voeu__etat__in=(Voeu.ETAT_ACCEPTE_AUTRES,
 					Voeu.ETAT_ACCEPTE_DEFINITIF))
 
+	def candidats_etat(self, etat):
+		"""Candidats dont le dossier est dans l'état donné (voir
+		DossierEtat)"""
+		return Candidat.objects.filter(dossieretat__formation=self,
+				dossieretat__etat=etat)
+
 	def candidats_etat_edition(self):
 		"""Candidats dont au moins une fiche à valider
 		par leurs soins est en etat édition"""
-		return self.candidats().filter(fiche__in=self.etablissement.fiches_edition_candidats).distinct()
+		from .parcoursup import DossierEtat
+		return self.candidats_etat(DossierEtat.ETAT_EDITION)
 
 	def candidats_etat_complet(self):
 		"""Candidats dont
 		- aucune fiche qu'il doit valider n'est en etat édition
 		- au moins une fiche (editable par le candidat ou non) n'est pas terminée."""
-		return self.candidats().exclude(fiche__in=self.etablissement.fiches_edition_candidats).filter(
-			fiche__in=self.etablissement.fiches_non_terminees_lycee).distinct()
+		from .parcoursup import DossierEtat
+		return self.candidats_etat(DossierEtat.ETAT_COMPLET)
 
 	def candidats_etat_termine(self):
 		"""Candidats dont toutes les fiches sont dans l'état terminé"""
-		return self.candidats().exclude(models.Q(fiche__in=self.etablissement.fiches_non_terminees_lycee)).distinct()
+		from .parcoursup import DossierEtat
+		return self.candidats_etat(DossierEtat.ETAT_TERMINE)
 
 	def candidats_etat_demission(self):
-		from .parcoursup import Voeu
-		voeux_demissionnes=Voeu.objects.filter(formation=self, etat=Voeu.ETAT_REFUSE)
-		return Candidat.objects.filter(voeu__in = voeux_demissionnes)
+		from .parcoursup import DossierEtat
+		return self.candidats_etat(DossierEtat.ETAT_DEMISSION)
 
 class MefMatiere(models.Model):
 	"""
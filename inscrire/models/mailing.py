@@ -1,7 +1,8 @@
-from django.db import models
-from django.core.mail import EmailMessage
+from django.conf import settings
+from django.db import models, transaction
 
-from inscrire.models import Formation, Etablissement, Candidat, ResponsableLegal, Voeu
+from inscrire.models import Formation, Etablissement, Candidat, ResponsableLegal, Voeu, \
+    Courriel
 
 class Mailing(models.Model):
     EDITION, COMPLET, TERMINE, DEMISSION = 1, 2, 3, 4
@@ -35,75 +36,156 @@ class Mailing(models.Model):
     message = models.TextField()
     candidats = models.ManyToManyField(Candidat, through='Envoi') # candidats à qui le mail a été envoyé
 
-    def send(self):
+    def destinataires_possibles(self):
+        """
+        Renvoie le queryset des candidats correspondant aux critères du
+        mailing.
+        """
+        # Les critères portant sur le vœu (formation, état, internat)
+        # s'appliquent au même vœu du candidat
+        voeux = Voeu.objects.all()
         if self.formation:
-            formation=self.formation
-            if self.etat_dossier==self.EDITION:
-                candidats=formation.candidats_etat_edition()
-            elif self.etat_dossier==self.COMPLET:
-                candidats=formation.candidats_etat_complet()
-            elif self.etat_dossier==self.TERMINE:
-                candidats=formation.candidats_etat_termine()
-            elif self.etat_dossier==self.DEMISSION:
-                candidats=formation.candidats_etat_demission()
-            else:
-                voeux = Voeu.objects.filter(formation = self.formation, etat=Voeu.ETAT_ACCEPTE_DEFINITIF)
-                candidats=Candidat.objects.filter(voeu__in = voeux)
+            voeux = voeux.filter(formation = self.formation)
+        else:
+            voeux = voeux.filter(formation__etablissement = self.etablissement)
+        if self.etat_dossier:
+            # Les états du mailing sont ceux de DossierEtat
+            voeux = voeux.filter(dossier__etat = self.etat_dossier)
         else:
-            etablissement=self.etablissement
-            if self.etat_dossier==self.EDITION:
-                candidats=etablissement.candidats_etat_edition()
-            elif self.etat_dossier==self.COMPLET:
-                candidats=etablissement.candidats_etat_complet()
-            elif self.etat_dossier==self.TERMINE:
-                candidats=etablissement.candidats_etat_termine()
-            elif self.etat_dossier==self.DEMISSION:
-                candidats=etablissement.candidats_etat_demission()
-            else:
-                voeux = Voeu.objects.filter(formation__etablissement = self.etablissement, etat=Voeu.ETAT_ACCEPTE_DEFINITIF)
-                candidats=Candidat.objects.filter(voeu__in = voeux)
+            voeux = voeux.filter(etat = Voeu.ETAT_ACCEPTE_DEFINITIF)
         if self.internat != None:
             voeux = voeux.filter(internat = self.internat)
-        # On n'envoie le mail qu'aux candidats qui ne l'ont pas déjà reçu
-        candidats = candidats.difference(self.candidats.all())
+
+        candidats = Candidat.objects.filter(pk__in = voeux.values('candidat'))
         if self.derniere_connexion_apres:
-            # candidats.filter(...) dysfonctionne !
-            candidats = candidats.intersection(Candidat.objects.filter(user__last_login__gte = self.derniere_connexion_apres))
+            candidats = candidats.filter(user__last_login__gte = self.derniere_connexion_apres)
         if self.derniere_connexion_avant:
-            candidats = candidats.intersection(Candidat.objects.filter(models.Q(user__last_login__isnull = True)|models.Q(user__last_login__lte = self.derniere_connexion_avant)))
+            candidats = candidats.filter(models.Q(user__last_login__isnull = True)|models.Q(user__last_login__lte = self.derniere_connexion_avant))
         if self.connexion != None:
-            if self.connexion:
-                candidats = candidats.intersection(Candidat.objects.filter(user__last_login__isnull = False))
-            else:
-                candidats = candidats.intersection(Candidat.objects.filter(user__last_login__isnull = True))
-        un_envoi = False
-        for candidat in candidats:
-            if self.copie_responsables:
-                cc = [responsable.email for responsable in candidat.responsables.all() if responsable.email]
-            else:
-                cc = []
-            email = EmailMessage(
-                subject=self.sujet,
-                body=self.message,
-                from_email = self.de,
-                to =[candidat.user.email,],
-                cc = cc,
-                reply_to = (self.repondre_a,)
-            )
-            ok = email.send()
-            if ok:
-                un_envoi = True
-                envoi = Envoi(mailing = self, candidat = candidat)
-                envoi.save()
-                if self.copie_responsables:
-                    envoi.responsables.add(*candidat.responsables.exclude(email="").exclude(email__isnull = True).values_list('id', flat=True))
-        if un_envoi:
+            candidats = candidats.filter(user__last_login__isnull = not self.connexion)
+        return candidats
+
+    def figer_destinataires(self):
+        """
+        Ajoute à la liste d'envoi les candidats correspondant aux critères
+        du mailing qui n'y figurent pas encore. Renvoie le nombre de
+        candidats ajoutés.
+        """
+        pks = list(self.destinataires_possibles().exclude(
+            pk__in = self.destinataires.values('candidat')
+            ).order_by('pk').values_list('pk', flat=True))
+        Destinataire.objects.bulk_create([Destinataire(mailing = self, candidat_id = pk)
+            for pk in pks], batch_size = 500)
+        return len(pks)
+
+    def send(self):
+        """
+        Complète la liste d'envoi puis met en file le message pour les
+        destinataires qui ne l'ont pas encore reçu.
+
+        La mise en file se fait par lots, chacun dans une transaction :
+        un envoi interrompu reprend là où il s'était arrêté lorsqu'on
+        relance send().
+        """
+        self.figer_destinataires()
+        taille_lot = getattr(settings, 'MAILING_TAILLE_LOT', 100)
+        while True:
+            with transaction.atomic():
+                lot = list(self.destinataires.filter(en_file = False
+                    ).order_by('pk').values_list('pk', 'candidat_id')[:taille_lot])
+                if not lot:
+                    break
+                pks = [pk for pk, candidat in lot]
+                if Destinataire.objects.filter(pk__in = pks, en_file = False
+                        ).update(en_file = True) != len(lot):
+                    # Lot réservé entre-temps par un autre envoi : on
+                    # annule et on recommence avec les destinataires restants
+                    transaction.set_rollback(True)
+                    continue
+                self.mettre_en_file_lot([candidat for pk, candidat in lot])
+        if self.brouillon and self.destinataires.exists():
             self.brouillon = False
             self.save()
 
+    @classmethod
+    def ajouter_progression(cls, mailings):
+        """
+        Évalue la liste de mailings donnée et ajoute à chacun les
+        attributs destinataires_total, destinataires_en_file, envoyes et
+        echecs, calculés en deux requêtes groupées.
+        """
+        mailings = list(mailings)
+        destinataires = {ligne['mailing']: ligne for ligne in
+            Destinataire.objects.filter(mailing__in = mailings
+                ).values('mailing').annotate(
+                    total = models.Count('pk'),
+                    en_file = models.Count('pk', filter = models.Q(en_file = True)))}
+        envois = {ligne['mailing']: ligne for ligne in
+            Envoi.objects.filter(mailing__in = mailings
+                ).values('mailing').annotate(
+                    # Les envois sans e-mail associé datent d'avant la
+                    # file d'envoi et sont partis immédiatement
+                    envoyes = models.Count('pk', filter = models.Q(courriel__isnull = True)
+                        | models.Q(courriel__etat = Courriel.ETAT_TERMINEE)),
+                    echecs = models.Count('pk', filter = models.Q(
+                        courriel__etat = Courriel.ETAT_ABANDONNEE)))}
+        for mailing in mailings:
+            mailing.destinataires_total = destinataires.get(mailing.pk, {}).get('total', 0)
+            mailing.destinataires_en_file = destinataires.get(mailing.pk, {}).get('en_file', 0)
+            mailing.envoyes = envois.get(mailing.pk, {}).get('envoyes', 0)
+            mailing.echecs = envois.get(mailing.pk, {}).get('echecs', 0)
+        return mailings
+
+    def mettre_en_file_lot(self, pks):
+        """
+        Met en file le message pour les candidats dont les clés primaires
+        sont données, et enregistre les envois correspondants.
+        """
+        candidats = list(Candidat.objects.filter(pk__in=pks).select_related('user'
+            ).prefetch_related(models.Prefetch('responsables',
+                queryset=ResponsableLegal.objects.exclude(email="").exclude(
+                    email__isnull=True))))
+        with transaction.atomic():
+            Envoi.objects.bulk_create([Envoi(mailing = self, candidat = candidat)
+                for candidat in candidats])
+            # bulk_create ne renvoie pas les clés primaires avec tous les
+            # moteurs de base de données : on les relit
+            envois = dict(Envoi.objects.filter(mailing = self,
+                candidat__in = candidats).values_list('candidat_id', 'pk'))
+            if self.copie_responsables:
+                Through = Envoi.responsables.through
+                Through.objects.bulk_create([
+                    Through(envoi_id = envois[candidat.pk], responsablelegal_id = responsable.pk)
+                    for candidat in candidats
+                    for responsable in candidat.responsables.all()])
+            Courriel.objects.bulk_create([Courriel.objects.preparer(
+                sujet = self.sujet,
+                message = self.message,
+                expediteur = self.de,
+                destinataires = [candidat.user.email,],
+                copie = [responsable.email for responsable in candidat.responsables.all()]
+                    if self.copie_responsables else [],
+                repondre_a = [self.repondre_a,],
+                candidat = candidat,
+                envoi_id = envois[candidat.pk]) for candidat in candidats])
+
 
 class Envoi(models.Model):
     mailing = models.ForeignKey(Mailing, on_delete = models.CASCADE)
     candidat = models.ForeignKey(Candidat, on_delete = models.CASCADE)
     date = models.DateTimeField(auto_now_add = True)
     responsables = models.ManyToManyField(ResponsableLegal) # responsables légaux à qui le mail à été envoyé
+
+class Destinataire(models.Model):
+    """
+    Liste d'envoi d'un mailing : candidats retenus lors de l'envoi, et
+    indication de la mise en file de leur message.
+    """
+    mailing = models.ForeignKey(Mailing, on_delete = models.CASCADE,
+        related_name = 'destinataires')
+    candidat = models.ForeignKey(Candidat, on_delete = models.CASCADE,
+        related_name = '+')
+    en_file = models.BooleanField(default = False)
+
+    class Meta:
+        unique_together = (('mailing', 'candidat'),)
@@ -16,21 +16,40 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import itertools
+import json
 import logging
+import threading
 import time
 
+import requests
+
 from django.utils import timezone
 from django.db import models, transaction
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.validators import MinValueValidator
 
 from inscrire.lib.parcoursup_rest import ParcoursupCandidat, \
-		ParcoursupRest, ParcoursupPersonne, ParcoursupProposition
-from .personnes import Candidat, Pays, Commune, ResponsableLegal
+		ParcoursupRest, ParcoursupPersonne, ParcoursupProposition, \
+		ParcoursupError, DEBIT_MIN
+from inscrire.lib.referentiel import referentiel
+from inscrire.lib.statistiques import invalider_statistiques
+from .personnes import Candidat, ResponsableLegal
 from .formation import Etablissement, Formation, Classement
 from .fiches import Fiche
+from .taches import Tache
 
 logger = logging.getLogger(__name__)
 
+# Résultat de l'envoi à Parcoursup de l'inscription d'un candidat
+ResultatConfirmation = namedtuple('ResultatConfirmation',
+		('candidat', 'succes', 'message'))
+
 class ParcoursupUserManager(models.Manager):
 	def authenticate(self, username, password):
 		"""
@@ -67,6 +86,19 @@ class ParcoursupUser(models.Model):
 	remontee_username = models.CharField(max_length=50)
 	remontee_password = models.CharField(max_length=128)
 
+	# Débit maximal des requêtes envoyées à Parcoursup pour cet
+	# établissement.
+	debit_max = models.FloatField(verbose_name="débit maximal",
+			default=ParcoursupRest.DEBIT_DEFAUT,
+			validators=[MinValueValidator(DEBIT_MIN)],
+			help_text="Nombre maximal de requêtes envoyées à Parcoursup "
+			"par seconde")
+	rafale_max = models.PositiveSmallIntegerField(
+			verbose_name="rafale maximale",
+			default=ParcoursupRest.RAFALE_DEFAUT,
+			help_text="Nombre de requêtes pouvant être envoyées d'un "
+			"coup avant que le débit maximal ne s'applique")
+
 	objects = ParcoursupUserManager()
 
 	class Meta:
@@ -81,10 +113,84 @@ class ParcoursupUser(models.Model):
 			self._parcoursup_rest = ParcoursupRest(
 					login=self.remontee_username,
 					password=self.remontee_password,
-					code_etablissement=self.etablissement.numero_uai)
+					code_etablissement=self.etablissement.numero_uai,
+					debit=self.debit_max,
+					rafale=self.rafale_max)
 		return self._parcoursup_rest
 
-	def import_candidat(self, psup):
+	@staticmethod
+	def _genre(sexe):
+		if sexe == ParcoursupPersonne.GENRE_HOMME:
+			return Candidat.GENRE_HOMME
+		elif sexe == ParcoursupPersonne.GENRE_FEMME:
+			return Candidat.GENRE_FEMME
+		return None
+
+	@staticmethod
+	def _etat_voeu(proposition):
+		return {
+				ParcoursupProposition.ETAT_ATTENTE: Voeu.ETAT_ATTENTE,
+				ParcoursupProposition.ETAT_ACCEPTEE_AUTRES_VOEUX: Voeu.ETAT_ACCEPTE_AUTRES,
+				ParcoursupProposition.ETAT_ACCEPTEE: Voeu.ETAT_ACCEPTE_DEFINITIF,
+				ParcoursupProposition.ETAT_REFUSEE: Voeu.ETAT_REFUSE,
+				}.get(proposition.etat)
+
+	@staticmethod
+	def _maj_bac(candidat, psup_candidat):
+		"""
+		Recopie les données transmises par Parcoursup qui sont mises à
+		jour à chaque import, même pour un candidat déjà connu.
+		"""
+		candidat.ine = psup_candidat.ine
+		candidat.bac_date = psup_candidat.bac_date
+		candidat.bac_serie = psup_candidat.bac_serie
+		candidat.bac_mention = {
+				'P': Candidat.BAC_MENTION_PASSABLE,
+				'AB': Candidat.BAC_MENTION_ASSEZBIEN,
+				'B': Candidat.BAC_MENTION_BIEN,
+				'TB': Candidat.BAC_MENTION_TRESBIEN,
+			}.get(psup_candidat.bac_mention)
+
+	@classmethod
+	def _responsables(kls, candidat, psup):
+		"""
+		Renvoie les instances (non enregistrées) des responsables
+		légaux transmis par Parcoursup.
+		"""
+		return [ResponsableLegal(
+				candidat=candidat,
+				genre=kls._genre(psup_resp.sexe),
+				last_name=psup_resp.nom,
+				first_name=psup_resp.prenom,
+				telephone=psup_resp.telephone_fixe or '',
+				telephone_mobile=psup_resp.telephone_mobile or '',
+				adresse=psup_resp.adresse,
+				email=psup_resp.email)
+			for psup_resp in psup['responsables']]
+
+	def admission_deja_traitee(self, psup, empreinte):
+		"""
+		Indique si les données d'admission psup, d'empreinte donnée,
+		sont identiques au dernier envoi appliqué pour ce vœu (ou à un
+		envoi encore en file d'attente), auquel cas il est inutile de
+		les importer à nouveau.
+
+		Le vœu doit en outre être encore dans l'état indiqué par
+		Parcoursup, sans quoi il a été modifié depuis chez nous et il
+		faut refaire l'import.
+		"""
+		if Voeu.objects.filter(
+				candidat__dossier_parcoursup=psup['candidat'].code,
+				formation__code_parcoursup=psup['proposition'].code_formation,
+				formation__etablissement=self.etablissement_id,
+				etat=self._etat_voeu(psup['proposition']),
+				empreinte_parcoursup=empreinte).exists():
+			return True
+		return TacheAdmission.objects.filter(user=self,
+				etat__in=(Tache.ETAT_ATTENTE, Tache.ETAT_EN_COURS),
+				message__empreinte=empreinte).exists()
+
+	def import_candidat(self, psup, empreinte=None):
 		"""
 		Import des données Parcoursup dans la base de données du serveur
 		d'inscription.
@@ -92,8 +198,15 @@ class ParcoursupUser(models.Model):
 		Renvoie l'instance du modèle Candidat correspondant au candidat.
 
 		Prend en paramètre un dictionnaire renvoyé par
-		ParcoursupRest.parse_parcoursup_admission.
+		ParcoursupRest.parse_parcoursup_admission, et éventuellement
+		l'empreinte des données brutes, conservée sur le vœu pour
+		reconnaître les envois identiques (voir
+		admission_deja_traitee).
 		"""
+		with DossierEtat.objects.differer():
+			return self._import_candidat(psup, empreinte)
+
+	def _import_candidat(self, psup, empreinte):
 		# Création ou mise à jour du candidat
 		creation = True
 		try:
@@ -114,27 +227,14 @@ class ParcoursupUser(models.Model):
 			candidat.telephone_mobile = psup['candidat'].telephone_mobile or ''
 			candidat.adresse = psup['candidat'].adresse
 			candidat.date_naissance = psup['candidat'].date_naissance
-			candidat.commune_naissance = Commune.objects.filter(code_insee=psup['candidat'].commune_naissance).first()
-			candidat.pays_naissance = Pays.objects.filter(code_iso2=psup['candidat'].pays_naissance).first()
-			candidat.nationalite = Pays.objects.filter(code_iso2=psup['candidat'].nationalite).first()
-		candidat.ine = psup['candidat'].ine
-		candidat.bac_date = psup['candidat'].bac_date
-		candidat.bac_serie = psup['candidat'].bac_serie
-		candidat.bac_mention = {
-				'P': Candidat.BAC_MENTION_PASSABLE,
-				'AB': Candidat.BAC_MENTION_ASSEZBIEN,
-				'B': Candidat.BAC_MENTION_BIEN,
-				'TB': Candidat.BAC_MENTION_TRESBIEN,
-			}.get(psup['candidat'].bac_mention)
+			candidat.commune_naissance = referentiel.commune(psup['candidat'].commune_naissance)
+			candidat.pays_naissance = referentiel.pays(psup['candidat'].pays_naissance)
+			candidat.nationalite = referentiel.pays(psup['candidat'].nationalite)
+		self._maj_bac(candidat, psup['candidat'])
 		candidat.save()
 
 		# Détermination du vœu concerné
-		etat_voeu = {
-				ParcoursupProposition.ETAT_ATTENTE: Voeu.ETAT_ATTENTE,
-				ParcoursupProposition.ETAT_ACCEPTEE_AUTRES_VOEUX: Voeu.ETAT_ACCEPTE_AUTRES,
-				ParcoursupProposition.ETAT_ACCEPTEE: Voeu.ETAT_ACCEPTE_DEFINITIF,
-				ParcoursupProposition.ETAT_REFUSEE: Voeu.ETAT_REFUSE,
-				}.get(psup['proposition'].etat)
+		etat_voeu = self._etat_voeu(psup['proposition'])
 
 		formation = Formation.objects.get(
 				code_parcoursup=psup['proposition'].code_formation,
@@ -142,7 +242,8 @@ class ParcoursupUser(models.Model):
 		voeu, voeu_created = Voeu.objects.get_or_create(
 				candidat=candidat,
 				formation=formation,
-				defaults={'etat': etat_voeu, 'internat': psup['proposition'].internat, 'cesure': psup['proposition'].cesure})
+				defaults={'etat': etat_voeu, 'internat': psup['proposition'].internat, 'cesure': psup['proposition'].cesure,
+					'empreinte_parcoursup': empreinte or ""})
 		if voeu.etat != etat_voeu or voeu.internat != psup['proposition'].internat or voeu.cesure != psup['proposition'].cesure:
 			HistoriqueVoeu(voeu=voeu, etat=etat_voeu,
 					date=timezone.now()).save()
@@ -156,44 +257,225 @@ class ParcoursupUser(models.Model):
 		# de mettre à jour manuellement les données dans son dossier
 		# d'inscription.
 		if not candidat.responsables.all():
-			for psup_resp in psup['responsables']:
-				if psup_resp.sexe == ParcoursupPersonne.GENRE_HOMME:
-					genre = Candidat.GENRE_HOMME
-				elif psup_resp.sexe == ParcoursupPersonne.GENRE_FEMME:
-					genre = Candidat.GENRE_FEMME
-				else:
-					genre = None
-				ResponsableLegal(
-						candidat=candidat,
-						genre=genre,
-						last_name=psup_resp.nom,
-						first_name=psup_resp.prenom,
-						telephone=psup_resp.telephone_fixe or '',
-						telephone_mobile=psup_resp.telephone_mobile or '',
-						adresse=psup_resp.adresse,
-						email=psup_resp.email
-					).save()
+			for responsable in self._responsables(candidat, psup):
+				responsable.save()
 
 		# Mise à jour des fiches d'inscription
 		Fiche.objects.create_or_update_applicable(voeu,
 				parcoursup=psup)
 
+		# L'empreinte n'est enregistrée qu'une fois l'import terminé
+		if empreinte is not None and voeu.empreinte_parcoursup != empreinte:
+			voeu.empreinte_parcoursup = empreinte
+			voeu.save(update_fields=['empreinte_parcoursup'])
+
 		return candidat
 
+	def _import_lot(self, lot):
+		"""
+		Import en bloc d'un lot de candidats, avec la même sémantique
+		que import_candidat appelée sur chacun d'eux.
+
+		Les candidats, vœux et données de référence du lot sont chargés
+		en quelques requêtes, et les écritures sont groupées. Cette
+		méthode lève une exception dès que le lot ne peut pas être
+		traité d'un bloc : l'appelant doit alors annuler la transaction
+		et reprendre les candidats un par un.
+
+		Renvoie la liste des candidats et le nombre de candidats créés.
+		"""
+		User = get_user_model()
+		codes = [int(psup['candidat'].code) for psup in lot]
+		if len(set(codes)) != len(codes):
+			raise ValueError("Un candidat apparaît plusieurs fois dans le lot")
+
+		formations = {formation.code_parcoursup: formation
+			for formation in Formation.objects.filter(
+				etablissement=self.etablissement,
+				code_parcoursup__in={psup['proposition'].code_formation
+					for psup in lot})}
+		if any(psup['proposition'].code_formation not in formations
+				for psup in lot):
+			raise Formation.DoesNotExist("Formation inconnue dans le lot")
+
+		existants = Candidat.objects.in_bulk(codes)
+		nouveaux = [psup for psup in lot
+				if int(psup['candidat'].code) not in existants]
+
+		# Création des comptes utilisateurs des nouveaux candidats
+		users = []
+		for psup in nouveaux:
+			user = User(email=User.objects.normalize_email(psup['candidat'].email),
+					first_name=psup['candidat'].prenom,
+					last_name=psup['candidat'].nom,
+					role=User.ROLE_ETUDIANT,
+					is_staff=False, is_superuser=False)
+			user.set_password(None)
+			users.append(user)
+		User.objects.bulk_create(users)
+		users_pk = dict(User.objects.filter(
+			email__in=[user.email for user in users]).values_list('email', 'pk'))
+
+		candidats = {}
+		crees = []
+		for psup, user in zip(nouveaux, users):
+			psup_candidat = psup['candidat']
+			candidat = Candidat(
+					first_name=psup_candidat.prenom,
+					last_name=psup_candidat.nom,
+					dossier_parcoursup=int(psup_candidat.code),
+					user_id=users_pk[user.email],
+					genre=Candidat.GENRE_HOMME
+						if psup_candidat.sexe == ParcoursupPersonne.GENRE_HOMME
+						else Candidat.GENRE_FEMME,
+					telephone=psup_candidat.telephone_fixe or '',
+					telephone_mobile=psup_candidat.telephone_mobile or '',
+					adresse=psup_candidat.adresse,
+					date_naissance=psup_candidat.date_naissance,
+					commune_naissance=referentiel.commune(psup_candidat.commune_naissance),
+					pays_naissance=referentiel.pays(psup_candidat.pays_naissance),
+					nationalite=referentiel.pays(psup_candidat.nationalite))
+			self._maj_bac(candidat, psup_candidat)
+			candidats[candidat.pk] = candidat
+			crees.append(candidat)
+		for psup in lot:
+			candidat = existants.get(int(psup['candidat'].code))
+			if candidat is not None:
+				self._maj_bac(candidat, psup['candidat'])
+				candidats[candidat.pk] = candidat
+		Candidat.objects.bulk_create(crees)
+		Candidat.objects.bulk_update(list(existants.values()),
+				['ine', 'bac_date', 'bac_serie', 'bac_mention'])
+
+		# Vœux
+		def voeux_du_lot():
+			return {(voeu.candidat_id, voeu.formation_id): voeu
+				for voeu in Voeu.objects.filter(candidat_id__in=codes,
+					formation__in=list(formations.values()))}
+		voeux = voeux_du_lot()
+		nouveaux_voeux = []
+		voeux_modifies = []
+		historiques = []
+		maintenant = timezone.now()
+		for psup in lot:
+			proposition = psup['proposition']
+			etat_voeu = self._etat_voeu(proposition)
+			formation = formations[proposition.code_formation]
+			voeu = voeux.get((int(psup['candidat'].code), formation.pk))
+			if voeu is None:
+				nouveaux_voeux.append(Voeu(candidat_id=int(psup['candidat'].code),
+					formation=formation, etat=etat_voeu,
+					internat=proposition.internat, cesure=proposition.cesure))
+			elif voeu.etat != etat_voeu or voeu.internat != proposition.internat \
+					or voeu.cesure != proposition.cesure:
+				historiques.append(HistoriqueVoeu(voeu=voeu, etat=etat_voeu,
+					date=maintenant))
+				voeu.etat, voeu.internat, voeu.cesure = etat_voeu, \
+						proposition.internat, proposition.cesure
+				voeux_modifies.append(voeu)
+		HistoriqueVoeu.objects.bulk_create(historiques)
+		Voeu.objects.bulk_update(voeux_modifies, ['etat', 'internat', 'cesure'])
+		Voeu.objects.bulk_create(nouveaux_voeux)
+		if nouveaux_voeux:
+			voeux = voeux_du_lot()
+
+		# Responsables légaux, uniquement pour les candidats qui n'en
+		# ont aucun (voir import_candidat)
+		avec_responsables = set(ResponsableLegal.objects.filter(
+			candidat_id__in=codes).values_list('candidat_id', flat=True))
+		responsables = []
+		for psup in lot:
+			code = int(psup['candidat'].code)
+			if code not in avec_responsables:
+				responsables.extend(self._responsables(candidats[code], psup))
+		ResponsableLegal.objects.bulk_create(responsables)
+
+		# Fiches d'inscription
+		voeux_fiches = []
+		for psup in lot:
+			code = int(psup['candidat'].code)
+			voeu = voeux[(code, formations[psup['proposition'].code_formation].pk)]
+			voeu.candidat = candidats[code]
+			voeu.formation = formations[psup['proposition'].code_formation]
+			voeux_fiches.append((voeu, psup))
+		Fiche.objects.create_or_update_applicable_lot(voeux_fiches)
+
+		return [candidats[code] for code in codes], len(crees)
+
+	def import_candidats(self, psups, taille_lot=None):
+		"""
+		Import en bloc des candidats renvoyés par
+		ParcoursupRest.parse_parcoursup_admission (liste ou générateur,
+		lu au fur et à mesure).
+
+		Les candidats sont traités par lots de taille_lot (par défaut,
+		la valeur du réglage PARCOURSUP_IMPORT_LOT), chacun dans une
+		transaction. Si un lot échoue, ses candidats sont repris un par
+		un avec import_candidat, afin qu'une erreur sur un candidat
+		n'empêche pas l'import des autres.
+
+		Renvoie un dictionnaire qui résume l'import :
+		- candidats : liste des candidats importés,
+		- crees : nombre de candidats créés,
+		- erreurs : nombre de candidats qui n'ont pas pu être importés,
+		- echecs : couples (données du candidat, message d'erreur) des
+		  candidats qui n'ont pas pu être importés,
+		- duree : durée de l'import, en secondes,
+		- debit : nombre de candidats traités par seconde.
+		"""
+		if taille_lot is None:
+			taille_lot = getattr(settings, 'PARCOURSUP_IMPORT_LOT', 200)
+		psups = iter(psups)
+		nombre = 0
+		debut = time.monotonic()
+		rapport = {'candidats': [], 'crees': 0, 'erreurs': 0, 'echecs': []}
+
+		while True:
+			lot = list(itertools.islice(psups, taille_lot))
+			if not lot:
+				break
+			nombre += len(lot)
+			try:
+				with transaction.atomic():
+					candidats, crees = self._import_lot(lot)
+				rapport['candidats'].extend(candidats)
+				rapport['crees'] += crees
+				continue
+			except Exception:
+				logger.exception("Erreur à l'importation d'un lot de "
+					"candidats depuis Parcoursup, reprise candidat par "
+					"candidat")
+
+			for psup in lot:
+				try:
+					with transaction.atomic():
+						creation = not Candidat.objects.filter(
+								pk=psup['candidat'].code).exists()
+						rapport['candidats'].append(self.import_candidat(psup))
+						rapport['crees'] += creation
+				except Exception as e:
+					rapport['erreurs'] += 1
+					rapport['echecs'].append((psup, str(e)))
+					logger.exception("Erreur à l'importation d'un candidat "
+						"depuis Parcoursup")
+
+		rapport['duree'] = time.monotonic() - debut
+		rapport['debit'] = nombre / rapport['duree'] if rapport['duree'] else 0
+		logger.info("Import Parcoursup pour %s : %d candidats (%d créés, "
+				"%d erreurs) en %.1f s, soit %.1f candidats/s",
+				self.etablissement, nombre, rapport['crees'],
+				rapport['erreurs'], rapport['duree'], rapport['debit'])
+		return rapport
+
 	def get_candidats_admis(self):
 		"""
 		Met à jour la liste de tous les candidats admis dans
 		l'établissement.
+
+		Renvoie le rapport d'import (voir import_candidats).
 		"""
-		res = []
-		for candidat in self.parcoursup_rest.get_candidats_admis():
-			try:
-				with transaction.atomic():
-					res.append(self.import_candidat(candidat))
-			except Exception as e:
-				logger.exception("Erreur à l'importation d'un candidat "
-					"depuis Parcoursup")
-		return res
+		return self.import_candidats(
+				self.parcoursup_rest.get_candidats_admis())
 
 	def get_candidat_admis(self, code_candidat):
 		"""
@@ -203,45 +485,180 @@ class ParcoursupUser(models.Model):
 		return self.import_candidat(
 				self.parcoursup_rest.get_candidat(code_candidat))
 
-	def set_inscription(self, candidat):
+	@staticmethod
+	def _psup_candidat(candidat):
 		"""
-		Envoie à Parcoursup l'état d'inscription
+		Identité du candidat telle qu'elle doit être transmise à
+		Parcoursup.
 		"""
-		psup_candidat = ParcoursupCandidat(
+		return ParcoursupCandidat(
 				code=candidat.dossier_parcoursup,
 				ine=candidat.ine,
 				nom=candidat.last_name,
 				prenom=candidat.first_name,
 				date_naissance=candidat.date_naissance)
+
+	def set_inscription(self, candidat):
+		"""
+		Envoie à Parcoursup l'état d'inscription
+		"""
 		return self.parcoursup_rest.maj_inscription(
-				psup_candidat,
+				self._psup_candidat(candidat),
 				candidat.voeu_actuel.formation.code_parcoursup,
 				ParcoursupRest.INSCRIPTION_PRINCIPALE)
 
+	def _envoi_inscription(self, psup_candidat, code_formation):
+		"""
+		Envoie l'inscription d'un candidat à Parcoursup et renvoie un
+		couple (succès, message).
+
+		Cette méthode est appelée depuis les fils d'exécution de
+		confirme_inscriptions : elle ne doit pas accéder à la base de
+		données.
+		"""
+		try:
+			reponse = self.parcoursup_rest.maj_inscription(psup_candidat,
+					code_formation, ParcoursupRest.INSCRIPTION_PRINCIPALE)
+			reponse_json = reponse.json()
+		except ParcoursupError as e:
+			return False, str(e)
+		except (requests.RequestException, ValueError) as e:
+			return False, "Erreur de communication avec Parcoursup : {}".format(e)
+
+		message = ''
+		if isinstance(reponse_json, dict):
+			message = reponse_json.get('message') or ''
+		return True, message
+
+	def confirme_inscriptions(self, candidats, concurrence=None):
+		"""
+		Confirme à Parcoursup l'inscription administrative des candidats
+		donnés en paramètre.
+
+		Les requêtes sont envoyées en parallèle, avec au plus
+		concurrence requêtes simultanées (par défaut, la valeur du
+		réglage PARCOURSUP_CONCURRENCE). Le résultat de chaque envoi est
+		enregistré dans le journal des messages envoyés et, en cas de
+		succès, dans le dossier du candidat.
+
+		Renvoie la liste des ResultatConfirmation.
+		"""
+		if concurrence is None:
+			concurrence = getattr(settings, 'PARCOURSUP_CONCURRENCE', 4)
+
+		candidats = list(candidats)
+		voeux = {voeu.candidat_id: voeu for voeu in Voeu.objects.filter(
+			candidat__in=candidats,
+			etat__in=(Voeu.ETAT_ACCEPTE_AUTRES, Voeu.ETAT_ACCEPTE_DEFINITIF)
+			).select_related('formation')}
+
+		resultats = []
+		a_envoyer = []
+		for candidat in candidats:
+			voeu = voeux.get(candidat.pk)
+			if voeu is None:
+				resultats.append(ResultatConfirmation(candidat, False,
+					"Aucun vœu accepté pour ce candidat"))
+			else:
+				a_envoyer.append((candidat, voeu.formation.code_parcoursup))
+
+		# Instanciation de l'accès REST avant de démarrer les fils
+		# d'exécution, pour qu'ils partagent la même session HTTP.
+		self.parcoursup_rest
+		with ThreadPoolExecutor(max_workers=max(1, concurrence)) as executor:
+			envois = {executor.submit(self._envoi_inscription,
+					self._psup_candidat(candidat), code_formation): candidat
+				for candidat, code_formation in a_envoyer}
+			for envoi in as_completed(envois):
+				# Une erreur imprévue sur un envoi ne doit pas faire
+				# perdre les résultats des autres
+				try:
+					succes, message = envoi.result()
+				except Exception as e:
+					logger.exception("Erreur à la confirmation de "
+							"l'inscription du candidat %s",
+							envois[envoi].pk)
+					succes, message = False, "Erreur inattendue : {}".format(e)
+				resultats.append(ResultatConfirmation(envois[envoi],
+					succes, message))
+
+		maintenant = timezone.now()
+		confirmes = []
+		logs = []
+		for resultat in resultats:
+			if resultat.succes:
+				resultat.candidat.inscription_administrative_confirmee = True
+				resultat.candidat.inscription_administrative_message = \
+						resultat.message[:200]
+				confirmes.append(resultat.candidat)
+			else:
+				logger.warning("Échec de la confirmation de l'inscription "
+						"du candidat %s : %s", resultat.candidat.pk,
+						resultat.message)
+			logs.append(ParcoursupMessageEnvoyeLog(date=maintenant,
+				user=self, endpoint='majInscriptionAdministrative',
+				candidat=resultat.candidat, succes=resultat.succes,
+				message=resultat.message[:200]))
+
+		with transaction.atomic():
+			Candidat.objects.bulk_update(confirmes,
+					['inscription_administrative_confirmee',
+						'inscription_administrative_message'])
+			ParcoursupMessageEnvoyeLog.objects.bulk_create(logs)
+
+		return resultats
+
 	def demissions(self):
 		"""
 		Change en ETAT_REFUSE les voeux en ETAT_ACCEPTE_DEFINITIF qui
 		ne sont plus listés dans ParcourSup.
+
+		Les couples (dossier Parcoursup, code de formation) des admis
+		sont comparés en mémoire à ceux des vœux acceptés dans
+		l'établissement. Les vœux manquants sont mis à jour en une seule
+		requête et leur historique est créé en bloc.
+
+		Renvoie un dictionnaire qui résume les changements :
+		- admis : nombre d'admis listés par Parcoursup,
+		- voeux : nombre de vœux acceptés définitivement avant la mise à
+		  jour,
+		- demissions : liste des vœux passés en ETAT_REFUSE.
 		"""
-		voeux = Voeu.objects.filter(formation__etablissement = self.etablissement, etat=Voeu.ETAT_ACCEPTE_DEFINITIF)
-		etats = {voeu: False for voeu in voeux}
-		candidats_ps = self.parcoursup_rest.get_candidats_admis()
-		for candidat_ps in candidats_ps:
-			try:
-				candidat=Candidat.objects.get(dossier_parcoursup=candidat_ps['candidat'].code)
-				formation=Formation.objects.get(etablissement=self.etablissement, code_parcoursup=candidat_ps['proposition'].code_formation)
-				voeu = voeux.get(candidat=candidat, formation=formation)
-				etats[voeu]=True
-			except (Candidat.DoesNotExist, Voeu.DoesNotExist):
-				pass
-			time.sleep(0.01) # petite pause pour que PS ne rejete pas un nombre trop grand de connexions en un temps trop court
-		for voeu in etats:
-			if not etats[voeu]:
-				voeu.etat=Voeu.ETAT_REFUSE
-				voeu.save()
+		admis = set()
+		for candidat_ps in self.parcoursup_rest.get_candidats_admis():
+			admis.add((int(candidat_ps['candidat'].code),
+				candidat_ps['proposition'].code_formation))
 
+		voeux = Voeu.objects.filter(
+				formation__etablissement=self.etablissement,
+				etat=Voeu.ETAT_ACCEPTE_DEFINITIF).select_related(
+						'candidat', 'formation')
+		voeux = list(voeux)
+		demissions = [voeu for voeu in voeux
+				if (voeu.candidat_id, voeu.formation.code_parcoursup) not in admis]
 
+		maintenant = timezone.now()
+		with transaction.atomic():
+			pks = [voeu.pk for voeu in demissions]
+			# Découpage pour ne pas dépasser le nombre maximal de
+			# paramètres d'une requête SQL.
+			for debut in range(0, len(pks), 500):
+				Voeu.objects.filter(pk__in=pks[debut:debut+500]).update(
+						etat=Voeu.ETAT_REFUSE)
+			HistoriqueVoeu.objects.bulk_create([
+				HistoriqueVoeu(voeu=voeu, etat=Voeu.ETAT_REFUSE,
+					date=maintenant)
+				for voeu in demissions])
+			DossierEtat.objects.mettre_a_jour(
+					[voeu.candidat_id for voeu in demissions])
+		for voeu in demissions:
+			voeu.etat = Voeu.ETAT_REFUSE
 
+		return {
+			'admis': len(admis),
+			'voeux': len(voeux),
+			'demissions': demissions,
+		}
 
 	def envoi_candidat_test(self):
 		"""
@@ -262,16 +679,80 @@ class ParcoursupMessageRecuLog(models.Model):
 	succes = models.BooleanField()
 	payload = models.BinaryField(verbose_name="données reçues",
 			blank=True, default=b'', null=True)
+	empreinte = models.CharField(max_length=64, blank=True, default="",
+			db_index=True,
+			help_text="Empreinte SHA-256 des données d'admission reçues")
 
 	class Meta:
 		verbose_name = "message reçu Parcoursup"
 		verbose_name_plural = "messages reçus Parcoursup"
 
+class TacheAdmission(Tache):
+	"""
+	Réponse d'un candidat à une proposition d'admission, reçue de
+	Parcoursup et en attente d'import.
+
+	Le point d'entrée admissionCandidat se contente d'enregistrer les
+	données reçues : l'import du candidat et l'envoi de l'e-mail de
+	bienvenue sont réalisés par la commande traite_admissions.
+
+	Les admissions d'un même dossier sont importées une par une, dans
+	l'ordre de réception : une réponse plus ancienne ne doit pas écraser
+	une réponse plus récente du candidat.
+	"""
+	champ_serialisation = 'dossier_parcoursup'
+
+	user = models.ForeignKey(ParcoursupUser, on_delete=models.CASCADE)
+	message = models.ForeignKey(ParcoursupMessageRecuLog,
+			on_delete=models.SET_NULL, blank=True, null=True)
+	donnees = models.TextField(verbose_name="données reçues")
+	url_base = models.URLField(max_length=300,
+			help_text="Adresse du site utilisée dans les liens de l'e-mail "
+			"de bienvenue")
+	candidat = models.ForeignKey(Candidat, on_delete=models.SET_NULL,
+			blank=True, null=True)
+	dossier_parcoursup = models.IntegerField(verbose_name="numéro Parcoursup",
+			blank=True, null=True, db_index=True)
+
+	class Meta:
+		verbose_name = "admission Parcoursup à traiter"
+		verbose_name_plural = "admissions Parcoursup à traiter"
+
+	def __str__(self):
+		return "Admission n°{} ({})".format(self.pk, self.get_etat_display())
+
+	def executer(self):
+		# Une tâche relancée à la main ne doit pas revenir sur une
+		# admission plus récente déjà importée pour ce dossier
+		if self.dossier_parcoursup is not None and \
+				TacheAdmission.objects.filter(pk__gt=self.pk,
+					dossier_parcoursup=self.dossier_parcoursup,
+					etat=Tache.ETAT_TERMINEE).exists():
+			logger.info("Admission %s ignorée : une admission plus récente "
+					"du dossier %s a déjà été importée", self.pk,
+					self.dossier_parcoursup)
+			return
+
+		donnees = json.loads(self.donnees)
+		psup = ParcoursupRest.parse_parcoursup_admission(donnees)
+		with transaction.atomic():
+			candidat = self.user.import_candidat(psup,
+					empreinte=ParcoursupRest.empreinte_admission(donnees))
+		self.candidat = candidat
+		candidat.email_bienvenue(url_base=self.url_base)
+
 class ParcoursupMessageEnvoyeLog(models.Model):
 	"""
 	Journal des messages envoyés à Parcoursup
 	"""
 	date = models.DateTimeField()
+	user = models.ForeignKey(ParcoursupUser, on_delete=models.SET_NULL,
+			blank=True, null=True)
+	endpoint = models.CharField(max_length=100, blank=True, default="")
+	candidat = models.ForeignKey(Candidat, on_delete=models.SET_NULL,
+			blank=True, null=True)
+	succes = models.BooleanField(default=False)
+	message = models.CharField(max_length=200, blank=True, default="")
 
 	class Meta:
 		verbose_name = "message envoyé Parcoursup"
@@ -306,6 +787,10 @@ class Voeu(EtatVoeu):
 	internat = models.BooleanField()
 	cesure = models.BooleanField()
 	_classement = models.PositiveSmallIntegerField(null=True, default=None)
+	empreinte_parcoursup = models.CharField(max_length=64, blank=True,
+			default="", editable=False,
+			help_text="Empreinte des dernières données d'admission "
+			"Parcoursup importées pour ce vœu")
 
 	class Meta:
 		verbose_name = "vœu"
@@ -340,3 +825,218 @@ class HistoriqueVoeu(EtatVoeu):
 	class Meta:
 		verbose_name = "historique de vœu"
 		verbose_name_plural = "historiques de vœu"
+
+_dossiers_differes = threading.local()
+
+class DossierEtatManager(models.Manager):
+	def mettre_a_jour(self, candidats):
+		"""
+		Recalcule l'état des dossiers des candidats donnés (instances
+		ou clés primaires), pour tous leurs vœux.
+		"""
+		pks = sorted({Candidat._meta.pk.to_python(getattr(candidat, 'pk', candidat))
+			for candidat in candidats})
+		# Découpage pour ne pas dépasser le nombre maximal de
+		# paramètres d'une requête SQL.
+		for debut in range(0, len(pks), 500):
+			self._mettre_a_jour(pks[debut:debut+500])
+
+	def _mettre_a_jour(self, pks):
+		from .fiches import all_fiche_validation_candidat
+
+		voeux = list(Voeu.objects.filter(candidat__in=pks).values_list(
+			'pk', 'candidat_id', 'formation_id',
+			'formation__etablissement_id', 'etat'))
+		types_etablissement = {}
+		for etablissement_id, ctype_id in Etablissement.fiches.through.objects.filter(
+				etablissement_id__in={voeu[3] for voeu in voeux}).values_list(
+						'etablissement_id', 'contenttype_id'):
+			types_etablissement.setdefault(etablissement_id, set()).add(ctype_id)
+		types_candidat = {ctype.pk for ctype in
+				ContentType.objects.get_for_models(
+					*all_fiche_validation_candidat).values()}
+		fiches = {}
+		for candidat_id, ctype_id, etat in Fiche.objects.non_polymorphic(
+				).filter(candidat__in=pks).values_list('candidat_id',
+						'polymorphic_ctype_id', 'etat'):
+			fiches.setdefault(candidat_id, []).append((ctype_id, etat))
+
+		etats = {}
+		for pk, candidat_id, formation_id, etablissement_id, etat_voeu in voeux:
+			etat = DossierEtat.etat_dossier(etat_voeu,
+					[(ctype_id, etat) for ctype_id, etat in fiches.get(candidat_id, [])
+						if ctype_id in types_etablissement.get(etablissement_id, ())],
+					types_candidat)
+			if etat is not None:
+				etats[pk] = DossierEtat(voeu_id=pk, candidat_id=candidat_id,
+						formation_id=formation_id, etat=etat)
+
+		existants = {dossier.pk: dossier
+				for dossier in self.filter(candidat__in=pks)}
+		modifies = [dossier for pk, dossier in etats.items()
+				if pk in existants and (existants[pk].etat, existants[pk].formation_id)
+					!= (dossier.etat, dossier.formation_id)]
+		supprimes = [pk for pk in existants if pk not in etats]
+		crees = [dossier for pk, dossier in etats.items()
+			if pk not in existants]
+		maintenant = timezone.now()
+		for dossier in modifies:
+			dossier.date_maj = maintenant
+		self.filter(pk__in=supprimes).delete()
+		self.bulk_update(modifies, ['etat', 'formation', 'date_maj'])
+		self.bulk_create(crees)
+		if supprimes or modifies or crees:
+			invalider_statistiques()
+
+	@contextmanager
+	def differer(self):
+		"""
+		Gestionnaire de contexte qui regroupe les mises à jour des
+		dossiers déclenchées par les enregistrements de fiches et de
+		vœux : les dossiers concernés sont recalculés en une fois à la
+		sortie du bloc.
+		"""
+		if getattr(_dossiers_differes, 'candidats', None) is not None:
+			yield
+			return
+		_dossiers_differes.candidats = set()
+		try:
+			yield
+			candidats = _dossiers_differes.candidats
+		finally:
+			_dossiers_differes.candidats = None
+		self.mettre_a_jour(candidats)
+
+	def signaler(self, candidat_pk):
+		"""
+		Demande la mise à jour des dossiers d'un candidat, tout de suite
+		ou à la sortie du bloc differer() en cours.
+		"""
+		candidats = getattr(_dossiers_differes, 'candidats', None)
+		if candidats is not None:
+			candidats.add(candidat_pk)
+		else:
+			self.mettre_a_jour([candidat_pk])
+
+	def reconstruire(self, etablissement=None):
+		"""
+		Reconstruit entièrement l'état des dossiers, éventuellement pour
+		un seul établissement. Renvoie le nombre de candidats traités.
+		"""
+		voeux = Voeu.objects.all()
+		dossiers = self.all()
+		if etablissement is not None:
+			voeux = voeux.filter(formation__etablissement=etablissement)
+			dossiers = dossiers.filter(formation__etablissement=etablissement)
+		pks = set(voeux.values_list('candidat_id', flat=True))
+		with transaction.atomic():
+			dossiers.delete()
+			self.mettre_a_jour(pks)
+		invalider_statistiques()
+		return len(pks)
+
+class DossierEtat(models.Model):
+	"""
+	État du dossier d'inscription d'un candidat pour un vœu.
+
+	Cet état est déduit de l'état du vœu et de celui des fiches du
+	candidat. Il est stocké pour éviter de le recalculer à chaque
+	affichage, et tenu à jour lors des enregistrements de fiches et de
+	vœux (voir inscrire.apps). La commande reconstruit_dossiers le
+	recalcule entièrement.
+
+	Seuls les vœux acceptés ou refusés ont un dossier.
+	"""
+	ETAT_EDITION = 1
+	ETAT_COMPLET = 2
+	ETAT_TERMINE = 3
+	ETAT_DEMISSION = 4
+	ETAT_CHOICES = (
+		(ETAT_EDITION, "édition"),
+		(ETAT_COMPLET, "complet"),
+		(ETAT_TERMINE, "terminé"),
+		(ETAT_DEMISSION, "démission"),
+	)
+
+	voeu = models.OneToOneField(Voeu, on_delete=models.CASCADE,
+			primary_key=True, related_name='dossier')
+	candidat = models.ForeignKey(Candidat, on_delete=models.CASCADE)
+	formation = models.ForeignKey(Formation, on_delete=models.CASCADE)
+	etat = models.PositiveSmallIntegerField(verbose_name="état",
+			choices=ETAT_CHOICES)
+	date_maj = models.DateTimeField(verbose_name="date de mise à jour",
+			default=timezone.now)
+
+	objects = DossierEtatManager()
+
+	class Meta:
+		verbose_name = "état de dossier"
+		verbose_name_plural = "états de dossier"
+		indexes = [models.Index(fields=['formation', 'etat'])]
+
+	def __str__(self):
+		return "{} : {}".format(self.voeu_id, self.get_etat_display())
+
+	@classmethod
+	def etat_dossier(kls, etat_voeu, fiches, types_candidat):
+		"""
+		Calcule l'état d'un dossier à partir de l'état du vœu et de la
+		liste des couples (type, état) des fiches du candidat que
+		l'établissement utilise :
+		- édition : au moins une fiche à valider par le candidat est en
+		  édition,
+		- complet : aucune fiche du candidat n'est en édition, mais au
+		  moins une fiche n'est pas terminée,
+		- terminé : toutes les fiches sont terminées,
+		- démission : le candidat a refusé le vœu.
+		"""
+		if etat_voeu == Voeu.ETAT_REFUSE:
+			return kls.ETAT_DEMISSION
+		if etat_voeu not in (Voeu.ETAT_ACCEPTE_AUTRES, Voeu.ETAT_ACCEPTE_DEFINITIF):
+			return None
+		if any(ctype_id in types_candidat and etat == Fiche.ETAT_EDITION
+				for ctype_id, etat in fiches):
+			return kls.ETAT_EDITION
+		if any(etat != Fiche.ETAT_TERMINEE for _, etat in fiches):
+			return kls.ETAT_COMPLET
+		return kls.ETAT_TERMINE
+
+	@classmethod
+	def compteurs(kls, formations=None):
+		"""
+		Nombre de dossiers dans chaque état pour les formations données
+		(par défaut, pour toutes les formations), en une seule requête.
+		Renvoie un dictionnaire qui associe à la clé primaire de chaque
+		formation un dictionnaire {état: nombre}.
+		"""
+		dossiers = kls.objects.all()
+		compteurs = {}
+		if formations is not None:
+			compteurs = {getattr(formation, 'pk', formation):
+					{etat: 0 for etat, _ in kls.ETAT_CHOICES}
+				for formation in formations}
+			dossiers = dossiers.filter(formation__in=list(compteurs))
+		for formation_id, etat, nombre in dossiers.values_list(
+				'formation_id', 'etat').annotate(
+					nombre=models.Count('pk')).order_by():
+			compteurs.setdefault(formation_id,
+					{etat: 0 for etat, _ in kls.ETAT_CHOICES})[etat] = nombre
+		return compteurs
+
+def maj_dossier_etat(sender, instance, **kwargs):
+	"""
+	Récepteur des signaux post_save et post_delete des fiches et des
+	vœux, qui met à jour l'état des dossiers du candidat concerné.
+	"""
+	if kwargs.get('raw'):
+		return
+	DossierEtat.objects.signaler(instance.candidat_id)
+
+def maj_dossiers_etablissement(sender, instance, action, **kwargs):
+	"""
+	Récepteur du signal m2m_changed des fiches utilisées par un
+	établissement : tous ses dossiers sont recalculés.
+	"""
+	if action in ('post_add', 'post_remove', 'post_clear') \
+			and isinstance(instance, Etablissement):
+		DossierEtat.objects.reconstruire(instance)
@@ -17,12 +17,11 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+from urllib.parse import urljoin
 
 from django.db import models
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
@@ -212,8 +211,11 @@ class Candidat(Personne):
 		"""Indique si toutes les fiches du candidat sont valides
 		(y compris celles que l'établissement doit traiter)"""
 		from . import Fiche
+		from inscrire.lib.configuration import configurations
+		configuration = configurations.get(
+				self.voeu_actuel.formation.etablissement_id)
 		return not Fiche.objects.filter(candidat=self, etat = Fiche.ETAT_EDITION,
-			polymorphic_ctype__in = self.voeu_actuel.formation.etablissement.fiches.all()).exists()
+			polymorphic_ctype__in = configuration.fiches).exists()
 
 	@property
 	def date_modification(self):
@@ -221,46 +223,94 @@ class Candidat(Personne):
 		return Fiche.objects.filter(candidat = self).aggregate(
 				date=models.Max('date_modification'))['date']
 
-	def email_bienvenue(self, request, force=False):
+	def email_bienvenue(self, request=None, force=False, url_base=None):
 		"""
 		Envoyer au candidat l'e-mail de bienvenue qui lui permet
 		d'activer son compte.
+
+		Le lien d'activation est construit à partir de la requête en
+		cours ou, en dehors d'une requête (travailleur en arrière-plan),
+		à partir de l'adresse url_base du site.
 		"""
-		if not force and self.email_bienvenue_envoye:
-			return
+		type(self).emails_bienvenue([self], request=request, force=force,
+				url_base=url_base)
 
-		voeu_actuel = self.voeu_actuel
-		render_context = {
-				'candidat': self,
-				'formation': voeu_actuel.formation,
-				'voeu': voeu_actuel,
-				'lien_activation': request.build_absolute_uri(reverse('password_reset_confirm',
+	@classmethod
+	def emails_bienvenue(cls, candidats, request=None, force=False,
+			url_base=None):
+		"""
+		Envoyer l'e-mail de bienvenue à chacun des candidats donnés
+		(voir email_bienvenue).
+
+		Les vœux des candidats sont lus en une requête, les gabarits
+		compilés une seule fois par formation (voir inscrire.lib.gabarits),
+		et les e-mails et le journal enregistrés en bloc.
+		"""
+		from .parcoursup import Voeu # Import ici, sinon dépendance circulaire
+		from .courriels import Courriel
+		from inscrire.lib.gabarits import rendre_courriels
+
+		candidats = [candidat for candidat in candidats
+				if force or not candidat.email_bienvenue_envoye]
+		if not candidats:
+			return
+		models.prefetch_related_objects(candidats, 'user')
+		pks = [cls._meta.pk.to_python(candidat.pk) for candidat in candidats]
+		voeux = {voeu.candidat_id: voeu for voeu in Voeu.objects.filter(
+			candidat__in=pks, etat__in=(Voeu.ETAT_ACCEPTE_AUTRES,
+				Voeu.ETAT_ACCEPTE_DEFINITIF)
+			).select_related('formation__etablissement')}
+
+		par_formation = {}
+		for candidat, pk in zip(candidats, pks):
+			if pk not in voeux:
+				raise Voeu.DoesNotExist("Aucun vœu accepté pour le "
+						"candidat {}".format(pk))
+			voeu_actuel = voeux[pk]
+			lien_activation = reverse('password_reset_confirm',
 					args=(
-						urlsafe_base64_encode(force_bytes(self.user.pk)),
-						default_token_generator.make_token(self.user)
-					)))
-				}
+						urlsafe_base64_encode(force_bytes(candidat.user.pk)),
+						default_token_generator.make_token(candidat.user)
+					))
+			if request is not None:
+				lien_activation = request.build_absolute_uri(lien_activation)
+			else:
+				lien_activation = urljoin(url_base, lien_activation)
+			render_context = {
+					'candidat': candidat,
+					'formation': voeu_actuel.formation,
+					'voeu': voeu_actuel,
+					'lien_activation': lien_activation,
+					}
+			par_formation.setdefault(voeu_actuel.formation_id, []).append(
+					(candidat, voeu_actuel.formation, render_context))
+
 		if settings.MODE == settings.MODE_FONCTION:
-			send_mail(
-					render_to_string('inscrire/email_bienvenue_candidat_subject.txt',
-						context=render_context).strip(),
-					render_to_string('inscrire/email_bienvenue_candidat_message.txt',
-						context=render_context).strip(),
-					"{email}".format(
-						etablissement=voeu_actuel.formation.etablissement,
-						email=voeu_actuel.formation.email_defaut),
-					("{candidat_prenom} {candidat_nom} <{email}>".format(
-						candidat_prenom=str(self.user.first_name),
-						candidat_nom=str(self.user.last_name),
-						email=str(self.user.email)),),
-					html_message=render_to_string('inscrire/email_bienvenue_candidat_message.html',
-						context=render_context).strip()
-				)
-
-			self.email_bienvenue_envoye = True
-		self.save()
-
-		self.log("E-mail d'activation du compte envoyé au candidat")
+			courriels = []
+			for groupe in par_formation.values():
+				formation = groupe[0][1]
+				rendus = rendre_courriels('email_bienvenue_candidat',
+						[render_context for _, _, render_context in groupe],
+						formation=formation)
+				for (candidat, _, _), (sujet, texte, html) in zip(groupe, rendus):
+					courriels.append(Courriel.objects.preparer(
+						sujet, texte, formation.email_defaut,
+						("{candidat_prenom} {candidat_nom} <{email}>".format(
+							candidat_prenom=str(candidat.user.first_name),
+							candidat_nom=str(candidat.user.last_name),
+							email=str(candidat.user.email)),),
+						message_html=html,
+						candidat=candidat))
+			Courriel.objects.bulk_create(courriels)
+			cls.objects.filter(pk__in=pks).update(email_bienvenue_envoye=True)
+			for candidat in candidats:
+				candidat.email_bienvenue_envoye = True
+
+		date = timezone.now()
+		CandidatActionLog.objects.bulk_create([CandidatActionLog(
+			candidat_id=pk, date=date,
+			message="E-mail d'activation du compte envoyé au candidat")
+			for pk in pks])
 
 	def log(self, message, date=None):
 		if date is None:
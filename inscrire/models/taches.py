@@ -0,0 +1,221 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+File de tâches asynchrones stockée en base de données
+"""
+
+import datetime
+import logging
+import traceback
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+TACHES_DEFAULTS = {
+	# Nombre de tentatives avant abandon définitif d'une tâche
+	'TENTATIVES': 5,
+	# Attente (en secondes) avant la première nouvelle tentative, doublée
+	# à chaque échec
+	'ATTENTE_INITIALE': 30,
+	'ATTENTE_MAX': 3600,
+	# Durée (en secondes) au-delà de laquelle une tâche en cours est
+	# considérée comme perdue (travailleur interrompu) et remise en jeu
+	'DELAI_VERROU': 900,
+}
+
+def taches_settings():
+	"""
+	Renvoie les paramètres de la file de tâches, en complétant les
+	réglages Django par les valeurs par défaut.
+	"""
+	taches = dict(TACHES_DEFAULTS)
+	taches.update(getattr(settings, 'TACHES', {}))
+	return taches
+
+class Tache(models.Model):
+	"""
+	Tâche à exécuter en arrière-plan par un travailleur (commande de
+	gestion lancée à côté du serveur web).
+
+	Les sous-classes définissent la méthode executer(), qui lève une
+	exception en cas d'échec. La tâche est alors retentée plus tard,
+	avec une attente exponentielle, jusqu'à être abandonnée après un
+	nombre maximal de tentatives. Les tâches abandonnées restent en base
+	pour être examinées et relancées depuis l'interface
+	d'administration.
+
+	Si champ_serialisation désigne un champ de la tâche, les tâches
+	ayant la même valeur pour ce champ sont exécutées une par une, dans
+	leur ordre de création : une tâche n'est pas réservée tant qu'une
+	tâche plus ancienne de même clé est en attente ou en cours.
+	"""
+	champ_serialisation = None
+
+	ETAT_ATTENTE = 1
+	ETAT_EN_COURS = 2
+	ETAT_TERMINEE = 3
+	ETAT_ABANDONNEE = 4
+	ETAT_CHOICES = (
+		(ETAT_ATTENTE, "en attente"),
+		(ETAT_EN_COURS, "en cours"),
+		(ETAT_TERMINEE, "terminée"),
+		(ETAT_ABANDONNEE, "abandonnée"),
+	)
+
+	etat = models.PositiveSmallIntegerField(choices=ETAT_CHOICES,
+			default=ETAT_ATTENTE)
+	date_creation = models.DateTimeField(verbose_name="date de création",
+			auto_now_add=True)
+	prochaine_tentative = models.DateTimeField(default=timezone.now,
+			db_index=True)
+	date_debut = models.DateTimeField(verbose_name="début du traitement",
+			blank=True, null=True)
+	date_fin = models.DateTimeField(verbose_name="fin du traitement",
+			blank=True, null=True)
+	tentatives = models.PositiveSmallIntegerField(default=0)
+	erreur = models.TextField(blank=True, default="")
+
+	class Meta:
+		abstract = True
+
+	@classmethod
+	def reserver(cls):
+		"""
+		Réserve la prochaine tâche à exécuter et la renvoie, ou renvoie
+		None si aucune tâche n'est prête.
+
+		La réservation est une mise à jour conditionnelle de l'état de la
+		tâche : si plusieurs travailleurs convoitent la même tâche, un
+		seul d'entre eux réussit la mise à jour.
+		"""
+		maintenant = timezone.now()
+		delai_verrou = datetime.timedelta(
+				seconds=taches_settings()['DELAI_VERROU'])
+		candidates = cls.objects.filter(
+				Q(etat=cls.ETAT_ATTENTE, prochaine_tentative__lte=maintenant) |
+				Q(etat=cls.ETAT_EN_COURS, date_debut__lt=maintenant - delai_verrou)
+			)
+		if cls.champ_serialisation:
+			precedentes = cls.objects.filter(pk__lt=OuterRef('pk'),
+					etat__in=(cls.ETAT_ATTENTE, cls.ETAT_EN_COURS),
+					**{cls.champ_serialisation: OuterRef(cls.champ_serialisation)})
+			candidates = candidates.annotate(precedente=Exists(precedentes)
+					).filter(precedente=False)
+		candidates = candidates.order_by('prochaine_tentative', 'pk'
+			).values_list('pk', 'etat', 'date_debut')[:10]
+
+		for pk, etat, date_debut in candidates:
+			if cls.objects.filter(pk=pk, etat=etat, date_debut=date_debut
+					).update(etat=cls.ETAT_EN_COURS, date_debut=maintenant):
+				return cls.objects.get(pk=pk)
+		return None
+
+	@classmethod
+	def reserver_lot(cls, nombre):
+		"""
+		Réserve jusqu'à nombre tâches prêtes et renvoie leur liste
+		"""
+		taches = []
+		while len(taches) < nombre:
+			tache = cls.reserver()
+			if tache is None:
+				break
+			taches.append(tache)
+		return taches
+
+	@classmethod
+	def traiter_lot(cls, taches):
+		"""
+		Exécute les tâches réservées données. Renvoie, pour chacune,
+		True en cas de réussite, False en cas d'échec et None si elle a
+		été reportée sans être exécutée.
+
+		Les sous-classes peuvent redéfinir cette méthode pour partager
+		une ressource (connexion à un serveur…) entre les tâches du lot.
+		"""
+		return [tache.traiter() for tache in taches]
+
+	def executer(self):
+		raise NotImplementedError
+
+	def traiter(self):
+		"""
+		Exécute la tâche réservée et enregistre son résultat. Renvoie
+		True si l'exécution a réussi.
+		"""
+		try:
+			self.executer()
+		except Exception as e:
+			logger.exception("Échec de la tâche %s", self, exc_info=e)
+			self.echec(traceback.format_exc())
+			return False
+		self.succes()
+		return True
+
+	def succes(self):
+		self.etat = self.ETAT_TERMINEE
+		self.date_fin = timezone.now()
+		self.tentatives += 1
+		self.erreur = ""
+		self.save()
+
+	def echec(self, erreur):
+		"""
+		Enregistre l'échec de la tâche et programme une nouvelle
+		tentative, ou abandonne la tâche si le nombre maximal de
+		tentatives est atteint.
+		"""
+		params = taches_settings()
+		self.tentatives += 1
+		self.erreur = erreur
+		if self.tentatives >= params['TENTATIVES']:
+			self.etat = self.ETAT_ABANDONNEE
+			self.date_fin = timezone.now()
+		else:
+			self.etat = self.ETAT_ATTENTE
+			self.prochaine_tentative = timezone.now() + datetime.timedelta(
+					seconds=min(params['ATTENTE_MAX'],
+						params['ATTENTE_INITIALE'] * 2 ** (self.tentatives - 1)))
+		self.save()
+
+	def differer(self, secondes):
+		"""
+		Remet la tâche réservée dans la file sans l'exécuter ni compter
+		de tentative, pour une exécution dans le nombre de secondes donné
+		"""
+		self.etat = self.ETAT_ATTENTE
+		self.prochaine_tentative = timezone.now() + datetime.timedelta(
+				seconds=secondes)
+		self.date_debut = None
+		self.save()
+
+	def relancer(self):
+		"""
+		Remet la tâche dans la file pour une exécution immédiate
+		"""
+		self.etat = self.ETAT_ATTENTE
+		self.tentatives = 0
+		self.prochaine_tentative = timezone.now()
+		self.date_debut = None
+		self.date_fin = None
+		self.save()
@@ -0,0 +1,61 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Numéros de version des données conservées en mémoire par les processus
+
+Les processus (serveurs web, travailleurs) gardent en mémoire des
+données qui changent rarement : référentiel, configuration des
+établissements. Chaque modification de ces données incrémente leur
+numéro de version dans la base, dans la même transaction ; chaque
+processus compare régulièrement ce numéro à celui des données qu'il a
+chargées. La base est le seul stockage partagé par tous les processus :
+le cache Django ne l'est pas nécessairement (LocMemCache par défaut).
+"""
+
+from django.db import models, transaction, IntegrityError
+
+class VersionDonneesManager(models.Manager):
+	def numero(self, nom):
+		"""Numéro de version courant des données nom (0 par défaut)"""
+		return self.filter(nom=nom).values_list('numero', flat=True
+				).first() or 0
+
+	def incrementer(self, nom):
+		"""Signale une modification des données nom"""
+		if self.filter(nom=nom).update(numero=models.F('numero') + 1):
+			return
+		try:
+			with transaction.atomic():
+				self.create(nom=nom, numero=1)
+		except IntegrityError:
+			# Ligne créée entre-temps par un autre processus
+			self.filter(nom=nom).update(numero=models.F('numero') + 1)
+
+class VersionDonnees(models.Model):
+	nom = models.CharField(max_length=50, primary_key=True)
+	numero = models.PositiveIntegerField(verbose_name="numéro", default=0)
+
+	objects = VersionDonneesManager()
+
+	class Meta:
+		verbose_name = "version de données"
+		verbose_name_plural = "versions de données"
+
+	def __str__(self):
+		return "{} ({})".format(self.nom, self.numero)
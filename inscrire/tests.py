@@ -1,3 +1,1771 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
 
-# Create your tests here.
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import datetime
+import io
+import json
+import os
+import pickle
+import tempfile
+import xml.etree.ElementTree as ElementTree
+import zipfile
+from unittest import mock
+
+import requests
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from inscrire.lib import gabarits
+from inscrire.lib.comparaison_siecle import ComparaisonSiecle
+from inscrire.lib.configuration import EtablissementConfig, configurations
+from inscrire.lib.import_structures import ImportStructures
+from inscrire.lib.maintenance import AdressesAutorisees, Maintenance, \
+		MESSAGE_CONFIGURATION
+from inscrire.lib.parcoursup_fichiers import ExportInvalide, ExportStandard
+from inscrire.lib.parcoursup_rest import DEBIT_MIN, LimiteurDebit, \
+		ParcoursupError, ParcoursupRequest, ParcoursupRest, \
+		ParcoursupSessionPool, ReserveLimiteurs, attente_avant_tentative, \
+		parcoursup_http_settings
+from inscrire.lib.recherche import CacheLRU, IndexRecherche
+from inscrire.lib.referentiel import referentiel
+from inscrire.lib.siecle.fichiers import Nomenclature, Structures
+from inscrire.lib.statistiques import formations_avec_compteurs
+from inscrire.lib.utils import normalise_nom
+from inscrire.models import Candidat, Courriel, DossierEtat, Etablissement, \
+		Commune, Formation, HistoriqueVoeu, InscrireUser, MefMatiere, \
+		MefOption, Pays, ParcoursupMessageEnvoyeLog, ParcoursupMessageRecuLog, \
+		ParcoursupUser, Profession, ResponsableLegal, TacheAdmission, \
+		TacheExport, Voeu
+from inscrire.models.fiches import EnteteFiche, Fiche, FicheCesure, \
+		FicheHebergement, FicheIdentite, FicheInternat, FicheScolarite, all_fiche
+from inscrire.models.mailing import Destinataire, Envoi, Mailing
+from inscrire.models.taches import taches_settings
+
+def admission_json(code, **donnees):
+	"""
+	Données d'admission Parcoursup d'un candidat fictif, au format JSON
+	reçu de Parcoursup, construites à partir de l'exemple
+	tools/candidat_test.json. Les données passées en paramètre
+	remplacent celles de l'exemple.
+	"""
+	with open(os.path.join(settings.BASE_DIR, 'inscrire', 'tools',
+			'candidat_test.json'), encoding='utf-8') as f:
+		psup_json = json.load(f)['donneesCandidat']
+	psup_json.update(codeCandidat=code,
+			mail='candidat{}@example.com'.format(code),
+			ine='{:09d}AB'.format(code))
+	psup_json.update(donnees)
+	return psup_json
+
+def admission(code, **donnees):
+	"""
+	Données d'admission d'un candidat fictif, structurées par
+	ParcoursupRest.parse_parcoursup_admission
+	"""
+	return ParcoursupRest.parse_parcoursup_admission(
+			admission_json(code, **donnees))
+
+# Le hachage des mots de passe des candidats créés ralentirait les tests
+@override_settings(PASSWORD_HASHERS=[
+	'django.contrib.auth.hashers.MD5PasswordHasher'])
+class InscriptionTestCase(TestCase):
+	"""
+	Établissement utilisant toutes les fiches, avec une formation et un
+	compte Parcoursup pour importer des candidats.
+	"""
+	@classmethod
+	def setUpTestData(cls):
+		# Profession des responsables légaux de l'exemple
+		Profession.objects.create(code=99, libelle_court="Non renseignée",
+				libelle_long="Non renseignée")
+		cls.etablissement = Etablissement.objects.create(
+				numero_uai='0420041S', nom="Lycée du test",
+				inscriptions=True, email='lycee@example.com')
+		cls.etablissement.fiches.set([ContentType.objects.get_for_model(fiche)
+			for fiche in all_fiche])
+		cls.formation = Formation.objects.create(nom="MPSI",
+				code_parcoursup=8842, code_mef='30111111111', slug='mpsi',
+				etablissement=cls.etablissement)
+		cls.parcoursup = ParcoursupUser.objects.create(
+				etablissement=cls.etablissement, username='42',
+				user=InscrireUser.objects.create_user(
+					email='parcoursup@example.com',
+					role=InscrireUser.ROLE_PARCOURSUP),
+				adresse_api='https://parcoursup.example.com/',
+				remontee_username='lycee', remontee_password='secret')
+
+	def setUp(self):
+		# Le référentiel et la configuration des établissements restent
+		# en mémoire d'un test à l'autre, alors que la base est remise
+		# dans son état initial. Dans un test, les transactions ne sont
+		# jamais validées : la configuration n'est donc pas oubliée
+		# automatiquement après une modification. Les numéros de version,
+		# remis à zéro avec la base, sont réutilisés : le cache Django
+		# est donc vidé lui aussi.
+		referentiel.invalider()
+		configurations._vider()
+		cache.clear()
+
+	def candidat(self, code, **donnees):
+		"""Importe un candidat depuis Parcoursup et le renvoie"""
+		return self.parcoursup.import_candidat(admission(code, **donnees))
+
+class SessionsParcoursupTests(SimpleTestCase):
+	def test_session_partagee(self):
+		sessions = ParcoursupSessionPool()
+		premiere = ParcoursupRest(login='a', code_etablissement='0420041S')
+		seconde = ParcoursupRest(login='a', code_etablissement='0420041S')
+		with mock.patch('inscrire.lib.parcoursup_rest.sessions_parcoursup',
+				sessions):
+			self.assertIs(premiere.session, seconde.session)
+			self.assertIsNot(premiere.session, ParcoursupRest(login='b',
+				code_etablissement='0420041S').session)
+
+	@override_settings(PARCOURSUP_HTTP={'POOL_MAXSIZE': 3})
+	def test_reglages(self):
+		session = ParcoursupSessionPool().get('cle')
+		adapter = session.get_adapter('https://ws.parcoursup.fr/')
+		self.assertEqual(adapter._pool_maxsize, 3)
+		self.assertEqual(session.headers['Connection'], 'keep-alive')
+
+		with self.settings(PARCOURSUP_HTTP={'KEEPALIVE': False}):
+			session = ParcoursupSessionPool().get('cle')
+		self.assertEqual(session.headers['Connection'], 'close')
+
+	def test_session_inactive(self):
+		sessions = ParcoursupSessionPool()
+		with mock.patch('time.monotonic', return_value=1000.):
+			session = sessions.get('cle')
+		with mock.patch('time.monotonic', return_value=1200.):
+			self.assertIs(sessions.get('cle'), session)
+		with mock.patch.object(session, 'close') as close, \
+				mock.patch('time.monotonic', return_value=1600.):
+			self.assertIsNot(sessions.get('cle'), session)
+		close.assert_called_once_with()
+
+		session = sessions.get('cle')
+		with mock.patch.object(session, 'close') as close:
+			sessions.fermer()
+		close.assert_called_once_with()
+		self.assertIsNot(sessions.get('cle'), session)
+
+class ConfirmationInscriptionsTests(InscriptionTestCase):
+	def test_erreurs_par_candidat(self):
+		candidats = [self.candidat(code) for code in range(1, 5)]
+		voeu = candidats[3].voeu_set.get()
+		voeu.etat = Voeu.ETAT_REFUSE
+		voeu.save()
+
+		def maj_inscription(rest, candidat, formation, etat_inscription):
+			if candidat.code == 2:
+				raise RuntimeError("panne")
+			if candidat.code == 3:
+				raise ParcoursupError("Candidat inconnu")
+			reponse = mock.Mock()
+			reponse.json.return_value = {'retour': 'OK', 'message': "Inscrit"}
+			return reponse
+
+		with mock.patch.object(ParcoursupRest, 'maj_inscription',
+				maj_inscription):
+			resultats = self.parcoursup.confirme_inscriptions(candidats,
+					concurrence=2)
+
+		resultats = {resultat.candidat.pk: resultat for resultat in resultats}
+		self.assertEqual(sorted(resultats), [1, 2, 3, 4])
+		self.assertEqual(resultats[1].succes, True)
+		self.assertEqual(resultats[1].message, "Inscrit")
+		self.assertFalse(resultats[2].succes)
+		self.assertIn("panne", resultats[2].message)
+		self.assertEqual(resultats[3].message, "Candidat inconnu")
+		self.assertFalse(resultats[4].succes)
+
+		self.assertEqual(list(Candidat.objects.filter(
+			inscription_administrative_confirmee=True).values_list(
+				'pk', 'inscription_administrative_message')), [(1, "Inscrit")])
+		self.assertEqual(sorted(ParcoursupMessageEnvoyeLog.objects.values_list(
+			'candidat', 'succes')),
+			[(1, True), (2, False), (3, False), (4, False)])
+
+class Horloge:
+	"""
+	Horloge factice qui remplace le module time : les attentes font
+	simplement avancer le temps.
+	"""
+	def __init__(self):
+		self.temps = 0.
+		self.attentes = []
+
+	def monotonic(self):
+		return self.temps
+
+	def sleep(self, duree):
+		self.attentes.append(duree)
+		self.temps += duree
+
+class LimiteurDebitTests(SimpleTestCase):
+	def setUp(self):
+		self.horloge = Horloge()
+		patcher = mock.patch('inscrire.lib.parcoursup_rest.time', self.horloge)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_rafale_puis_debit(self):
+		limiteur = LimiteurDebit(debit=2, rafale=3)
+		for i in range(3):
+			limiteur.acquerir()
+		self.assertEqual(self.horloge.attentes, [])
+		limiteur.acquerir()
+		self.assertEqual(self.horloge.attentes, [0.5])
+		# Un jeton supplémentaire toutes les demi-secondes
+		self.horloge.temps += 1
+		limiteur.acquerir()
+		limiteur.acquerir()
+		self.assertEqual(self.horloge.attentes, [0.5])
+
+	def test_saturation(self):
+		limiteur = LimiteurDebit(debit=8, rafale=5)
+		limiteur.signaler_saturation(pause=2)
+		self.assertEqual(limiteur.debit_courant, 4)
+		limiteur.acquerir()
+		# Pause imposée à tous les fils d'exécution
+		self.assertEqual(self.horloge.attentes, [2])
+		for i in range(5):
+			limiteur.signaler_saturation()
+		self.assertEqual(limiteur.debit_courant, 1)
+
+		for i in range(20):
+			limiteur.signaler_succes()
+		self.assertEqual(limiteur.debit_courant, 8)
+
+	def test_configuration(self):
+		limiteur = LimiteurDebit(debit=0, rafale=0)
+		self.assertEqual(limiteur.debit, DEBIT_MIN)
+		self.assertEqual(limiteur.rafale, 1)
+
+		limiteurs = ReserveLimiteurs()
+		limiteur = limiteurs.get('cle', 10, 10)
+		limiteur.signaler_saturation()
+		self.assertIs(limiteurs.get('cle', 10, 10), limiteur)
+		self.assertEqual(limiteur.debit_courant, 5)
+		self.assertIs(limiteurs.get('cle', 4, 10), limiteur)
+		self.assertEqual((limiteur.debit, limiteur.debit_courant), (4, 4))
+
+	def test_attente_avant_tentative(self):
+		http_settings = dict(parcoursup_http_settings(),
+				ATTENTE_INITIALE=0.5, ATTENTE_MAX=30)
+		self.assertEqual(attente_avant_tentative(0, http_settings, '2'), 2)
+		self.assertEqual(attente_avant_tentative(0, http_settings, '120'), 30)
+		with mock.patch('random.uniform', return_value=0.) as uniform:
+			attente_avant_tentative(3, http_settings,
+					'Wed, 21 Oct 2026 07:28:00 GMT')
+			attente_avant_tentative(10, http_settings)
+		self.assertEqual(uniform.call_args_list,
+				[mock.call(0, 4.), mock.call(0, 30)])
+
+	def reponse(self, code, retry_after=None):
+		reponse = mock.Mock(status_code=code,
+				headers={'Retry-After': retry_after} if retry_after else {})
+		reponse.json.return_value = {'retour': 'OK'}
+		if code >= 400:
+			reponse.raise_for_status.side_effect = \
+					requests.exceptions.HTTPError(code)
+		return reponse
+
+	@override_settings(PARCOURSUP_HTTP={'TENTATIVES': 3})
+	def test_nouvelles_tentatives(self):
+		session = mock.Mock()
+		session.post.side_effect = [self.reponse(503, '1'),
+				requests.exceptions.ConnectionError(), self.reponse(200)]
+		limiteur = LimiteurDebit(debit=10, rafale=10)
+		requete = ParcoursupRequest('login', 'secret', 'majInscription',
+				session=session, limiteur=limiteur)
+		with mock.patch('random.uniform', return_value=0.25):
+			self.assertEqual(requete.send().status_code, 200)
+			self.assertEqual(session.post.call_count, 3)
+			self.assertEqual(self.horloge.attentes, [1, 0.25])
+			self.assertEqual(limiteur.debit_courant, 6)
+
+			# Abandon après le nombre maximal de tentatives
+			session.post.side_effect = [self.reponse(429)] * 3
+			with self.assertRaises(requests.exceptions.HTTPError):
+				ParcoursupRequest('login', 'secret', 'majInscription',
+						session=session).send()
+			self.assertEqual(session.post.call_count, 6)
+
+class DemissionsTests(InscriptionTestCase):
+	def test_demissions(self):
+		candidats = [self.candidat(code) for code in range(1, 5)]
+		# Vœu accepté avec d'autres vœux en attente : non concerné
+		self.candidat(4, codeSituation=2)
+		admis = [admission(1), admission(3)]
+
+		with mock.patch.object(ParcoursupRest, 'get_candidats_admis',
+				return_value=admis):
+			resultat = self.parcoursup.demissions()
+
+		self.assertEqual(resultat['admis'], 2)
+		self.assertEqual(resultat['voeux'], 3)
+		self.assertEqual([voeu.candidat for voeu in resultat['demissions']],
+				[candidats[1]])
+		self.assertEqual(dict(Voeu.objects.values_list('candidat', 'etat')), {
+			1: Voeu.ETAT_ACCEPTE_DEFINITIF,
+			2: Voeu.ETAT_REFUSE,
+			3: Voeu.ETAT_ACCEPTE_DEFINITIF,
+			4: Voeu.ETAT_ACCEPTE_AUTRES,
+			})
+		self.assertEqual(list(HistoriqueVoeu.objects.filter(
+			etat=Voeu.ETAT_REFUSE).values_list('voeu__candidat', flat=True)),
+			[2])
+		self.assertEqual(candidats[1].voeu_set.get().dossier.etat,
+				DossierEtat.ETAT_DEMISSION)
+
+		# Rien ne change au deuxième passage
+		with mock.patch.object(ParcoursupRest, 'get_candidats_admis',
+				return_value=admis):
+			resultat = self.parcoursup.demissions()
+		self.assertEqual(resultat['demissions'], [])
+		self.assertEqual(HistoriqueVoeu.objects.filter(
+			etat=Voeu.ETAT_REFUSE).count(), 1)
+
+class ImportCandidatsTests(InscriptionTestCase):
+	def donnees(self):
+		"""Données importées, indépendamment des clés primaires"""
+		return (
+			sorted(Candidat.objects.values_list('pk', 'first_name',
+				'last_name', 'genre', 'ine', 'adresse', 'bac_mention',
+				'telephone_mobile', 'user__email')),
+			sorted(Voeu.objects.values_list('candidat', 'formation', 'etat',
+				'internat', 'cesure')),
+			sorted(HistoriqueVoeu.objects.values_list('voeu__candidat', 'etat')),
+			sorted(ResponsableLegal.objects.values_list('candidat',
+				'last_name', 'first_name', 'email')),
+			sorted(Fiche.objects.values_list('candidat',
+				'polymorphic_ctype', 'etat')),
+			sorted(FicheIdentite.objects.values_list('candidat', 'adresse',
+				'telephone', 'responsables__last_name')),
+			sorted(FicheHebergement.objects.values_list('candidat', 'regime')),
+			sorted(DossierEtat.objects.values_list('candidat', 'etat')),
+		)
+
+	def test_lot_comme_un_par_un(self):
+		self.candidat(1)
+		self.candidat(2, internat="1")
+		psups = [admission(code, internat="1" if code % 2 else "0")
+			for code in range(1, 8)]
+
+		with transaction.atomic():
+			for psup in psups:
+				self.parcoursup.import_candidat(psup)
+			un_par_un = self.donnees()
+			transaction.set_rollback(True)
+
+		# Aucun lot n'est repris candidat par candidat
+		with self.assertNoLogs('inscrire.models.parcoursup', 'ERROR'):
+			rapport = self.parcoursup.import_candidats(psups, taille_lot=3)
+		self.assertEqual(self.donnees(), un_par_un)
+		self.assertEqual(rapport['crees'], 5)
+		self.assertEqual(rapport['erreurs'], 0)
+		self.assertEqual([candidat.pk for candidat in rapport['candidats']],
+				list(range(1, 8)))
+
+	def test_reprise_candidat_par_candidat(self):
+		psups = [admission(1), admission(2, codeFormationPsup=9999),
+				admission(3), admission(1)]
+		rapport = self.parcoursup.import_candidats(psups)
+		self.assertEqual(rapport['erreurs'], 1)
+		self.assertEqual(rapport['echecs'][0][0], psups[1])
+		self.assertEqual(rapport['crees'], 2)
+		self.assertEqual(sorted(Candidat.objects.values_list('pk', flat=True)),
+				[1, 3])
+		self.assertEqual(Voeu.objects.count(), 2)
+
+class ReferentielTests(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		Commune.objects.create(code_insee='42218', nom_clair="SAINT ETIENNE",
+				nom_riche="Saint-Étienne", libelle="Saint-Étienne (42)")
+		for code, libelle in (('73065', "Chambéry"), ('01073', "Chambéry")):
+			Commune.objects.create(code_insee=code, nom_clair=libelle.upper(),
+					nom_riche=libelle, libelle=libelle)
+		Pays.objects.create(code_iso2='FR', code_iso3='FRA', num_iso=250,
+				num_insee=99100, libelle="France")
+		Profession.objects.create(code=99, libelle_court="Non renseignée",
+				libelle_long="Non renseignée")
+		Etablissement.objects.create(numero_uai='0420041S',
+				nom="Lycée du test", email='lycee@example.com')
+
+	def setUp(self):
+		referentiel.invalider()
+
+	def test_recherches(self):
+		self.assertEqual(referentiel.commune('42218').nom_riche,
+				"Saint-Étienne")
+		self.assertIsNone(referentiel.commune('99999'))
+		self.assertEqual(referentiel.commune_par_nom("saint etienne").pk,
+				'42218')
+		# Nom ambigu
+		self.assertIsNone(referentiel.commune_par_nom("Chambéry"))
+		self.assertEqual(referentiel.pays('fr').libelle, "France")
+		self.assertEqual(referentiel.pays(' 99100').pk, 'FR')
+		self.assertIsNone(referentiel.pays(None))
+		self.assertEqual(referentiel.pays_par_nom("FRANCE").pk, 'FR')
+		self.assertEqual(referentiel.profession(99).pk, 99)
+		self.assertTrue(referentiel.uai_connu('0420041s'))
+		self.assertFalse(referentiel.uai_connu(''))
+
+	def test_instantane(self):
+		ancien = referentiel._index()
+		with self.assertRaises(TypeError):
+			ancien.communes['75056'] = None
+		self.assertIs(referentiel._index(), ancien)
+
+		Commune.objects.create(code_insee='75056', nom_clair="PARIS",
+				nom_riche="Paris", libelle="Paris")
+		self.assertEqual(referentiel.commune('75056').libelle, "Paris")
+		# L'instantané précédent, éventuellement en cours d'utilisation
+		# par un autre fil d'exécution, reste complet et inchangé
+		nouveau = referentiel._index()
+		self.assertIsNot(nouveau, ancien)
+		self.assertNotIn('75056', ancien.communes)
+		self.assertEqual(set(ancien.communes) | {'75056'},
+				set(nouveau.communes))
+		self.assertEqual(ancien.pays, nouveau.pays)
+
+class TacheTests(InscriptionTestCase):
+	def mettre_en_file(self, *codes, **kwargs):
+		return [TacheAdmission.objects.create(user=self.parcoursup,
+			donnees=json.dumps(admission_json(code)), dossier_parcoursup=code,
+			url_base='https://inscrire.example.com/', **kwargs)
+			for code in codes]
+
+	def test_reserver_une_seule_fois(self):
+		taches = self.mettre_en_file(1, 2, 3, 4, 5)
+		reserves = TacheAdmission.reserver_lot(3)
+		reserves.append(TacheAdmission.reserver())
+		reserves.append(TacheAdmission.reserver())
+		self.assertIsNone(TacheAdmission.reserver())
+		self.assertEqual(sorted(tache.pk for tache in reserves),
+				sorted(tache.pk for tache in taches))
+		self.assertTrue(all(tache.etat == TacheAdmission.ETAT_EN_COURS
+			for tache in reserves))
+
+	def test_reserver_concurrence(self):
+		# Un autre travailleur réserve la tâche entre la lecture des
+		# candidates et la mise à jour conditionnelle.
+		tache, = self.mettre_en_file(1)
+		filtre = TacheAdmission.objects.filter
+
+		def concurrent(*args, **kwargs):
+			if 'etat' in kwargs and 'date_debut' in kwargs:
+				TacheAdmission.objects.filter(pk=tache.pk).update(
+						etat=TacheAdmission.ETAT_EN_COURS,
+						date_debut=timezone.now())
+			return filtre(*args, **kwargs)
+
+		with mock.patch.object(TacheAdmission.objects, 'filter', concurrent):
+			self.assertIsNone(TacheAdmission.reserver())
+
+	def test_reserver_plus_tard(self):
+		self.mettre_en_file(1, prochaine_tentative=timezone.now()
+				+ datetime.timedelta(minutes=5))
+		self.assertIsNone(TacheAdmission.reserver())
+
+	def test_verrou_expire(self):
+		tache, = self.mettre_en_file(1)
+		self.assertEqual(TacheAdmission.reserver().pk, tache.pk)
+		self.assertIsNone(TacheAdmission.reserver())
+
+		# Le travailleur qui avait réservé la tâche a disparu
+		TacheAdmission.objects.filter(pk=tache.pk).update(
+				date_debut=timezone.now() - datetime.timedelta(
+					seconds=taches_settings()['DELAI_VERROU'] + 1))
+		self.assertEqual(TacheAdmission.reserver().pk, tache.pk)
+		self.assertIsNone(TacheAdmission.reserver())
+
+	@override_settings(TACHES={'TENTATIVES': 3, 'ATTENTE_INITIALE': 10,
+		'ATTENTE_MAX': 15})
+	def test_echec_puis_abandon(self):
+		self.mettre_en_file(1)
+		for tentatives, attente in ((1, 10), (2, 15)):
+			tache = TacheAdmission.reserver()
+			avant = timezone.now()
+			tache.echec("erreur {}".format(tentatives))
+			tache.refresh_from_db()
+			self.assertEqual(tache.etat, TacheAdmission.ETAT_ATTENTE)
+			self.assertEqual(tache.tentatives, tentatives)
+			self.assertEqual(tache.erreur, "erreur {}".format(tentatives))
+			self.assertGreaterEqual(tache.prochaine_tentative,
+					avant + datetime.timedelta(seconds=attente))
+			self.assertLessEqual(tache.prochaine_tentative,
+					timezone.now() + datetime.timedelta(seconds=attente))
+			self.assertIsNone(TacheAdmission.reserver())
+			TacheAdmission.objects.filter(pk=tache.pk).update(
+					prochaine_tentative=timezone.now())
+
+		tache = TacheAdmission.reserver()
+		tache.echec("erreur 3")
+		tache.refresh_from_db()
+		self.assertEqual(tache.etat, TacheAdmission.ETAT_ABANDONNEE)
+		self.assertEqual(tache.tentatives, 3)
+		self.assertIsNotNone(tache.date_fin)
+		self.assertIsNone(TacheAdmission.reserver())
+
+		tache.relancer()
+		self.assertEqual(TacheAdmission.reserver().pk, tache.pk)
+		self.assertEqual(TacheAdmission.objects.get(pk=tache.pk).tentatives, 0)
+
+	def test_differer(self):
+		self.mettre_en_file(1)
+		tache = TacheAdmission.reserver()
+		tache.differer(60)
+		tache.refresh_from_db()
+		self.assertEqual(tache.etat, TacheAdmission.ETAT_ATTENTE)
+		self.assertEqual(tache.tentatives, 0)
+		self.assertIsNone(tache.date_debut)
+		self.assertGreater(tache.prochaine_tentative, timezone.now())
+		self.assertIsNone(TacheAdmission.reserver())
+
+		TacheAdmission.objects.filter(pk=tache.pk).update(
+				prochaine_tentative=timezone.now())
+		self.assertEqual(TacheAdmission.reserver().pk, tache.pk)
+
+	def test_serialisation_par_dossier(self):
+		premiere, autre, seconde = self.mettre_en_file(1, 2, 1)
+		# Deux travailleurs ne traitent jamais en même temps deux
+		# admissions du même dossier
+		self.assertEqual([tache.pk for tache in TacheAdmission.reserver_lot(3)],
+				[premiere.pk, autre.pk])
+
+		# Tant que la première admission n'est pas importée, y compris
+		# après un échec, la seconde attend
+		premiere.echec("erreur")
+		TacheAdmission.objects.filter(pk=premiere.pk).update(
+				prochaine_tentative=timezone.now()
+				- datetime.timedelta(minutes=1))
+		self.assertEqual(TacheAdmission.reserver().pk, premiere.pk)
+		self.assertIsNone(TacheAdmission.reserver())
+
+		# Une admission abandonnée ne bloque pas le dossier
+		TacheAdmission.objects.filter(pk=premiere.pk).update(
+				etat=TacheAdmission.ETAT_ABANDONNEE)
+		self.assertEqual(TacheAdmission.reserver().pk, seconde.pk)
+
+	def test_admission_perimee(self):
+		# Le candidat accepte définitivement, puis se ravise et
+		# maintient d'autres vœux
+		premiere = TacheAdmission.objects.create(user=self.parcoursup,
+				donnees=json.dumps(admission_json(1, codeSituation=1)),
+				dossier_parcoursup=1, url_base='https://inscrire.example.com/')
+		seconde = TacheAdmission.objects.create(user=self.parcoursup,
+				donnees=json.dumps(admission_json(1, codeSituation=2)),
+				dossier_parcoursup=1, url_base='https://inscrire.example.com/')
+		self.assertTrue(TacheAdmission.reserver().traiter())
+		self.assertTrue(TacheAdmission.reserver().traiter())
+		voeu = Voeu.objects.get(candidat__dossier_parcoursup=1)
+		self.assertEqual(voeu.etat, Voeu.ETAT_ACCEPTE_AUTRES)
+
+		# Relancer l'ancienne admission ne revient pas sur la réponse
+		# plus récente du candidat
+		premiere.refresh_from_db()
+		premiere.relancer()
+		self.assertTrue(TacheAdmission.reserver().traiter())
+		voeu.refresh_from_db()
+		self.assertEqual(voeu.etat, Voeu.ETAT_ACCEPTE_AUTRES)
+		self.assertIsNotNone(TacheAdmission.objects.get(pk=seconde.pk).candidat)
+
+class EmpreinteAdmissionTests(InscriptionTestCase):
+	def test_empreinte(self):
+		donnees = admission_json(1)
+		empreinte = ParcoursupRest.empreinte_admission(donnees)
+		# Indépendante de l'ordre des clés et de l'identification
+		self.assertEqual(ParcoursupRest.empreinte_admission(
+			dict(reversed(list(donnees.items())), identifiant='psup42')),
+			empreinte)
+		self.assertNotEqual(ParcoursupRest.empreinte_admission(
+			dict(donnees, codeSituation=2)), empreinte)
+		self.assertNotEqual(ParcoursupRest.empreinte_admission(
+			admission_json(2)), empreinte)
+
+	def test_admission_deja_traitee(self):
+		donnees = admission_json(1, codeSituation=1)
+		empreinte = ParcoursupRest.empreinte_admission(donnees)
+		psup = ParcoursupRest.parse_parcoursup_admission(donnees)
+		self.assertFalse(self.parcoursup.admission_deja_traitee(psup,
+			empreinte))
+
+		candidat = self.parcoursup.import_candidat(psup, empreinte=empreinte)
+		self.assertTrue(self.parcoursup.admission_deja_traitee(psup,
+			empreinte))
+		autre = admission_json(1, codeSituation=2)
+		self.assertFalse(self.parcoursup.admission_deja_traitee(
+			ParcoursupRest.parse_parcoursup_admission(autre),
+			ParcoursupRest.empreinte_admission(autre)))
+
+		# Le vœu a été modifié depuis chez nous : l'import doit être
+		# refait
+		Voeu.objects.filter(candidat=candidat).update(
+				etat=Voeu.ETAT_ACCEPTE_AUTRES)
+		self.assertFalse(self.parcoursup.admission_deja_traitee(psup,
+			empreinte))
+
+	def test_admission_en_file(self):
+		donnees = admission_json(1)
+		empreinte = ParcoursupRest.empreinte_admission(donnees)
+		psup = ParcoursupRest.parse_parcoursup_admission(donnees)
+		message = ParcoursupMessageRecuLog.objects.create(
+				date=timezone.now(), ip_source='127.0.0.1',
+				user=self.parcoursup, endpoint='admissionCandidat',
+				message="", succes=True, empreinte=empreinte)
+		tache = TacheAdmission.objects.create(user=self.parcoursup,
+				message=message, donnees=json.dumps(donnees),
+				dossier_parcoursup=1, url_base='https://inscrire.example.com/')
+		self.assertTrue(self.parcoursup.admission_deja_traitee(psup,
+			empreinte))
+
+		# Une admission abandonnée doit pouvoir être renvoyée
+		TacheAdmission.objects.filter(pk=tache.pk).update(
+				etat=TacheAdmission.ETAT_ABANDONNEE)
+		self.assertFalse(self.parcoursup.admission_deja_traitee(psup,
+			empreinte))
+
+class FicheTests(InscriptionTestCase):
+	def test_import_fiches_polymorphiques(self):
+		candidat = self.candidat(1, internat="1")
+
+		fiches = {type(fiche): fiche
+			for fiche in Fiche.objects.filter(candidat=candidat)}
+		self.assertEqual(set(fiches),
+				set(all_fiche) - {FicheCesure})
+		self.assertIsInstance(fiches[FicheInternat], FicheInternat)
+		self.assertEqual(fiches[FicheIdentite].telephone, '0600000000')
+		self.assertEqual(fiches[FicheIdentite].adresse, candidat.adresse)
+		self.assertEqual(list(fiches[FicheIdentite].responsables.order_by(
+			'pk')), list(candidat.responsables.order_by('pk')))
+		self.assertEqual(fiches[FicheScolarite].formation, self.formation)
+		self.assertEqual(fiches[FicheHebergement].regime,
+				FicheHebergement.REGIME_INTERNE)
+		for fiche in fiches.values():
+			self.assertEqual(type(fiche).objects.get(pk=fiche.pk).candidat,
+					candidat)
+
+	def test_inserer_plusieurs_candidats(self):
+		# Des fiches existent déjà pour un autre candidat : les clés
+		# primaires des nouvelles lignes doivent être retrouvées sans
+		# confusion.
+		self.candidat(1)
+		candidats = [self.candidat(code) for code in (2, 3)]
+		for fiche_kls in (FicheIdentite, FicheHebergement):
+			fiche_kls.objects.filter(candidat__in=candidats).delete()
+
+		fiches = [
+			FicheHebergement(candidat=candidats[0],
+				regime=FicheHebergement.REGIME_EXTERNE),
+			FicheIdentite(candidat=candidats[1], telephone='0611111111'),
+			FicheHebergement(candidat=candidats[1],
+				regime=FicheHebergement.REGIME_DEMIPENSIONNAIRE),
+			FicheIdentite(candidat=candidats[0], telephone='0622222222'),
+		]
+		Fiche.objects._inserer(fiches)
+
+		self.assertEqual(len({fiche.pk for fiche in fiches}), len(fiches))
+		for fiche in fiches:
+			relue = Fiche.objects.get(pk=fiche.pk)
+			self.assertIs(type(relue), type(fiche))
+			self.assertEqual(relue.candidat_id, fiche.candidat_id)
+			self.assertEqual(relue.etat, Fiche.ETAT_EDITION)
+		self.assertEqual(Fiche.objects.get(pk=fiches[0].pk).regime,
+				FicheHebergement.REGIME_EXTERNE)
+		self.assertEqual(Fiche.objects.get(pk=fiches[1].pk).telephone,
+				'0611111111')
+		self.assertEqual(Fiche.objects.get(pk=fiches[2].pk).regime,
+				FicheHebergement.REGIME_DEMIPENSIONNAIRE)
+		self.assertEqual(Fiche.objects.get(pk=fiches[3].pk).telephone,
+				'0622222222')
+		for candidat in candidats:
+			for fiche_kls in (FicheIdentite, FicheHebergement):
+				self.assertEqual(fiche_kls.objects.filter(
+					candidat=candidat).count(), 1)
+
+	def test_inserer_concurrence(self):
+		# Un autre processus insère au même moment une fiche de même
+		# classe pour le même candidat : elle ne doit pas être confondue
+		# avec la fiche insérée ici.
+		candidat = self.candidat(1)
+		FicheHebergement.objects.filter(candidat=candidat).delete()
+		fiche = FicheHebergement(candidat=candidat,
+				regime=FicheHebergement.REGIME_EXTERNE)
+		concurrentes = []
+
+		def concurrent(execute, sql, params, many, context):
+			resultat = execute(sql, params, many, context)
+			if not concurrentes and sql.startswith('INSERT INTO "{}"'.format(
+					Fiche._meta.db_table)):
+				concurrentes.append(Fiche(candidat=candidat,
+					polymorphic_ctype=ContentType.objects.get_for_model(
+						FicheHebergement)))
+				Fiche._base_manager.bulk_create(concurrentes)
+			return resultat
+
+		with connection.execute_wrapper(concurrent):
+			Fiche.objects._inserer([fiche])
+		# La ligne insérée ici est la première des deux
+		self.assertEqual(Fiche.objects.non_polymorphic().filter(
+			candidat=candidat, polymorphic_ctype=concurrentes[0].polymorphic_ctype
+			).order_by('pk').values_list('pk', flat=True)[0], fiche.pk)
+		self.assertEqual(FicheHebergement.objects.get(pk=fiche.pk).regime,
+				FicheHebergement.REGIME_EXTERNE)
+
+	def test_reimport_sans_doublon(self):
+		candidat = self.candidat(1)
+		nombre = Fiche.objects.filter(candidat=candidat).count()
+		self.candidat(1, internat="1")
+		self.assertEqual(Fiche.objects.filter(candidat=candidat).count(),
+				nombre + 1)
+		self.assertTrue(FicheInternat.objects.filter(candidat=candidat).exists())
+
+class DossierEtatTests(InscriptionTestCase):
+	def assertDossiersConformes(self):
+		"""
+		Compare les candidats de chaque état, lus dans DossierEtat, à
+		ceux obtenus en interrogeant directement les fiches et les vœux.
+		"""
+		etablissement = Etablissement.objects.get(pk=self.etablissement.pk)
+		candidats = etablissement.candidats
+		attendus = {
+			DossierEtat.ETAT_EDITION: candidats.filter(
+				fiche__in=etablissement.fiches_edition_candidats),
+			DossierEtat.ETAT_COMPLET: candidats.exclude(
+				fiche__in=etablissement.fiches_edition_candidats).filter(
+				fiche__in=etablissement.fiches_non_terminees_lycee),
+			DossierEtat.ETAT_TERMINE: candidats.exclude(
+				fiche__in=etablissement.fiches_non_terminees_lycee),
+			DossierEtat.ETAT_DEMISSION: Candidat.objects.filter(
+				voeu__in=Voeu.objects.filter(
+					formation__etablissement=etablissement,
+					etat=Voeu.ETAT_REFUSE)),
+		}
+		for etat, candidats_etat in attendus.items():
+			self.assertEqual(set(etablissement.candidats_etat(etat)),
+					set(candidats_etat),
+					"état {}".format(etat))
+
+	def enregistrer_fiches(self, candidat, etat, exclure=()):
+		for fiche in Fiche.objects.filter(candidat=candidat):
+			if type(fiche) not in exclure:
+				fiche.etat = etat
+				fiche.save()
+
+	def test_fiches_et_voeux(self):
+		candidats = [self.candidat(code) for code in range(1, 5)]
+		self.assertDossiersConformes()
+		self.assertEqual(self.etablissement.candidats_etat(
+			DossierEtat.ETAT_EDITION).count(), 4)
+
+		self.enregistrer_fiches(candidats[0], Fiche.ETAT_CONFIRMEE)
+		self.enregistrer_fiches(candidats[1], Fiche.ETAT_TERMINEE)
+		self.assertDossiersConformes()
+		self.assertEqual(candidats[0].voeu_set.get().dossier.etat,
+				DossierEtat.ETAT_COMPLET)
+		self.assertEqual(candidats[1].voeu_set.get().dossier.etat,
+				DossierEtat.ETAT_TERMINE)
+
+		voeu = candidats[2].voeu_set.get()
+		voeu.etat = Voeu.ETAT_REFUSE
+		voeu.save()
+		self.assertDossiersConformes()
+		self.assertEqual(Voeu.objects.get(pk=voeu.pk).dossier.etat,
+				DossierEtat.ETAT_DEMISSION)
+
+		fiche = FicheHebergement.objects.get(candidat=candidats[1])
+		fiche.etat = Fiche.ETAT_EDITION
+		fiche.save()
+		self.assertDossiersConformes()
+		self.assertEqual(candidats[1].voeu_set.get().dossier.etat,
+				DossierEtat.ETAT_EDITION)
+
+		# Les autres fiches du candidat sont terminées
+		fiche.delete()
+		self.assertDossiersConformes()
+		self.assertEqual(candidats[1].voeu_set.get().dossier.etat,
+				DossierEtat.ETAT_TERMINE)
+
+	def test_fiches_etablissement(self):
+		candidats = [self.candidat(code) for code in range(1, 3)]
+		self.enregistrer_fiches(candidats[0], Fiche.ETAT_CONFIRMEE,
+				exclure=(FicheHebergement,))
+		self.assertDossiersConformes()
+		self.assertEqual(candidats[0].voeu_set.get().dossier.etat,
+				DossierEtat.ETAT_EDITION)
+
+		# L'établissement n'utilise plus la fiche restée en édition
+		self.etablissement.fiches.remove(
+				ContentType.objects.get_for_model(FicheHebergement))
+		configurations._vider()
+		self.assertDossiersConformes()
+		self.assertEqual(candidats[0].voeu_set.get().dossier.etat,
+				DossierEtat.ETAT_COMPLET)
+
+	def test_import_lot(self):
+		self.candidat(1)
+		self.parcoursup.import_candidats([admission(code) for code in range(2, 6)]
+				+ [admission(1, codeSituation=3)])
+		self.assertDossiersConformes()
+		self.assertEqual(DossierEtat.objects.count(), 5)
+
+
+class StatistiquesTests(InscriptionTestCase):
+	def compteurs(self):
+		formation, = formations_avec_compteurs(
+				Formation.objects.filter(pk=self.formation.pk))
+		return formation.compteurs
+
+	def test_compteurs(self):
+		candidats = [self.candidat(code) for code in range(1, 5)]
+		for fiche in Fiche.objects.filter(candidat=candidats[0]):
+			fiche.etat = Fiche.ETAT_TERMINEE
+			fiche.save()
+		voeu = candidats[1].voeu_set.get()
+		voeu.etat = Voeu.ETAT_REFUSE
+		voeu.save()
+		self.assertEqual(self.compteurs(), {'total': 3, 'edition': 2,
+			'complet': 0, 'termine': 1, 'demission': 1})
+
+		# Les compteurs sont conservés en cache…
+		with self.assertNumQueries(1):
+			self.compteurs()
+
+		# … jusqu'au prochain changement d'état d'un dossier
+		for fiche in Fiche.objects.filter(candidat=candidats[2]):
+			fiche.etat = Fiche.ETAT_CONFIRMEE
+			fiche.save()
+		self.assertEqual(self.compteurs(), {'total': 3, 'edition': 1,
+			'complet': 1, 'termine': 1, 'demission': 1})
+
+	def test_formation_sans_candidat(self):
+		self.assertEqual(self.compteurs(), {'total': 0, 'edition': 0,
+			'complet': 0, 'termine': 0, 'demission': 0})
+
+class ExportCandidatsAdmisTests(InscriptionTestCase):
+	def setUp(self):
+		super().setUp()
+		self.client.force_login(InscrireUser.objects.create_user(
+			email='direction@example.com', role=InscrireUser.ROLE_DIRECTION))
+
+	def exporter(self):
+		reponse = self.client.get(reverse('formation_export',
+			args=[self.formation.slug]))
+		self.assertEqual(reponse.status_code, 200)
+		self.assertTrue(reponse.streaming)
+		self.assertEqual(reponse['Content-Disposition'],
+				'attachment; filename = admis_mpsi.csv')
+		return list(csv.reader(io.StringIO(b''.join(
+			reponse.streaming_content).decode('utf-8')), delimiter=';'))
+
+	def test_export(self):
+		for code in range(1, 4):
+			self.candidat(code)
+		entete, *lignes = self.exporter()
+		self.assertEqual(entete[:4], ['Parcoursup', 'Classement', 'Nom',
+			'Prénom'])
+		self.assertEqual(sorted(ligne[0] for ligne in lignes),
+				['1', '2', '3'])
+		self.assertEqual({tuple(ligne[2:6]) for ligne in lignes},
+				{('Dupont', 'Hector', '{:09d}AB'.format(code), 'Edition')
+					for code in range(1, 4)})
+
+	def test_nombre_requetes(self):
+		# Le nombre de requêtes ne dépend pas du nombre de candidats
+		self.candidat(1)
+		with CaptureQueriesContext(connection) as un:
+			self.exporter()
+		for code in range(2, 6):
+			self.candidat(code)
+		with CaptureQueriesContext(connection) as cinq:
+			self.assertEqual(len(self.exporter()), 6)
+		self.assertEqual(len(cinq), len(un))
+
+class TacheExportTests(InscriptionTestCase):
+	def setUp(self):
+		super().setUp()
+		repertoire = tempfile.TemporaryDirectory()
+		self.addCleanup(repertoire.cleanup)
+		reglages = override_settings(EXPORTS_ROOT=repertoire.name)
+		reglages.enable()
+		self.addCleanup(reglages.disable)
+		self.repertoire = repertoire.name
+		for code in range(1, 4):
+			self.candidat(code)
+
+	def exporter(self, format):
+		TacheExport.objects.create(etablissement=self.etablissement,
+				format=format, url_base='https://inscrire.example.com/')
+		tache = TacheExport.reserver()
+		self.assertTrue(tache.traiter())
+		tache.refresh_from_db()
+		return tache
+
+	def test_stockage_prive(self):
+		premiere = self.exporter(TacheExport.FORMAT_CSV)
+		seconde = self.exporter(TacheExport.FORMAT_CSV)
+		self.assertEqual(premiere.avance, 3)
+		self.assertEqual(premiere.progression, 100)
+		chemin = premiere.fichier.path
+		self.assertEqual(os.path.dirname(chemin), self.repertoire)
+		self.assertFalse(os.path.abspath(chemin).startswith(
+			os.path.abspath(settings.MEDIA_ROOT)))
+		# Nom imprévisible, et pas d'adresse publique
+		self.assertNotEqual(premiere.fichier.name,
+				"admis_0420041S_{}.csv".format(premiere.pk))
+		self.assertNotEqual(premiere.fichier.name.replace(
+			str(premiere.pk), str(seconde.pk)), seconde.fichier.name)
+		with self.assertRaises(ValueError):
+			premiere.fichier.url
+
+		with premiere.fichier.open('rb') as fichier:
+			entete, *lignes = csv.reader(io.StringIO(
+				fichier.read().decode('utf-8')), delimiter=';')
+		self.assertEqual(entete[:2], ['Formation', 'Parcoursup'])
+		self.assertEqual(sorted(ligne[1] for ligne in lignes),
+				['1', '2', '3'])
+
+	def test_relance(self):
+		tache = self.exporter(TacheExport.FORMAT_CSV)
+		ancien = tache.fichier.path
+		tache.relancer()
+		tache = TacheExport.reserver()
+		self.assertTrue(tache.traiter())
+		self.assertFalse(os.path.exists(ancien))
+		self.assertEqual(os.listdir(self.repertoire),
+				[os.path.basename(tache.fichier.name)])
+
+	def test_zip(self):
+		tache = self.exporter(TacheExport.FORMAT_ZIP)
+		with tache.fichier.open('rb') as fichier, \
+				zipfile.ZipFile(fichier) as archive:
+			self.assertEqual(archive.namelist(),
+					['candidats.csv', 'responsables.csv'])
+
+	def test_telechargement(self):
+		tache = self.exporter(TacheExport.FORMAT_CSV)
+		url = reverse('export_telechargement', args=[tache.pk])
+		self.client.force_login(InscrireUser.objects.create_user(
+			email='professeur@example.com', role=InscrireUser.ROLE_PROFESSEUR))
+		self.assertEqual(self.client.get(url).status_code, 403)
+
+		self.client.force_login(InscrireUser.objects.create_user(
+			email='direction@example.com', role=InscrireUser.ROLE_DIRECTION))
+		reponse = self.client.get(url)
+		self.assertEqual(reponse.status_code, 200)
+		self.assertEqual(reponse['Content-Disposition'],
+				'attachment; filename="admis_0420041S_{}.csv"'.format(tache.pk))
+		with tache.fichier.open('rb') as fichier:
+			self.assertEqual(b''.join(reponse.streaming_content),
+					fichier.read())
+
+class MailingTests(InscriptionTestCase):
+	def setUp(self):
+		super().setUp()
+		self.candidats = [self.candidat(code) for code in range(1, 6)]
+		self.mailing = self.nouveau_mailing()
+
+	def nouveau_mailing(self):
+		return Mailing.objects.create(de='lycee@example.com',
+				repondre_a='lycee@example.com',
+				etablissement=self.etablissement, copie_responsables=True,
+				sujet="Rentrée", message="Bonjour")
+
+	def assertEnvoisUniques(self, candidats):
+		"""Chaque candidat a reçu le message une fois et une seule"""
+		envois = Envoi.objects.filter(mailing=self.mailing)
+		self.assertEqual(sorted(envois.values_list('candidat', flat=True)),
+				sorted(candidat.pk for candidat in candidats))
+		self.assertEqual(sorted(Courriel.objects.filter(
+			envoi__mailing=self.mailing).values_list('candidat', flat=True)),
+			sorted(candidat.pk for candidat in candidats))
+		self.assertEqual(Envoi.responsables.through.objects.filter(
+			envoi__mailing=self.mailing).count(),
+			ResponsableLegal.objects.filter(candidat__in=candidats).exclude(
+				email="").count())
+		self.assertFalse(self.mailing.destinataires.filter(
+			en_file=False).exists())
+
+	def test_envoyer_deux_fois(self):
+		self.mailing.send()
+		self.assertEnvoisUniques(self.candidats)
+		self.assertFalse(Mailing.objects.get(pk=self.mailing.pk).brouillon)
+
+		self.mailing.send()
+		self.assertEnvoisUniques(self.candidats)
+
+		# Seul un nouveau candidat reçoit le message
+		nouveau = self.candidat(6)
+		self.mailing.send()
+		self.assertEnvoisUniques(self.candidats + [nouveau])
+
+	def test_nombre_requetes(self):
+		# Dans un même lot, le nombre de requêtes ne dépend pas du
+		# nombre de destinataires
+		with CaptureQueriesContext(connection) as cinq:
+			self.mailing.send()
+		for code in range(6, 11):
+			self.candidat(code)
+		self.mailing = self.nouveau_mailing()
+		with CaptureQueriesContext(connection) as dix:
+			self.mailing.send()
+		self.assertEnvoisUniques(Candidat.objects.all())
+		self.assertEqual(len(dix), len(cinq))
+
+	@override_settings(MAILING_TAILLE_LOT=2)
+	def test_reprise_apres_interruption(self):
+		mettre_en_file_lot = Mailing.mettre_en_file_lot
+		lots = []
+
+		def interrompu(mailing, pks):
+			if lots:
+				raise RuntimeError("interruption")
+			lots.append(pks)
+			return mettre_en_file_lot(mailing, pks)
+
+		with mock.patch.object(Mailing, 'mettre_en_file_lot', interrompu):
+			with self.assertRaises(RuntimeError):
+				self.mailing.send()
+		self.assertEqual(Envoi.objects.filter(mailing=self.mailing).count(), 2)
+		self.assertEqual(Destinataire.objects.filter(mailing=self.mailing,
+			en_file=True).count(), 2)
+
+		self.mailing.send()
+		self.assertEnvoisUniques(self.candidats)
+		self.mailing.send()
+		self.assertEnvoisUniques(self.candidats)
+
+	def test_criteres_voeu(self):
+		interne = self.candidat(6, internat="1")
+		self.mailing.internat = True
+		self.assertEqual(list(self.mailing.destinataires_possibles()),
+				[interne])
+		self.mailing.internat = False
+		self.assertEqual(set(self.mailing.destinataires_possibles()),
+				set(self.candidats))
+
+		# L'état du dossier remplace le critère d'acceptation définitive
+		self.mailing.internat = None
+		self.mailing.etat_dossier = DossierEtat.ETAT_TERMINE
+		self.assertFalse(self.mailing.destinataires_possibles().exists())
+		for fiche in Fiche.objects.filter(candidat=interne):
+			fiche.etat = Fiche.ETAT_TERMINEE
+			fiche.save()
+		self.assertEqual(list(self.mailing.destinataires_possibles()),
+				[interne])
+
+	def test_progression(self):
+		self.mailing.send()
+		with self.assertNumQueries(2):
+			mailing, = Mailing.ajouter_progression([self.mailing])
+		self.assertEqual((mailing.destinataires_total,
+			mailing.destinataires_en_file, mailing.envoyes, mailing.echecs),
+			(5, 5, 0, 0))
+
+		Courriel.traiter_lot(Courriel.reserver_lot(10))
+		mailing, = Mailing.ajouter_progression([self.mailing])
+		self.assertEqual((mailing.envoyes, mailing.echecs), (5, 0))
+
+class CourrielTests(TestCase):
+	def mettre_en_file(self, nombre, expediteur='lycee@example.com'):
+		return [Courriel.objects.mettre_en_file(
+			sujet="Message {}".format(i), message="Bonjour",
+			expediteur=expediteur, repondre_a='secretariat@example.com',
+			destinataires=['candidat{}@example.com'.format(i)],
+			copie=['parent{}@example.com'.format(i)])
+			for i in range(nombre)]
+
+	def test_envoi_par_lot(self):
+		self.mettre_en_file(3)
+		# Rien n'est envoyé avant le passage du travailleur
+		self.assertEqual(mail.outbox, [])
+
+		connexions = []
+
+		def get_connection(*args, **kwargs):
+			connexions.append(mail.get_connection(*args, **kwargs))
+			return connexions[-1]
+
+		with mock.patch('inscrire.models.courriels.get_connection',
+				get_connection):
+			self.assertEqual(Courriel.traiter_lot(Courriel.reserver_lot(5)),
+					[True, True, True])
+		self.assertEqual(len(connexions), 1)
+		self.assertEqual(sorted(message.to for message in mail.outbox),
+				[['candidat{}@example.com'.format(i)] for i in range(3)])
+		message = mail.outbox[0]
+		self.assertEqual(len(message.cc), 1)
+		self.assertEqual(message.reply_to, ['secretariat@example.com'])
+		self.assertFalse(Courriel.objects.exclude(
+			etat=Courriel.ETAT_TERMINEE).exists())
+
+	def test_echec(self):
+		premier, second = self.mettre_en_file(2)
+		envoyer = mail.EmailMultiAlternatives.send
+
+		def echec(email, *args, **kwargs):
+			if email.subject == premier.sujet:
+				raise OSError("serveur injoignable")
+			return envoyer(email, *args, **kwargs)
+
+		with mock.patch.object(mail.EmailMultiAlternatives, 'send', echec):
+			self.assertEqual(Courriel.traiter_lot(Courriel.reserver_lot(5)),
+					[False, True])
+		premier.refresh_from_db()
+		self.assertEqual(premier.etat, Courriel.ETAT_ATTENTE)
+		self.assertIn("serveur injoignable", premier.erreur)
+		self.assertEqual([message.subject for message in mail.outbox],
+				[second.sujet])
+
+	@override_settings(COURRIELS_DEBIT_MAX=2)
+	def test_debit_max(self):
+		courriels = self.mettre_en_file(3)
+		autre, = self.mettre_en_file(1, expediteur='autre@example.com')
+		self.assertEqual(Courriel.traiter_lot(Courriel.reserver_lot(5)),
+				[True, True, None, True])
+		reporte = Courriel.objects.get(pk=courriels[2].pk)
+		self.assertEqual(reporte.etat, Courriel.ETAT_ATTENTE)
+		self.assertEqual(reporte.tentatives, 0)
+		self.assertGreater(reporte.prochaine_tentative, timezone.now())
+		self.assertEqual(len(mail.outbox), 3)
+
+		# Le débit est décompté sur la dernière minute, d'un lot à l'autre
+		self.mettre_en_file(1)
+		self.assertEqual(Courriel.traiter_lot(Courriel.reserver_lot(5)),
+				[None])
+
+class GabaritsTests(InscriptionTestCase):
+	def setUp(self):
+		super().setUp()
+		gabarits.vider_cache()
+		self.addCleanup(gabarits.vider_cache)
+
+	def test_noms_gabarit(self):
+		self.assertEqual(gabarits.noms_gabarit('email', 'subject.txt',
+			'0420041S', 'mpsi'), [
+				'inscrire/0420041S/mpsi/email_subject.txt',
+				'inscrire/0420041S/email_subject.txt',
+				'inscrire/email_subject.txt'])
+		self.assertEqual(gabarits.noms_gabarit('email', 'message.html'),
+				['inscrire/email_message.html'])
+
+	def test_gabarit_etablissement(self):
+		with tempfile.TemporaryDirectory() as repertoire:
+			os.makedirs(os.path.join(repertoire, 'inscrire', '0420041S'))
+			with open(os.path.join(repertoire, 'inscrire', '0420041S',
+					'email_bienvenue_candidat_subject.txt'), 'w') as f:
+				f.write("Bienvenue en {{ formation.nom }}")
+			moteurs = [dict(settings.TEMPLATES[0], DIRS=[repertoire])]
+			with override_settings(TEMPLATES=moteurs):
+				sujet, texte, html = gabarits.rendre_courriel(
+						'email_bienvenue_candidat',
+						{'formation': self.formation}, formation=self.formation)
+				autre, _, _ = gabarits.rendre_courriel(
+						'email_bienvenue_candidat', {})
+		self.assertEqual(sujet, "Bienvenue en MPSI")
+		self.assertEqual(autre,
+				"Inscription administrative en classe préparatoire")
+
+	def test_cache(self):
+		select_template = gabarits.select_template
+		with mock.patch('inscrire.lib.gabarits.select_template',
+				side_effect=select_template) as recherche:
+			for _ in range(2):
+				gabarits.gabarits_courriel('email_bienvenue_candidat',
+						formation=self.formation)
+			self.assertEqual(recherche.call_count, len(gabarits.PARTIES))
+
+			# En mode DEBUG, les gabarits sont relus à chaque fois
+			with self.settings(DEBUG=True):
+				gabarits.gabarits_courriel('email_bienvenue_candidat',
+						formation=self.formation)
+			self.assertEqual(recherche.call_count, 2 * len(gabarits.PARTIES))
+
+	@override_settings(MODE=settings.MODE_FONCTION)
+	def test_emails_bienvenue(self):
+		candidats = [self.candidat(code) for code in range(1, 4)]
+		select_template = gabarits.select_template
+		with mock.patch('inscrire.lib.gabarits.select_template',
+				side_effect=select_template) as recherche:
+			Candidat.emails_bienvenue(candidats,
+					url_base='https://inscrire.example.com/')
+		self.assertEqual(recherche.call_count, len(gabarits.PARTIES))
+		courriels = Courriel.objects.order_by('candidat')
+		self.assertEqual([courriel.candidat for courriel in courriels],
+				candidats)
+		self.assertTrue(all('https://inscrire.example.com/' in courriel.message
+			for courriel in courriels))
+		self.assertFalse(Candidat.objects.filter(
+			email_bienvenue_envoye=False).exists())
+
+		# L'e-mail n'est pas renvoyé
+		Candidat.emails_bienvenue(candidats,
+				url_base='https://inscrire.example.com/')
+		self.assertEqual(Courriel.objects.count(), 3)
+
+NOMENCLATURE = """<?xml version="1.0" encoding="UTF-8"?>
+<BEE_NOMENCLATURES>
+<PARAMETRES>
+<UAJ>0420041S</UAJ>
+<ANNEE_SCOLAIRE>2020</ANNEE_SCOLAIRE>
+<DATE_EXPORT>01/09/2020</DATE_EXPORT>
+<HORODATAGE>01/09/2020 08:30:00</HORODATAGE>
+</PARAMETRES>
+<DONNEES>
+<PROGRAMMES>
+<PROGRAMME><CODE_MEF>30111111111</CODE_MEF><CODE_MATIERE>061300</CODE_MATIERE>
+<CODE_MODALITE_ELECT>S</CODE_MODALITE_ELECT><HORAIRE>12</HORAIRE></PROGRAMME>
+</PROGRAMMES>
+<MEFS>
+<MEF CODE_MEF="30111111111"><FORMATION>MPSI</FORMATION>
+<LIBELLE_LONG>MATHS PHYSIQUE SCIENCES INGENIEUR</LIBELLE_LONG>
+<NB_OPT_OBLIG>1</NB_OPT_OBLIG></MEF>
+<MEF CODE_MEF="30111111112"><FORMATION>PCSI</FORMATION>
+<LIBELLE_LONG>PHYSIQUE CHIMIE SCIENCES INGENIEUR</LIBELLE_LONG></MEF>
+</MEFS>
+<MATIERES>
+<MATIERE CODE_MATIERE="061300"><CODE_GESTION>MATHS</CODE_GESTION>
+<LIBELLE_COURT>MATHS</LIBELLE_COURT><LIBELLE_LONG>MATHEMATIQUES</LIBELLE_LONG>
+<LIBELLE_EDITION>Mathématiques</LIBELLE_EDITION><MATIERE_ETP>0</MATIERE_ETP></MATIERE>
+<MATIERE CODE_MATIERE="030201"><CODE_GESTION>AGL1</CODE_GESTION>
+<LIBELLE_COURT>ANGLAIS LV1</LIBELLE_COURT><LIBELLE_LONG>ANGLAIS LV1</LIBELLE_LONG>
+<LIBELLE_EDITION>Anglais LV1</LIBELLE_EDITION><MATIERE_ETP>0</MATIERE_ETP></MATIERE>
+</MATIERES>
+<OPTIONS_OBLIGATOIRES>
+<OPTION_OBLIGATOIRE><CODE_MEF>30111111111</CODE_MEF><CODE_MATIERE>030201</CODE_MATIERE>
+<RANG_OPTION>1</RANG_OPTION></OPTION_OBLIGATOIRE>
+</OPTIONS_OBLIGATOIRES>
+</DONNEES>
+</BEE_NOMENCLATURES>
+""".encode('utf-8')
+
+STRUCTURES = """<?xml version="1.0" encoding="UTF-8"?>
+<BEE_STRUCTURES>
+<PARAMETRES>
+<UAJ>0420041S</UAJ>
+<ANNEE_SCOLAIRE>2020</ANNEE_SCOLAIRE>
+<DATE_EXPORT>01/09/2020</DATE_EXPORT>
+<HORODATAGE>01/09/2020 08:30:00</HORODATAGE>
+</PARAMETRES>
+<DONNEES>
+<DIVISIONS>
+<DIVISION CODE_STRUCTURE="MPSI1"><MEFS_APPARTENANCE>
+<MEF_APPARTENANCE><CODE_MEF>30111111111</CODE_MEF></MEF_APPARTENANCE>
+</MEFS_APPARTENANCE></DIVISION>
+<DIVISION CODE_STRUCTURE="SUP"><MEFS_APPARTENANCE>
+<MEF_APPARTENANCE><CODE_MEF>30111111111</CODE_MEF></MEF_APPARTENANCE>
+<MEF_APPARTENANCE><CODE_MEF>30111111112</CODE_MEF></MEF_APPARTENANCE>
+</MEFS_APPARTENANCE></DIVISION>
+</DIVISIONS>
+</DONNEES>
+</BEE_STRUCTURES>
+""".encode('utf-8')
+
+class ExportSiecleTests(SimpleTestCase):
+	def test_elements_comme_findall(self):
+		# Même résultat que l'ancienne lecture par findall, y compris
+		# avec plusieurs lectures successives du même fichier
+		racine = ElementTree.fromstring(NOMENCLATURE)
+		export = Nomenclature(io.BytesIO(NOMENCLATURE))
+		for chemins in (['DONNEES/MEFS/MEF'], ['DONNEES/MATIERES/*'],
+				['DONNEES/MEFS/MEF', 'DONNEES/PROGRAMMES/PROGRAMME']):
+			attendus = [ElementTree.tostring(element)
+				for chemin in chemins for element in racine.findall(chemin)]
+			lus = [ElementTree.tostring(element)
+				for _, element in export.elements(*chemins)]
+			self.assertEqual(sorted(lus), sorted(attendus))
+		self.assertEqual(list(export.elements('DONNEES/ELEVES/ELEVE')), [])
+
+	def test_parametres(self):
+		export = Structures(io.BytesIO(STRUCTURES))
+		self.assertEqual(export.parametres(), {
+			'uai': '0420041S',
+			'annee_scolaire': '2020',
+			'date_export': datetime.date(2020, 9, 1),
+			'horodatage': datetime.datetime(2020, 9, 1, 8, 30),
+		})
+
+	def test_nomenclature(self):
+		mefs = Nomenclature(io.BytesIO(NOMENCLATURE)).mefs()
+		self.assertEqual(set(mefs), {'30111111111', '30111111112'})
+		mpsi = mefs['30111111111']
+		self.assertEqual(mpsi.nb_opt_oblig, 1)
+		self.assertIsNone(mefs['30111111112'].nb_opt_oblig)
+		# Le programme précède les matières dans le fichier
+		self.assertEqual([(programme.matiere.code, programme.horaire)
+			for programme in mpsi.programme], [('061300', '12')])
+		self.assertEqual([(option.matiere.libelle_long, option.rang)
+			for option in mpsi.options_obligatoires], [('ANGLAIS LV1', 1)])
+		self.assertEqual(mefs['30111111112'].programme, [])
+
+	def test_structures(self):
+		export = Structures(io.BytesIO(STRUCTURES))
+		self.assertEqual(list(export.divisions()), [
+			('MPSI1', ['30111111111']),
+			('SUP', ['30111111111', '30111111112'])])
+		self.assertEqual(export.mefs(), {'30111111111', '30111111112'})
+
+class ComparaisonSiecleTests(InscriptionTestCase):
+	def eleve(self, structure, email="", ine="", options=()):
+		return {'nom': "Élève", 'prenom': "Test", 'structure': structure,
+				'email': email, 'ine': ine,
+				'options': [{'code_matiere': code} for code in options]}
+
+	def test_comparer(self):
+		candidats = [self.candidat(code) for code in range(1, 4)]
+		MefMatiere.objects.create(code='030201', libelle_court="ANGLAIS LV1",
+				libelle_long="ANGLAIS LV1", libelle_edition="Anglais LV1")
+		eleves = {
+			# Retrouvé par adresse e-mail
+			'e1': self.eleve('MPSI1', email=candidats[0].user.email,
+				options=['030201', '999999']),
+			# Retrouvé par INE
+			'e2': self.eleve('MPSI1', email='autre@example.com',
+				ine=candidats[1].ine),
+			'e3': self.eleve('MPSI1', email='inconnu@example.com'),
+			# Division d'une autre formation : ignoré
+			'e4': self.eleve('TS1', email=candidats[2].user.email),
+		}
+		comparaison = ComparaisonSiecle(self.etablissement, eleves,
+				{'30111111111': ['MPSI1']}).comparer()
+
+		self.assertEqual(list(comparaison.eleves_sans_candidat), ['e3'])
+		self.assertEqual(eleves['e2']['candidat'], candidats[1])
+		self.assertEqual([candidat for candidat, _ in
+			comparaison.candidats_sans_eleve], [candidats[2]])
+		self.assertEqual(comparaison.divergences,
+				[(candidats[0], 'MPSI1', ["ANGLAIS LV1", '999999'])])
+		self.assertEqual([ligne[0] for ligne in comparaison.lignes()], [
+			"Élève SIECLE sans candidat", "Candidat sans élève SIECLE",
+			"Options SIECLE non choisies"])
+		self.assertTrue(all(len(ligne) == len(comparaison.entete())
+			for ligne in comparaison.lignes()))
+
+	def test_nombre_requetes(self):
+		def comparer(nombre):
+			eleves = {code: self.eleve('MPSI1',
+				email='candidat{}@example.com'.format(code),
+				options=['030201'])
+				for code in range(1, nombre + 1)}
+			with CaptureQueriesContext(connection) as requetes:
+				ComparaisonSiecle(self.etablissement, eleves,
+						{'30111111111': ['MPSI1']}).comparer()
+			return len(requetes)
+
+		for code in range(1, 7):
+			self.candidat(code)
+		self.assertEqual(comparer(6), comparer(2))
+
+class ImportStructuresTests(InscriptionTestCase):
+	def importer(self, nomenclature=NOMENCLATURE):
+		return ImportStructures(self.etablissement,
+				Structures(io.BytesIO(STRUCTURES)),
+				Nomenclature(io.BytesIO(nomenclature))).executer()
+
+	def test_formations(self):
+		# Le slug pcsi est déjà pris dans un autre établissement
+		autre = Etablissement.objects.create(numero_uai='0690026D',
+				nom="Autre lycée", email='autre@example.com')
+		Formation.objects.create(nom="PCSI", code_mef='30122222222',
+				slug='pcsi', etablissement=autre)
+
+		resultat = self.importer()
+		self.assertEqual((resultat.formations_creees,
+			resultat.formations_modifiees), (1, 1))
+		self.assertEqual(dict(self.etablissement.formation_set.values_list(
+			'code_mef', 'slug')), {'30111111111': 'mpsi',
+				'30111111112': 'pcsi-1'})
+		self.assertEqual(Formation.objects.get(pk=self.formation.pk).nom,
+				"MATHS PHYSIQUE SCIENCES INGENIEUR")
+		self.assertTrue(Etablissement.objects.get(
+			pk=self.etablissement.pk).inscriptions)
+
+		# Un second import ne modifie plus rien
+		resultat = self.importer()
+		self.assertEqual(str(resultat), "0 formation(s) créée(s), "
+				"0 modifiée(s) ; 0 matière(s) créée(s), 0 modifiée(s) ; "
+				"0 option(s) créée(s), 0 supprimée(s), "
+				"0 conservée(s) car choisie(s) par des candidats")
+
+	def test_options(self):
+		nomenclature = NOMENCLATURE.replace(b'<CODE_MODALITE_ELECT>S',
+				b'<CODE_MODALITE_ELECT>F')
+		anglais = MefMatiere.objects.create(code='030201',
+				libelle_court="ANGLAIS", libelle_long="ANGLAIS",
+				libelle_edition="Anglais")
+		allemand = MefMatiere.objects.create(code='030101',
+				libelle_court="ALLEMAND", libelle_long="ALLEMAND",
+				libelle_edition="Allemand")
+		# Déclinaisons d'une option attendue : conservées
+		for detail in ("débutant", "continuant"):
+			MefOption.objects.create(formation=self.formation, rang=1,
+					modalite=MefOption.MODALITE_OBLIGATOIRE, matiere=anglais,
+					detail=detail, inscriptions=True)
+		# Options disparues de la nomenclature, dont l'une a été choisie
+		choisie, obsolete = [MefOption.objects.create(
+			formation=self.formation, rang=rang, matiere=allemand,
+			modalite=MefOption.MODALITE_OBLIGATOIRE) for rang in (2, 3)]
+		candidat = self.candidat(1)
+		FicheScolarite.objects.get(candidat=candidat).options.add(choisie)
+
+		resultat = self.importer(nomenclature)
+		self.assertEqual((resultat.matieres_creees,
+			resultat.matieres_modifiees), (1, 1))
+		self.assertEqual(MefMatiere.objects.get(pk='030201').libelle_edition,
+				"Anglais LV1")
+		self.assertEqual((resultat.options_creees,
+			resultat.options_supprimees, resultat.options_conservees),
+			(1, 1, 1))
+		options = MefOption.objects.filter(formation=self.formation)
+		self.assertEqual(sorted(options.values_list('matiere', 'rang',
+			'detail', 'inscriptions')), [
+				('030101', 2, "", False),
+				('030201', 1, "continuant", True),
+				('030201', 1, "débutant", True),
+				('061300', 0, "", False)])
+		self.assertFalse(MefOption.objects.filter(pk=obsolete.pk).exists())
+
+class ExportStandardTests(TestCase):
+	ENTETE = ['Numéro candidat', 'Nom', 'Prénom', 'e-mail du candidat',
+			'Date de Naissance', 'Etat civil', 'Adresse 1', 'Adresse 2',
+			'Code postal', 'Commune', 'Internat', 'date réponse']
+
+	def lire(self, lignes, entete=ENTETE):
+		fichier = io.StringIO()
+		writer = csv.writer(fichier, delimiter=';')
+		writer.writerow(entete)
+		writer.writerows(lignes)
+		fichier.seek(0)
+		return ExportStandard(fichier, '0420041S', 8842)
+
+	def test_entete(self):
+		with self.assertRaisesMessage(ExportInvalide,
+				"Colonne(s) absente(s) du fichier : Date de Naissance, "
+				"date réponse"):
+			self.lire([], entete=[nom for nom in self.ENTETE
+				if nom not in ('Date de Naissance', 'date réponse')])
+
+		# Noms de colonnes de l'export paramétrable
+		export = self.lire([['42', 'Dupont', 'Hector', 'hector@example.com',
+			'01/02/2003', 'M.', '1 rue de la Paix', '', '42000',
+			'Saint-Étienne', 'Avec internat', '10/07/2020 12:00']],
+			entete=['Numéro', 'Nom', 'Prénom', 'Adresse mail',
+				'Date de naissance', 'Civilité', 'Adresse 1', 'Adresse 2',
+				'Code postal', 'Commune', 'Internat obtenu', 'Date réponse'])
+		admission, = export.admissions()
+		self.assertEqual(admission['candidat'].code, '42')
+		self.assertEqual(admission['candidat'].email, 'hector@example.com')
+		self.assertTrue(admission['proposition'].internat)
+
+	def test_lignes(self):
+		export = self.lire([
+			['1', 'Dupont', 'Hector', 'hector@example.com', '01/02/2003',
+				'M.', '1 rue de la Paix', '', '42000', 'Saint-Étienne',
+				'oui', '10/07/2020 12:00'],
+			[],
+			['2', 'Durand', 'Alice', 'alice@example.com', '31/02/2003',
+				'Mme', '2 rue de la Paix', '', '42000', 'Saint-Étienne',
+				'non', '10/07/2020 12:00'],
+			['3', 'Martin', 'Paul', 'paul@example.com', '2003-02-01',
+				'M.', '3 rue de la Paix', '', '42000', 'Saint-Étienne',
+				'non', '10/07/2020 12:00'],
+			['4', 'Bernard', 'Julie', 'julie@example.com', '04/05/2003',
+				'Mme', '4 rue de la Paix', '', '42000', 'Saint-Étienne',
+				'non', '11/07/2020 08:15'],
+		])
+		admissions = list(export.admissions())
+		self.assertEqual([(admission['ligne'], admission['candidat'].code)
+			for admission in admissions], [(2, '1'), (6, '4')])
+		hector = admissions[0]
+		self.assertEqual(hector['candidat'].date_naissance,
+				datetime.date(2003, 2, 1))
+		self.assertEqual(hector['candidat'].sexe,
+				hector['candidat'].GENRE_HOMME)
+		self.assertTrue(hector['proposition'].internat)
+		self.assertFalse(hector['proposition'].cesure)
+		self.assertEqual(hector['proposition'].code_formation, 8842)
+		self.assertEqual(hector['responsables'], [])
+		self.assertFalse(admissions[1]['proposition'].internat)
+
+		# Une ligne erronée n'interrompt pas la lecture
+		self.assertEqual([ligne for ligne, _ in export.erreurs], [4, 5])
+		self.assertEqual(export.erreurs[1][1],
+				"Date invalide : 2003-02-01")
+
+class IndexRechercheTests(SimpleTestCase):
+	COMMUNES = [
+		('1', "Saint-Étienne"),
+		('2', "Étienne"),
+		('3', "Saint-Étienne-de-Fursac"),
+		('4', "Bourg-Saint-Étienne"),
+		('5', "Lyon"),
+		('6', "---"),
+	]
+
+	def test_normalise_nom(self):
+		self.assertEqual(normalise_nom(" Saint-Étienne "), "SAINT ETIENNE")
+		self.assertEqual(normalise_nom("L'Haÿ-les-Roses"), "L HAY LES ROSES")
+		self.assertEqual(normalise_nom(None), "")
+
+	def test_classement(self):
+		index = IndexRecherche(self.COMMUNES)
+		# Nom sans lettre ni chiffre : ignoré
+		self.assertEqual(len(index), 5)
+		# Début du nom, puis début d'un mot, les plus courts d'abord
+		self.assertEqual(index.rechercher("etienne", 10), ['2', '1', '4', '3'])
+		self.assertEqual(index.rechercher("SAINT-ETIENNE", 10),
+				['1', '3', '4'])
+		# Puis à l'intérieur d'un mot
+		self.assertEqual(index.rechercher("tienne", 10), ['2', '1', '4', '3'])
+		self.assertEqual(index.rechercher("y", 10), ['5'])
+		self.assertEqual(index.rechercher("étienne", 2), ['2', '1'])
+		self.assertEqual(index.rechercher("paris", 10), [])
+		self.assertEqual(index.rechercher(" - ", 10), [])
+
+	def test_cache(self):
+		index = IndexRecherche(self.COMMUNES)
+		with mock.patch.object(index, '_rechercher',
+				wraps=index._rechercher) as rechercher:
+			for texte in ("Saint", "saint", "SAINT"):
+				self.assertEqual(index.rechercher(texte, 10), ['1', '3', '4'])
+		self.assertEqual(rechercher.call_count, 1)
+
+class CacheLRUTests(SimpleTestCase):
+	def test_nombre_entrees(self):
+		cache = CacheLRU(2)
+		cache.set('a', 1)
+		cache.set('b', 2)
+		# 'a' devient la plus récemment utilisée
+		self.assertEqual(cache.get('a'), 1)
+		cache.set('c', 3)
+		self.assertEqual(len(cache), 2)
+		self.assertIsNone(cache.get('b'))
+		self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+	def test_taille_totale(self):
+		cache = CacheLRU(10, octets_max=100)
+		cache.set('a', 'A', 40)
+		cache.set('b', 'B', 40)
+		cache.set('a', 'AA', 50)
+		self.assertEqual(cache.octets, 90)
+		cache.set('c', 'C', 30)
+		self.assertIsNone(cache.get('b'))
+		self.assertEqual(cache.octets, 80)
+		# Une entrée plus grosse que le cache n'est pas conservée
+		cache.set('d', 'D', 200)
+		self.assertEqual((len(cache), cache.octets), (0, 0))
+
+class AutocompleteTests(TestCase):
+	@classmethod
+	def setUpTestData(cls):
+		for code, libelle in IndexRechercheTests.COMMUNES[:5]:
+			Commune.objects.create(code_insee=code, nom_clair=libelle.upper(),
+					nom_riche=libelle, libelle=libelle)
+
+	def setUp(self):
+		referentiel.invalider()
+		self.client.force_login(InscrireUser.objects.create_user(
+			email='secretariat@example.com', role=InscrireUser.ROLE_SECRETARIAT))
+
+	def resultats(self, texte):
+		reponse = self.client.get(reverse('autocomplete-commune'),
+				{'q': texte})
+		self.assertEqual(reponse.status_code, 200)
+		return [resultat['id'] for resultat in reponse.json()['results']]
+
+	def test_recherche(self):
+		self.assertEqual(self.resultats("Saint Etienne"), ['1', '3', '4'])
+		self.assertEqual(self.resultats("tienne"), ['2', '1', '4', '3'])
+
+		# L'index est reconstruit après une modification du référentiel
+		Commune.objects.create(code_insee='7', nom_clair="SAINT ETIENNE",
+				nom_riche="Saint Étienne", libelle="St Étienne")
+		self.assertEqual(self.resultats("st"), ['7'])
+
+	def test_etag(self):
+		url = reverse('autocomplete-commune')
+		premiere = self.client.get(url, {'q': "etienne"})
+		etag = premiere['ETag']
+		self.assertIn('private', premiere['Cache-Control'])
+		self.assertIn('max-age=300', premiere['Cache-Control'])
+
+		# Réponse identique tirée du cache, ou confirmée au navigateur
+		with mock.patch('inscrire.lib.referentiel.IndexRecherche.rechercher') \
+				as rechercher:
+			seconde = self.client.get(url, {'q': "ÉTIENNE"})
+			self.assertEqual(seconde.content, premiere.content)
+			self.assertEqual(seconde['ETag'], etag)
+			reponse = self.client.get(url, {'q': "etienne"},
+					HTTP_IF_NONE_MATCH=etag)
+			self.assertEqual(reponse.status_code, 304)
+		self.assertFalse(rechercher.called)
+
+		# Après une modification du référentiel, l'ancienne réponse n'est
+		# plus confirmée
+		Commune.objects.create(code_insee='8', nom_clair="ETIENNE",
+				nom_riche="Étienne", libelle="Étienne (bis)")
+		reponse = self.client.get(url, {'q': "etienne"},
+				HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(reponse.status_code, 200)
+		self.assertNotEqual(reponse['ETag'], etag)
+		self.assertIn('8', [resultat['id']
+			for resultat in reponse.json()['results']])
+
+class MaintenanceTests(SimpleTestCase):
+	def test_adresses_autorisees(self):
+		with self.assertLogs('inscrire.lib.maintenance', 'WARNING'):
+			adresses = AdressesAutorisees([
+				"192.0.2.10",
+				"  10.1.0.0/16  # réseau du lycée",
+				"# commentaire",
+				"",
+				"2001:db8:0:0::1",
+				"2001:db8:1::/48",
+				"adresse invalide",
+			])
+		for adresse in ("192.0.2.10", "10.1.255.3", "2001:db8::1",
+				"2001:db8:1:42::7"):
+			self.assertIn(adresse, adresses)
+		for adresse in ("192.0.2.11", "10.2.0.1", "2001:db8::2", "", None,
+				"invalide"):
+			self.assertNotIn(adresse, adresses)
+		self.assertEqual(adresses.adresses,
+				frozenset({"192.0.2.10", "2001:db8::1"}))
+
+	def test_fichiers(self):
+		with tempfile.TemporaryDirectory() as repertoire:
+			os.mkdir(os.path.join(repertoire, 'scripsup'))
+			with self.settings(BASE_DIR=repertoire,
+					MAINTENANCE_DELAI_VERIFICATION=0):
+				etat = Maintenance()
+				def ecrire(nom, contenu):
+					with open(os.path.join(repertoire, 'scripsup', nom),
+							'w', encoding='utf-8') as f:
+						f.write(contenu)
+
+				# Site en cours de configuration : fermé pour tous
+				self.assertEqual(etat.message_travaux('192.0.2.10'),
+						MESSAGE_CONFIGURATION)
+
+				ecrire('en_travaux.txt', "")
+				self.assertEqual(etat.message_travaux('192.0.2.10'), "")
+
+				ecrire('en_travaux.txt', "Maintenance en cours\n")
+				ecrire('maintenance_mode_ip.txt', "192.0.2.0/24\n")
+				ecrire('avertissement_maintenance.txt', " Fermeture ce soir ")
+				self.assertEqual(etat.message_travaux('198.51.100.1'),
+						"Maintenance en cours")
+				self.assertEqual(etat.message_travaux('192.0.2.10'), "")
+				self.assertEqual(etat.avertissement_maintenance(),
+						"Fermeture ce soir")
+
+	def test_delai_verification(self):
+		with tempfile.TemporaryDirectory() as repertoire:
+			os.mkdir(os.path.join(repertoire, 'scripsup'))
+			with self.settings(BASE_DIR=repertoire,
+					MAINTENANCE_DELAI_VERIFICATION=60):
+				etat = Maintenance()
+				self.assertEqual(etat.message_travaux('192.0.2.10'),
+						MESSAGE_CONFIGURATION)
+				with open(os.path.join(repertoire, 'scripsup',
+						'en_travaux.txt'), 'w') as f:
+					f.write("")
+				# Les fichiers ne sont pas relus avant l'échéance…
+				with mock.patch('inscrire.lib.maintenance.os.stat') as stat:
+					self.assertEqual(etat.message_travaux('192.0.2.10'),
+							MESSAGE_CONFIGURATION)
+				self.assertFalse(stat.called)
+				# … sauf demande explicite
+				etat.recharger()
+				self.assertEqual(etat.message_travaux('192.0.2.10'), "")
+
+class ConfigurationTests(InscriptionTestCase):
+	def cle(self):
+		return configurations._cle(configurations._version,
+				self.etablissement.pk)
+
+	def test_entete(self):
+		identite = ContentType.objects.get_for_model(FicheIdentite)
+		autre = Formation.objects.create(nom="PCSI", code_parcoursup=8843,
+				code_mef='30111111112', slug='pcsi',
+				etablissement=self.etablissement)
+		EnteteFiche.objects.create(fiche=identite,
+				etablissement=self.etablissement, texte="Établissement")
+		EnteteFiche.objects.create(fiche=identite, formation=self.formation,
+				texte="MPSI")
+		configurations._vider()
+
+		configuration = configurations.get(self.etablissement.pk)
+		self.assertEqual(configuration.entete(FicheIdentite, self.formation),
+				"MPSI")
+		self.assertEqual(configuration.entete(FicheIdentite, autre),
+				"Établissement")
+		self.assertEqual(configuration.entete(FicheIdentite, None),
+				"Établissement")
+		self.assertIsNone(configuration.entete(FicheScolarite, self.formation))
+
+	def test_lecture_seule(self):
+		configuration = EtablissementConfig(uai='0420041S',
+				fiches=frozenset({1}), exclus={1: frozenset({'photo'})},
+				entetes={(1, None): "Entête"}, photo_size_max=1,
+				photo_largeur=1, photo_hauteur=1, tolerance_ratio=1)
+		with self.assertRaises(TypeError):
+			configuration.exclus[2] = frozenset()
+		with self.assertRaises(TypeError):
+			configuration.entetes[(1, None)] = "Autre"
+
+		# L'instantané reste sérialisable pour le cache Django
+		copie = pickle.loads(pickle.dumps(configuration))
+		self.assertEqual(copie, configuration)
+		with self.assertRaises(TypeError):
+			copie.exclus[2] = frozenset()
+
+	def test_transaction_modifiee(self):
+		cache.clear()
+		configuration = configurations.get(self.etablissement.pk)
+		self.assertEqual(cache.get(self.cle()), configuration)
+
+		# Dans la transaction qui modifie la configuration, l'instantané
+		# est relu dans la base sans être publié
+		EnteteFiche.objects.create(
+				fiche=ContentType.objects.get_for_model(FicheIdentite),
+				etablissement=self.etablissement, texte="Nouveau")
+		with mock.patch('inscrire.lib.configuration.cache') as cache_mock:
+			nouvelle = configurations.get(self.etablissement.pk)
+		self.assertEqual(nouvelle.entete(FicheIdentite, None), "Nouveau")
+		self.assertFalse(cache_mock.set.called)
+		self.assertIs(configurations._configurations[self.etablissement.pk][0],
+				configuration)
+
+		# Après la validation, le cache est de nouveau utilisé
+		configurations._vider()
+		nouvelle = configurations.get(self.etablissement.pk)
+		self.assertEqual(nouvelle.entete(FicheIdentite, None), "Nouveau")
+		self.assertEqual(cache.get(self.cle()), nouvelle)
@@ -44,13 +44,15 @@ parametrage_urlpatterns = [
 	path('parcoursup/demissions',
 		views.candidats.ParcoursupDemissions.as_view(),
 		name='parcoursup-demissions'),
+	path('parcoursup/confirmation',
+		views.candidats.ParcoursupConfirmationInscriptions.as_view(),
+		name='parcoursup-confirmation'),
 ]
 
 rest_parcoursup_urlpatterns = [
 	path('admissionCandidat', views.parcoursup.AdmissionView.as_view()),
 	# Blague de Parcoursup qui ne respectait pas toujours la spec en 2019
 	path('admissionCandidat/admissionCandidat', views.parcoursup.AdmissionView.as_view()),
-	# TODO écrire la vue appelant la fonction etablissement.confirme_inscription_administrative
 ]
 
 auth_urlpatterns = [
@@ -105,6 +107,15 @@ mailing_patterns = [
 		name='mailing_list'),
 ]
 
+export_patterns = [
+	path('',
+		views.exports.ExportListView.as_view(),
+		name='export_list'),
+	path('<int:pk>/telechargement',
+		views.exports.ExportTelechargementView.as_view(),
+		name='export_telechargement'),
+]
+
 urlpatterns = [
 	path('', views.HomeView.as_view(), name='home'),
 	path('accounts/', include(auth_urlpatterns)),
@@ -127,5 +138,6 @@ urlpatterns = [
 		name='fiche-traiter'),
 	path('autocomplete/', include(autocomplete_urlpatterns)),
 	path('mailing/', include(mailing_patterns)),
+	path('export/', include(export_patterns)),
 	path('siecle/compare', views.siecle_compare.CompareView.as_view(), name="siecle_compare"),
 ]
@@ -26,3 +26,4 @@ from . import autocomplete
 from . import fiches
 from . import mailing
 from . import siecle_compare
+from . import exports
@@ -16,42 +16,99 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+"""
+Autocomplétion des communes, pays et établissements
+
+La recherche se fait dans les index en mémoire du référentiel (voir
+inscrire.lib.recherche), sans tenir compte des accents ni de la casse ;
+la base n'est interrogée que pour les résultats retenus.
+
+Les réponses ne dépendent que des tables de référence : elles sont
+conservées en mémoire (voir Referentiel.reponses) et peuvent être
+gardées par le navigateur, qui les revalide grâce à leur ETag. L'ETag
+comprend le numéro de version du référentiel : une réponse n'est
+jamais confirmée après une modification des tables de référence.
+"""
+
+import hashlib
+
 from dal import autocomplete
+from django.conf import settings
+from django.db.models import Case, When, Value, IntegerField
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, \
+		patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
 
+from inscrire.lib.referentiel import referentiel
+from inscrire.lib.utils import normalise_nom
 from inscrire.models import Pays, Commune, Etablissement
 
-class PaysAutocomplete(autocomplete.Select2QuerySetView):
-	def get_queryset(self):
-		if not self.request.user.is_authenticated:
-			return Pays.objects.none()
+class ReferentielAutocomplete(autocomplete.Select2QuerySetView):
+	"""
+	Autocomplétion sur l'un des index de recherche du référentiel
+	"""
+	model = None
+	index = None
+	# Nombre maximal de résultats proposés pour une recherche
+	resultats_max = 100
 
-		qs = Pays.objects.all()
+	def get(self, request, *args, **kwargs):
+		if not request.user.is_authenticated:
+			return super().get(request, *args, **kwargs)
 
-		if self.q:
-			qs = qs.filter(libelle__icontains=self.q)
+		# Un texte sans lettre ni chiffre ne donne aucun résultat, alors
+		# qu'un texte vide les donne tous
+		cle = (bool(self.q), normalise_nom(self.q),
+				request.GET.get('page', ''))
+		version, reponses = referentiel.reponses(self.index)
+		en_cache = reponses.get(cle)
+		if en_cache is None:
+			reponse = super().get(request, *args, **kwargs)
+			if reponse.status_code != 200:
+				return reponse
+			en_cache = (reponse.content, reponse['Content-Type'],
+					quote_etag("{}-{}".format(version,
+						hashlib.md5(reponse.content).hexdigest())))
+			reponses.set(cle, en_cache, len(reponse.content))
+		contenu, content_type, etag = en_cache
 
-		return qs
+		reponse = get_conditional_response(request, etag=etag)
+		if reponse is None:
+			reponse = HttpResponse(contenu, content_type=content_type)
+		reponse['ETag'] = etag
+		# Réservé aux utilisateurs connectés : pas de cache partagé
+		patch_cache_control(reponse, private=True, max_age=getattr(
+			settings, 'AUTOCOMPLETE_DUREE_CACHE', 300))
+		patch_vary_headers(reponse, ('Cookie',))
+		return reponse
 
-class CommuneAutocomplete(autocomplete.Select2QuerySetView):
 	def get_queryset(self):
 		if not self.request.user.is_authenticated:
-			return Commune.objects.none()
+			return self.model.objects.none()
 
-		qs = Commune.objects.all()
+		qs = self.model.objects.all()
 
 		if self.q:
-			qs = qs.filter(libelle__icontains=self.q)
+			cles = referentiel.recherche(self.index, self.q,
+					self.resultats_max)
+			if not cles:
+				return self.model.objects.none()
+			qs = qs.filter(pk__in=cles).order_by(Case(
+				*[When(pk=cle, then=Value(rang))
+					for rang, cle in enumerate(cles)],
+				output_field=IntegerField()))
 
 		return qs
 
-class EtablissementAutocomplete(autocomplete.Select2QuerySetView):
-	def get_queryset(self):
-		if not self.request.user.is_authenticated:
-			return Etablissement.objects.none()
-
-		qs = Etablissement.objects.all()
+class PaysAutocomplete(ReferentielAutocomplete):
+	model = Pays
+	index = 'pays'
 
-		if self.q:
-			qs = qs.filter(nom__icontains=self.q)
+class CommuneAutocomplete(ReferentielAutocomplete):
+	model = Commune
+	index = 'commune'
 
-		return qs
+class EtablissementAutocomplete(ReferentielAutocomplete):
+	model = Etablissement
+	index = 'etablissement'
@@ -26,14 +26,15 @@ from django.views.generic import TemplateView, DetailView, UpdateView, \
 from django.utils.decorators import method_decorator
 from django.shortcuts import redirect, render
 from django.urls import reverse
-from django.template.loader import select_template, render_to_string
+from django.template.loader import select_template
 from django.contrib.contenttypes.models import ContentType
 from django.views.generic.detail import SingleObjectMixin
-from django.core.mail import send_mail
 
-from inscrire.models import ResponsableLegal, Candidat, ParcoursupUser
+from inscrire.models import ResponsableLegal, Candidat, ParcoursupUser, \
+		DossierEtat, Courriel
 from inscrire.models.fiches import Fiche, all_fiche
 from inscrire.forms.fiches import candidat_form
+from inscrire.lib.gabarits import rendre_courriel
 from .permissions import AccessPersonnelMixin, AccessGestionnaireMixin
 
 
@@ -62,15 +63,20 @@ class CandidatFicheMixin:
 		FicheTpl = namedtuple('FicheTpl', ('fiche', 'form', 'template'))
 		fiches = []
 		candidat = self.object
-		etablissement = candidat.voeu_actuel.formation.etablissement
-		for fiche in candidat.fiche_set.filter(polymorphic_ctype__in = etablissement.fiches.all()).exclude(etat=Fiche.ETAT_ANNULEE):
+		# Formation partagée par tous les formulaires, qui y lisent la
+		# configuration de l'établissement
+		formation = candidat.voeu_actuel.formation
+		configuration = formation.etablissement.configuration
+		for fiche in candidat.fiche_set.filter(polymorphic_ctype__in = configuration.fiches).exclude(etat=Fiche.ETAT_ANNULEE):
 			try:
 				if self.request.method in ('POST', 'PUT'):
 					form = candidat_form[type(fiche)](instance=fiche,
 							data=self.request.POST,
-							files=self.request.FILES)
+							files=self.request.FILES,
+							formation=formation)
 				else:
-					form = candidat_form[type(fiche)](instance=fiche)
+					form = candidat_form[type(fiche)](instance=fiche,
+							formation=formation)
 			except:
 				form = None
 
@@ -133,7 +139,8 @@ class CandidatDetail(AccessPersonnelMixin, CandidatFicheMixin, DetailView):
 		data = request.POST
 		if data['fonction'] == 'Valider toutes les fiches':
 			Fiche.objects.filter(candidat=candidat, etat=Fiche.ETAT_CONFIRMEE,
-				polymorphic_ctype__in = candidat.voeu_actuel.formation.etablissement.fiches.all()).update(etat=Fiche.ETAT_TERMINEE)
+				polymorphic_ctype__in = candidat.voeu_actuel.formation.etablissement.configuration.fiches).update(etat=Fiche.ETAT_TERMINEE)
+			DossierEtat.objects.mettre_a_jour([candidat])
 			return redirect(reverse('candidat_detail',
 				args=[candidat.dossier_parcoursup]))
 
@@ -198,14 +205,44 @@ class ParcoursupSynchroManuelle(AccessGestionnaireMixin, View):
 	def post(self, request, *args, **kwargs):
 		for psup_user in ParcoursupUser.objects.filter(
 				etablissement__inscriptions=True):
-			psup_user.get_candidats_admis()
+			rapport = psup_user.get_candidats_admis()
+			messages.info(request, "{} : {} candidat(s) importé(s) dont "
+					"{} nouveau(x), {} erreur(s), en {:.1f} s.".format(
+						psup_user.etablissement, len(rapport['candidats']),
+						rapport['crees'], rapport['erreurs'],
+						rapport['duree']))
 		return redirect('home')
 
 class ParcoursupDemissions(AccessGestionnaireMixin, View):
 	def post(self, request, *args, **kwargs):
 		for psup_user in ParcoursupUser.objects.filter(
 				etablissement__inscriptions=True):
-			psup_user.demissions()
+			rapport = psup_user.demissions()
+			messages.info(request, "{} : {} démission(s) parmi {} "
+					"vœu(x) acceptés définitivement.".format(
+						psup_user.etablissement,
+						len(rapport['demissions']), rapport['voeux']))
+		return redirect('home')
+
+
+class ParcoursupConfirmationInscriptions(AccessGestionnaireMixin, View):
+	"""
+	Confirme à Parcoursup l'inscription administrative des candidats
+	dont le dossier est terminé.
+	"""
+	def post(self, request, *args, **kwargs):
+		for psup_user in ParcoursupUser.objects.filter(
+				etablissement__inscriptions=True):
+			resultats = psup_user.etablissement.confirme_inscription_administrative()
+			succes = sum(1 for resultat in resultats if resultat.succes)
+			if succes:
+				messages.success(request, "{} : {} inscription(s) "
+						"confirmée(s) à Parcoursup.".format(
+							psup_user.etablissement, succes))
+			for resultat in resultats:
+				if not resultat.succes:
+					messages.error(request, "{} : {}".format(
+						resultat.candidat, resultat.message))
 		return redirect('home')
 
 
@@ -223,24 +260,18 @@ class PhotoInexploitable(AccessGestionnaireMixin, View):
 				'etablissement': voeu_actuel.formation.etablissement,
 				'voeu': voeu_actuel,
 				}
-		ok=send_mail(
-				render_to_string('inscrire/email_photographie_inexploitable_subject.txt',
-					context=render_context).strip(),
-				render_to_string('inscrire/email_photographie_inexploitable_message.txt',
-					context=render_context).strip(),
+		sujet, texte, html = rendre_courriel('email_photographie_inexploitable',
+				render_context, formation=voeu_actuel.formation)
+		Courriel.objects.mettre_en_file(sujet, texte,
 				"{email}".format(
 					email=voeu_actuel.formation.etablissement.email_technique),
 				("{candidat_prenom} {candidat_nom} <{email}>".format(
 					candidat_prenom=str(candidat.user.first_name),
 					candidat_nom=str(candidat.user.last_name),
 					email=str(candidat.user.email)),),
-				html_message=render_to_string('inscrire/email_photographie_inexploitable_message.html',
-					context=render_context).strip()
+				message_html=html,
+				candidat=candidat
 			)
-		if ok:
-			message += " et mail envoyé."
-			messages.success(request, message)
-		else:
-			message += " mais le mail n'a pas pu être envoyé. Contactez le candidat."
-			messages.error(request, message)
+		message += " et mail mis en file d'envoi."
+		messages.success(request, message)
 		return redirect(reverse('candidat_detail', args=[candidat.dossier_parcoursup]))
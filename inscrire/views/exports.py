@@ -0,0 +1,66 @@
+# -*- coding: utf8 -*-
+
+# scripsup - Inscription en ligne en CPGE
+# Copyright (c) 2020 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from django.http import FileResponse, Http404
+from django.shortcuts import redirect
+from django.views.generic import CreateView, DetailView
+
+from inscrire.models import TacheExport
+from inscrire.forms.exports import ExportForm
+from .permissions import AccessDirectionMixin
+
+class ExportListView(AccessDirectionMixin, CreateView):
+	"""
+	Demande d'un nouvel export et liste des exports déjà demandés, avec
+	leur avancement. La page se recharge d'elle-même tant qu'un export
+	est en attente ou en cours.
+	"""
+	model = TacheExport
+	form_class = ExportForm
+	template_name = 'inscrire/export_list.html'
+
+	def get_context_data(self, **kwargs):
+		context = super().get_context_data(**kwargs)
+		context['exports'] = TacheExport.objects.select_related(
+				'etablissement', 'demandeur').order_by('-date_creation')[:50]
+		context['actualiser'] = any(export.etat in (TacheExport.ETAT_ATTENTE,
+			TacheExport.ETAT_EN_COURS) for export in context['exports'])
+		return context
+
+	def form_valid(self, form):
+		form.instance.demandeur = self.request.user
+		form.instance.url_base = self.request.build_absolute_uri('/')
+		form.save()
+		return redirect('export_list')
+
+class ExportTelechargementView(AccessDirectionMixin, DetailView):
+	"""
+	Téléchargement du fichier produit par un export terminé
+	"""
+	model = TacheExport
+
+	def get(self, request, *args, **kwargs):
+		export = self.get_object()
+		if export.etat != TacheExport.ETAT_TERMINEE or not export.fichier:
+			raise Http404("Export non disponible")
+		try:
+			fichier = export.fichier.open('rb')
+		except FileNotFoundError:
+			raise Http404("Fichier d'export introuvable")
+		return FileResponse(fichier, as_attachment=True,
+				filename=export.nom_telechargement())
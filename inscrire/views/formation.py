@@ -16,8 +16,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import csv, io
-from django.http import HttpResponse
+import csv, io, itertools
+from django.contrib import messages
+from django.http import StreamingHttpResponse
 from django.views.generic import ListView, DetailView, View, FormView
 from django.views.generic.detail import SingleObjectMixin
 from django.shortcuts import redirect
@@ -30,12 +31,16 @@ from .permissions import AccessDirectionMixin, AccessGestionnaireMixin
 from inscrire.forms.parametrage import OptionActiverFormset, \
 		FormationForm
 from inscrire.forms.formation import ImportParcoursupForm, ImportClassementForm
+from inscrire.lib.statistiques import formations_avec_compteurs
+from inscrire.lib.exports import Echo, ExportAdmis
 
 class FormationListView(AccessDirectionMixin, ListView):
 	model = Formation
 
 	def get_context_data(self, *args, **kwargs):
 		context = super().get_context_data(*args, **kwargs)
+		context['formation_list'] = formations_avec_compteurs(
+				context['formation_list'])
 		context['import_manuel_form'] = ImportParcoursupForm()
 		return context
 
@@ -85,14 +90,36 @@ class FormationUpdateView(AccessDirectionMixin, SingleObjectMixin, View):
 class ImportParcoursupView(AccessGestionnaireMixin, FormView):
 	form_class = ImportParcoursupForm
 
+	# Nombre maximal d'erreurs détaillées dans les messages
+	ERREURS_AFFICHEES = 20
+
 	def form_valid(self, form):
-		propositions = form.propositions()
 		psup_user = form.cleaned_data['formation'].etablissement.parcoursupuser
-		for proposition in propositions:
-			candidat = psup_user.import_candidat(proposition)
-			candidat.email_bienvenue(self.request)
+		# Les admissions sont lues au fil de l'eau et importées par lots
+		rapport = psup_user.import_candidats(form.export.admissions())
+		Candidat.emails_bienvenue(rapport['candidats'], self.request)
+
+		erreurs = form.export.erreurs + [(psup['ligne'], "candidat {} : {}".format(
+				psup['candidat'].code, message))
+				for psup, message in rapport['echecs']]
+		erreurs.sort()
+		messages.info(self.request, "{} candidat(s) importé(s) dont {} "
+				"nouveau(x), {} ligne(s) en erreur.".format(
+					len(rapport['candidats']), rapport['crees'], len(erreurs)))
+		for ligne, message in erreurs[:self.ERREURS_AFFICHEES]:
+			messages.error(self.request, "Ligne {} : {}".format(ligne, message))
+		if len(erreurs) > self.ERREURS_AFFICHEES:
+			messages.error(self.request, "… et {} autre(s) erreur(s).".format(
+				len(erreurs) - self.ERREURS_AFFICHEES))
 		return super().form_valid(form)
 
+	def form_invalid(self, form):
+		# Le formulaire est affiché dans la liste des formations
+		for erreurs in form.errors.values():
+			for erreur in erreurs:
+				messages.error(self.request, erreur)
+		return redirect('formation_list')
+
 	def get_success_url(self):
 		return reverse('formation_list')
 
@@ -129,80 +156,18 @@ class ImportClassementView(AccessGestionnaireMixin, FormView):
 
 
 class ExportCandidatsAdmisView(AccessDirectionMixin, DetailView):
+	"""
+	Export CSV des candidats d'une formation, produit au fil de l'eau
+	(voir inscrire.lib.exports)
+	"""
 	model=Formation
 
 	def get(self, request, *args, **kwargs):
 		formation=self.get_object()
-		candidats_etat_edition = formation.candidats_etat_edition().annotate(
-			etat_dossier=Value("Edition", output_field=models.CharField()))
-		candidats_etat_complet = formation.candidats_etat_complet().annotate(
-			etat_dossier=Value("Complet", output_field=models.CharField()))
-		candidats_etat_termine = formation.candidats_etat_termine().annotate(
-			etat_dossier=Value("Termine", output_field=models.CharField()))
-		candidats_etat_demission = formation.candidats_etat_demission().annotate(
-			etat_dossier=Value("Démission", output_field=models.CharField()))
-		candidats=candidats_etat_edition.union(candidats_etat_complet,
-			candidats_etat_termine, candidats_etat_demission).order_by('last_name', 'first_name')
-
-		reponse  = HttpResponse(content_type='text/csv')
+		export = ExportAdmis([formation], self.request.build_absolute_uri)
+		writer = csv.writer(Echo(), delimiter  = ';')
+		lignes = itertools.chain([export.entete()], export.lignes())
+		reponse = StreamingHttpResponse((writer.writerow(ligne) for ligne in lignes),
+				content_type='text/csv')
 		reponse['Content-Disposition'] = 'attachment; filename = admis_{}.csv'.format(formation.slug)
-		writer = csv.writer(reponse, delimiter  = ';')
-		entete=[
-				'Parcoursup',
-				'Classement',
-				'Nom',
-				'Prénom',
-				'INE',
-				'Etat',
-				'Dernière connexion',
-				'Photo',
-				'Internat',
-				'Genre',
-				'Email',
-				'Téléphone',
-				'Mobile',
-				'Adresse',
-				'Série Bac',
-				'Mention Bac'
-			]
-		rangs_obligatoires=list(set(formation.mefoption_set.filter(
-			modalite=MefOption.MODALITE_OBLIGATOIRE,
-			inscriptions=True).values_list('rang',
-					flat=True)))
-		rangs_obligatoires.sort()
-		for r in rangs_obligatoires:
-			entete.append("Option obligatoire (rang {})".format(r))
-		for r in range(1, 7):
-			entete.append("Option facultative {}".format(r))
-		writer.writerow(entete)
-		for candidat in candidats:
-			voeu=candidat.voeu(formation)
-			ligne=[
-					candidat.dossier_parcoursup,
-					voeu.classement,
-					candidat.last_name, candidat.first_name,
-					candidat.ine, candidat.etat_dossier,
-					candidat.user.last_login.strftime("%Y-%m-%d") if candidat.user.last_login else "",
-					request.build_absolute_uri(candidat.photo.url) if candidat.photo else "",
-					voeu.internat,
-					candidat.genre_court(),
-					candidat.user.email,
-					candidat.telephone,
-					candidat.telephone_mobile,
-					candidat.adresse,
-					candidat.bac_serie,
-					candidat.bac_mention_court()
-				]
-			fichescolarite=FicheScolarite.objects.filter(candidat=candidat, formation=formation).exclude(etat=Fiche.ETAT_ANNULEE)
-			if fichescolarite.exists():
-				fichescolarite=fichescolarite[0]
-				for r in rangs_obligatoires:
-					try:
-						mefoption=fichescolarite.options.get(formation=formation, rang=r)
-						ligne.append(mefoption.__str__())
-					except MefOption.DoesNotExist:
-						ligne.append("")
-				for mefoption in fichescolarite.options.filter(formation=formation, modalite=MefOption.MODALITE_FACULTATIVE):
-					ligne.append(mefoption.__str__())
-			writer.writerow(ligne)
 		return reponse
@@ -26,6 +26,7 @@ from django.contrib.auth.mixins import LoginRequiredMixin, AccessMixin
 from inscrire.models import InscrireUser, Candidat, Formation, \
 		ParcoursupUser, Fiche
 from inscrire.forms.formation import ImportParcoursupForm, ImportClassementForm
+from inscrire.lib.statistiques import formations_avec_compteurs
 from .candidats import CandidatFicheMixin
 
 class HomeView(AccessMixin, View):
@@ -50,7 +51,8 @@ class DirectionHomeView(TemplateView):
 
 	def get_context_data(self, **kwargs):
 		context = super().get_context_data(**kwargs)
-		context['formation_list'] = Formation.objects.all().order_by('etablissement', 'nom')
+		context['formation_list'] = formations_avec_compteurs(
+				Formation.objects.all().order_by('etablissement', 'nom'))
 		context['import_manuel_form'] = ImportParcoursupForm()
 		context['import_classement_form'] = ImportClassementForm()
 
@@ -52,3 +52,8 @@ class MailingList(AccessDirectionMixin, ListView):
     model = Mailing
     template_name = "mailing/mailing_list.html"
     context_object_name = 'mailings'
+
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        context['mailings'] = Mailing.ajouter_progression(context['mailings'])
+        return context
@@ -19,19 +19,18 @@
 """
 Vues permettant le paramétrage des formations gérées
 """
+from django.contrib import messages
 from django.views.generic import FormView, UpdateView, View
 from django.views.generic.detail import SingleObjectTemplateResponseMixin, \
 		SingleObjectMixin
 from django.urls import reverse_lazy
-from django.utils.text import slugify
-from django.db import IntegrityError
 
 from requests.exceptions import HTTPError
 from inscrire.lib.parcoursup_rest import ParcoursupError
+from inscrire.lib.import_structures import ImportStructures
 
 import inscrire.forms.parametrage as param_forms
-from inscrire.models import Etablissement, Formation, MefMatiere, \
-		MefOption, ParcoursupUser
+from inscrire.models import Etablissement, ParcoursupUser
 from .permissions import AccessGestionnaireMixin, AccessDirectionMixin, \
 		AccessTechniqueMixin
 
@@ -49,72 +48,11 @@ class ImportStructuresView(AccessDirectionMixin, FormView):
 	success_url = reverse_lazy('formation_list')
 
 	def form_valid(self, form):
-		structures = form.lire_structures()
 		nomenclature = form.lire_nomenclature()
-		mefs = nomenclature.mefs()
-
-		# On active automatiquement les inscriptions pour
-		# l'établissement, puisque l'on dispose désormais de formations
-		# connues.
 		etablissement = Etablissement.objects.get(numero_uai=nomenclature.parametres()['uai'])
-		etablissement.inscriptions = True
-		etablissement.save()
-
-		# Création des classes
-		for code_mef in structures.mefs():
-			# On ignore ce qui n'est pas une classe du supérieur
-			if code_mef[0] != '3':
-				continue
-			# On crée la formation correspondante
-			formation = None
-			formation_slug = slugify(mefs[code_mef].formation)
-			formation_slug_rang = 0
-			while not formation:
-				try:
-					formation, _ = Formation.objects.update_or_create(
-						code_mef=code_mef,
-						etablissement=etablissement,
-						defaults={
-							'nom': mefs[code_mef].libelle_long,
-							'slug': formation_slug,
-						}
-					)
-				except IntegrityError:
-					# Slug pas forcément unique, on se laisse quelques
-					# tentatives.
-					formation_slug_rang += 1
-					if formation_slug_rang > 10:
-						raise IntegrityError
-					formation_slug = "{}-{}".format(
-							slugify(mefs[code_mef].formation),
-							formation_slug_rang)
-
-			def get_matiere(matiere):
-				matiere_db, _ = MefMatiere.objects.get_or_create(
-						code=matiere.code,
-						libelle_court=matiere.libelle_court,
-						libelle_long=matiere.libelle_long,
-						libelle_edition=matiere.libelle_edition,
-					)
-				return matiere_db
-			# Ajout des options obligatoires
-			for option in mefs[code_mef].options_obligatoires:
-				MefOption.objects.update_or_create(
-						formation=formation,
-						modalite=MefOption.MODALITE_OBLIGATOIRE,
-						rang=option.rang,
-						matiere=get_matiere(option.matiere),
-						defaults={})
-			# Ajout des options facultatives
-			for option in mefs[code_mef].programme:
-				if option.modalite_election == 'F':
-					MefOption.objects.update_or_create(
-							formation=formation,
-							modalite=MefOption.MODALITE_FACULTATIVE,
-							rang=0,
-							matiere=get_matiere(option.matiere),
-							defaults={})
-
+		resultat = ImportStructures(etablissement, form.lire_structures(),
+				nomenclature).executer()
+		messages.success(self.request, "Import terminé : {}.".format(resultat))
 		return super().form_valid(form)
 
 class AccesParcoursupView(UpdateView):
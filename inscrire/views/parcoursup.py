@@ -23,6 +23,7 @@ Vues gérant les appels de l'API REST de Parcoursup
 import json
 import logging
 
+from django.conf import settings
 from django.http import JsonResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
@@ -33,7 +34,7 @@ import requests
 
 from inscrire.models import ParcoursupUser, ParcoursupMessageRecuLog, \
 		Candidat, ResponsableLegal, Formation, EtatVoeu, Voeu, \
-		HistoriqueVoeu, Commune, Pays
+		HistoriqueVoeu, Commune, Pays, TacheAdmission
 import inscrire.lib.utils as utils
 from inscrire.lib.parcoursup_rest import ParcoursupRest
 
@@ -188,8 +189,29 @@ class AdmissionView(ParcoursupClientView):
 
 	def parcoursup(self, msg_log=None):
 		donnees = self.json.get('donneesCandidat', self.json) # Bug 2019 Parcoursup
+		# On vérifie dès maintenant que les données sont exploitables,
+		# afin de les refuser immédiatement dans le cas contraire.
 		psup = ParcoursupRest.parse_parcoursup_admission(donnees)
-		candidat = self.user.import_candidat(psup)
-		# Envoi de l'e-mail de bienvenue
-		candidat.email_bienvenue(self.request)
-		return self.json_response(True, msg_log=msg_log)
+
+		# Parcoursup renvoie régulièrement les mêmes données (par
+		# exemple avec « Relancer ») : on ne refait pas l'import.
+		msg_log.empreinte = ParcoursupRest.empreinte_admission(donnees)
+		if self.user.admission_deja_traitee(psup, msg_log.empreinte):
+			return self.json_response(True, msg_log=msg_log,
+					message="Requete deja traitee")
+
+		if not getattr(settings, 'PARCOURSUP_ADMISSION_ASYNCHRONE', True):
+			candidat = self.user.import_candidat(psup,
+					empreinte=msg_log.empreinte)
+			# Envoi de l'e-mail de bienvenue
+			candidat.email_bienvenue(self.request)
+			return self.json_response(True, msg_log=msg_log)
+
+		# L'import est confié à la commande traite_admissions
+		response = self.json_response(True, msg_log=msg_log)
+		msg_log.save()
+		TacheAdmission.objects.create(user=self.user, message=msg_log,
+				donnees=json.dumps(dict(donnees)),
+				dossier_parcoursup=int(psup['candidat'].code),
+				url_base=self.request.build_absolute_uri('/'))
+		return response
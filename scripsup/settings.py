@@ -161,7 +161,81 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
+# Fichiers produits par les exports d'établissement. Ce répertoire ne
+# doit pas être publié par le serveur web : les exports ne sont servis
+# qu'à la direction, par l'application.
+EXPORTS_ROOT = os.path.join(BASE_DIR, 'exports/')
+
 
 AUTH_USER_MODEL = 'inscrire.InscrireUser'
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'home'
+
+# Connexions HTTP vers l'API Parcoursup. Chaque utilisateur Parcoursup
+# dispose d'une session persistante dont les connexions sont réutilisées
+# d'une requête à l'autre. Les requêtes refusées pour saturation sont
+# retentées avec une attente exponentielle ; le débit maximal se règle
+# pour chaque établissement sur le ParcoursupUser. Les valeurs omises
+# prennent leur valeur par défaut (voir inscrire.lib.parcoursup_rest).
+PARCOURSUP_HTTP = {
+	'TIMEOUT_CONNEXION': 5,
+	'TIMEOUT_LECTURE': 30,
+	'POOL_CONNECTIONS': 1,
+	'POOL_MAXSIZE': 10,
+	'KEEPALIVE': True,
+	'DUREE_INACTIVITE': 300,
+	'TENTATIVES': 4,
+	'ATTENTE_INITIALE': 0.5,
+	'ATTENTE_MAX': 30,
+}
+
+# Nombre maximal de requêtes envoyées simultanément à Parcoursup lors de
+# la confirmation en masse des inscriptions administratives. Cette
+# valeur ne devrait pas dépasser PARCOURSUP_HTTP['POOL_MAXSIZE'].
+PARCOURSUP_CONCURRENCE = 4
+
+# Nombre de candidats importés dans une même transaction lors d'une
+# synchronisation complète avec Parcoursup.
+PARCOURSUP_IMPORT_LOT = 200
+
+# Les admissions envoyées par Parcoursup sont enregistrées dans une file
+# et traitées par la commande traite_admissions. Mettre à False pour
+# importer les candidats pendant la requête de Parcoursup.
+PARCOURSUP_ADMISSION_ASYNCHRONE = True
+
+# Paramètres des files de tâches en arrière-plan (voir
+# inscrire.models.taches) : nombre de tentatives, attente exponentielle
+# entre deux tentatives, délai au-delà duquel une tâche interrompue est
+# reprise.
+TACHES = {
+	'TENTATIVES': 5,
+	'ATTENTE_INITIALE': 30,
+	'ATTENTE_MAX': 3600,
+	'DELAI_VERROU': 900,
+}
+
+# Durée (en secondes) de conservation en cache des nombres de dossiers
+# affichés dans les tableaux de bord de la direction.
+STATISTIQUES_DUREE_CACHE = 60
+
+# Nombre de messages d'un mailing mis en file d'envoi ensemble.
+MAILING_TAILLE_LOT = 100
+
+# Nombre maximal d'e-mails remis au serveur SMTP par minute pour une même
+# adresse d'expédition (0 : pas de limite). Les e-mails en excès sont
+# reportés par la commande traite_courriels.
+COURRIELS_DEBIT_MAX = 0
+
+# Cache des réponses de l'autocomplétion (communes, pays,
+# établissements) : nombre maximal de réponses et taille totale (en
+# octets) conservées en mémoire par index, et durée (en secondes)
+# pendant laquelle le navigateur peut réutiliser une réponse sans la
+# revalider.
+AUTOCOMPLETE_CACHE_ENTREES = 2000
+AUTOCOMPLETE_CACHE_OCTETS = 4 * 1024 * 1024
+AUTOCOMPLETE_DUREE_CACHE = 300
+
+# Délai (en secondes) entre deux vérifications, par chaque processus, de
+# la modification des fichiers du mode maintenance (en_travaux.txt,
+# maintenance_mode_ip.txt, avertissement_maintenance.txt).
+MAINTENANCE_DELAI_VERIFICATION = 2